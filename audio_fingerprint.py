@@ -3,10 +3,27 @@ import subprocess
 import tempfile
 import requests
 import numpy as np
-import librosa
 import hashlib
-from s3 import download_video_from_s3
-from video_fingerprint import cleanup
+from contextlib import closing
+import metrics
+import models
+from s3 import open_media
+from audio_landmarks import LANDMARK_SAMPLE_RATE, extract_landmarks
+from video_fingerprint import cleanup, iter_ffmpeg_output
+
+# Unset keeps the original 44.1 kHz WAV + librosa.load path so fingerprints stay reproducible.
+# Set (e.g. 16000) to stream mono audio at that rate from ffmpeg and compute MFCCs in chunks.
+AUDIO_FINGERPRINT_SAMPLE_RATE = os.getenv("AUDIO_FINGERPRINT_SAMPLE_RATE")
+AUDIO_CHUNK_SECONDS = float(os.getenv("AUDIO_CHUNK_SECONDS", "30"))
+N_MFCC = 20
+# librosa's MFCC defaults
+N_FFT = 2048
+HOP_LENGTH = 512
+# The WAV generate_audio_fingerprint hashes: uncompressed, 44.1 kHz, stereo
+WAV_OUTPUT_ARGS = ["-acodec", "pcm_s16le", "-ar", "44100", "-ac", "2"]
+# Part of the result cache key: bump the leading number when a change alters the audio fingerprint
+AUDIO_FINGERPRINT_RESULT_VERSION = f"1:{N_MFCC}:{AUDIO_FINGERPRINT_SAMPLE_RATE or 'wav'}:{AUDIO_CHUNK_SECONDS}"
+
 def download_video(video_url: str) -> str:
     """
     Downloads a video from the given URL and saves it to a temporary file.
@@ -25,18 +42,19 @@ def download_video(video_url: str) -> str:
     return video_path
 
 
-def extract_audio(video_path: str) -> str:
+def extract_audio(video_path: str, output_dir: str = None) -> str:
     """
     Extracts audio from a video file using ffmpeg and saves it as a temporary WAV file.
+    The WAV goes next to the video unless output_dir is given.
     """
-    audio_path = video_path.replace(".mp4", ".wav")
+    audio_path = os.path.splitext(video_path)[0] + ".wav"
+    if output_dir:
+        audio_path = os.path.join(output_dir, os.path.basename(audio_path))
 
     cmd = [
         "ffmpeg", "-i", video_path,
         "-vn",  # no video
-        "-acodec", "pcm_s16le",  # uncompressed WAV
-        "-ar", "44100",  # sample rate
-        "-ac", "2",  # stereo
+        *WAV_OUTPUT_ARGS,
         audio_path,
         "-y"  # overwrite if exists
     ]
@@ -49,9 +67,12 @@ def generate_audio_fingerprint(audio_path: str) -> str:
     """
     Generates an audio fingerprint using MFCC features and SHA256 hashing.
     """
-    y, sr = librosa.load(audio_path, sr=None)
-    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20)
-    mfcc_mean = np.mean(mfcc, axis=1)  # average across time
+    librosa = models.get("librosa")
+    with metrics.stage("audio_load"):
+        y, sr = librosa.load(audio_path, sr=None)
+    with metrics.stage("mfcc"):
+        mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=20)
+        mfcc_mean = np.mean(mfcc, axis=1)  # average across time
 
     # Convert MFCC array to bytes and hash it
     mfcc_bytes = mfcc_mean.tobytes()
@@ -61,19 +82,120 @@ def generate_audio_fingerprint(audio_path: str) -> str:
 
 
 
+def iter_audio_chunks(video_path: str, sample_rate: int, chunk_seconds: float = AUDIO_CHUNK_SECONDS):
+    """
+    Stream mono float32 audio resampled to sample_rate from ffmpeg's stdout,
+    yielding chunk_seconds of samples at a time (the last chunk may be shorter).
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", video_path,
+        "-vn", "-ac", "1", "-ar", str(sample_rate),
+        "-f", "f32le", "pipe:1"
+    ]
+    chunk_bytes = int(sample_rate * chunk_seconds) * 4
+    with closing(iter_ffmpeg_output(cmd, chunk_bytes, "ffmpeg_decode_audio", keep_partial=True)) as chunks:
+        for buf in chunks:
+            yield np.frombuffer(buf[:len(buf) - len(buf) % 4], dtype="<f4")
+
+
+def streaming_mfcc_mean(chunks, sr: int, n_mfcc: int = N_MFCC, n_fft: int = N_FFT, hop_length: int = HOP_LENGTH):
+    """
+    Mean MFCC vector over a stream of audio chunks, holding at most one chunk
+    plus one analysis window in memory. Frames are cut exactly as they would
+    be from the whole signal (center=False), and dB conversion is not clipped
+    relative to the loudest frame, so the result doesn't depend on chunking.
+    """
+    librosa = models.get("librosa")
+    buffer = np.zeros(0, dtype=np.float32)
+    total = np.zeros(n_mfcc, dtype=np.float64)
+    frames = 0
+
+    def consume(samples):
+        nonlocal total, frames
+        with metrics.stage("mfcc"):
+            mel = librosa.feature.melspectrogram(y=samples, sr=sr, n_fft=n_fft, hop_length=hop_length, center=False)
+            mfcc = librosa.feature.mfcc(S=librosa.power_to_db(mel, top_db=None), n_mfcc=n_mfcc)
+        total += mfcc.sum(axis=1, dtype=np.float64)
+        frames += mfcc.shape[1]
+        return mfcc.shape[1]
+
+    for chunk in chunks:
+        buffer = np.concatenate([buffer, chunk])
+        if len(buffer) < n_fft:
+            continue
+        n_frames = 1 + (len(buffer) - n_fft) // hop_length
+        consume(buffer[:(n_frames - 1) * hop_length + n_fft])
+        buffer = buffer[n_frames * hop_length:]
+
+    if frames == 0:
+        if len(buffer) == 0:
+            raise ValueError("No audio samples decoded")
+        # Shorter than one window, pad it out like librosa would
+        consume(np.pad(buffer, (0, n_fft - len(buffer))))
+
+    return (total / frames).astype(np.float32)
+
+
+def mfcc_fingerprint(chunks, sample_rate: int) -> str:
+    """SHA256 of the mean MFCCs of mono float32 chunks at sample_rate."""
+    mfcc_mean = streaming_mfcc_mean(chunks, sample_rate)
+    return hashlib.sha256(mfcc_mean.tobytes()).hexdigest()
+
+
+def generate_streaming_audio_fingerprint(video_path: str, sample_rate: int) -> str:
+    """
+    Audio fingerprint from MFCCs computed incrementally on mono audio streamed
+    from ffmpeg, without writing a WAV or loading the full track.
+    """
+    return mfcc_fingerprint(iter_audio_chunks(video_path, sample_rate), sample_rate)
+
+
+def analyze_audio(video_url, video_id, s3_client):
+    """
+    Returns (fingerprint, landmarks): the exact-match MFCC hash and the
+    spectral-peak landmarks used for near-duplicate search, both computed
+    from a single download.
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        # Step 1: Open the video (cached download shared with the other analyses, or a ranged stream)
+        with open_media(video_url, s3_client, "audio_fingerprint") as input_file_path:
+            # Step 2: Landmarks from mono audio streamed at the landmark rate
+            landmarks = extract_landmarks(iter_audio_chunks(input_file_path, LANDMARK_SAMPLE_RATE))
+
+            if AUDIO_FINGERPRINT_SAMPLE_RATE:
+                # Steps 3+4: stream audio straight into the MFCC computation
+                fingerprint = generate_streaming_audio_fingerprint(input_file_path, int(AUDIO_FINGERPRINT_SAMPLE_RATE))
+                return fingerprint, landmarks
+
+            # Step 3: Extract audio
+            with metrics.stage("ffmpeg_decode_audio"):
+                audio_path = extract_audio(input_file_path, output_dir)
+
+        # Step 4: Generate audio fingerprint
+        fingerprint = generate_audio_fingerprint(audio_path)
+
+        return fingerprint, landmarks
+    finally:
+        cleanup(output_dir)
+
+
 def fingerprint_audio(video_url, video_id,s3_client):
-    temp_dir = tempfile.mkdtemp()
     output_dir = tempfile.mkdtemp()
     try:
-        # Step 1: Download video
-        input_file_path, input_file_name = download_video_from_s3(video_url,video_id,temp_dir,s3_client)
+        # Step 1: Open the video (cached download shared with the other analyses, or a ranged stream)
+        with open_media(video_url, s3_client, "audio_fingerprint") as input_file_path:
+            if AUDIO_FINGERPRINT_SAMPLE_RATE:
+                # Steps 2+3: stream audio straight into the MFCC computation
+                return generate_streaming_audio_fingerprint(input_file_path, int(AUDIO_FINGERPRINT_SAMPLE_RATE))
 
-        # Step 2: Extract audio
-        audio_path = extract_audio(input_file_path)
+            # Step 2: Extract audio
+            with metrics.stage("ffmpeg_decode_audio"):
+                audio_path = extract_audio(input_file_path, output_dir)
 
         # Step 3: Generate audio fingerprint
         fingerprint = generate_audio_fingerprint(audio_path)
 
         return fingerprint
     finally:
-        cleanup(temp_dir,output_dir)
\ No newline at end of file
+        cleanup(output_dir)
@@ -0,0 +1,570 @@
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import defaultdict
+import numpy as np
+from scipy.ndimage import maximum_filter
+import metrics
+from fingerprint_snapshot import (
+    FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS, HEADER_BYTES, ID_BYTES, FingerprintSnapshot, SnapshotSync,
+    datetime_to_ms, latest_update_ms, ms_to_datetime, snapshot_ids, updated_field, write_atomic,
+)
+
+# Landmarks are computed on mono audio at this rate
+LANDMARK_SAMPLE_RATE = int(os.getenv("AUDIO_LANDMARK_SAMPLE_RATE", "8000"))
+# A query matches a video when this many landmarks agree on one time offset
+LANDMARK_MIN_MATCHES = int(os.getenv("AUDIO_LANDMARK_MIN_MATCHES", "20"))
+# Landmark hashes shared by more postings than this are too common to be useful
+LANDMARK_MAX_POSTINGS = int(os.getenv("AUDIO_LANDMARK_MAX_POSTINGS", "50000"))
+# Cap per video so the stored field stays well under Mongo's document limit
+LANDMARK_MAX_PER_VIDEO = int(os.getenv("AUDIO_LANDMARK_MAX_PER_VIDEO", "500000"))
+# In-memory rows, as a fraction, that may be replaced or removed before the index is reloaded without them
+LANDMARK_COMPACT_DEAD_RATIO = float(os.getenv("AUDIO_LANDMARK_COMPACT_DEAD_RATIO", "0.5"))
+# Videos written since the landmark snapshot before one worker writes a new one
+LANDMARK_SNAPSHOT_COMPACT_ROWS = int(os.getenv("AUDIO_LANDMARK_SNAPSHOT_COMPACT_ROWS", "1000"))
+# Part of the result cache key: bump the leading number when a change alters extract_landmarks' result
+LANDMARK_RESULT_VERSION = f"1:{LANDMARK_SAMPLE_RATE}:{LANDMARK_MAX_PER_VIDEO}"
+
+N_FFT = 512
+HOP_LENGTH = 256
+# Peak neighbourhood (frequency bins, frames) and minimum height over the block median
+PEAK_FREQ_RADIUS = 15
+PEAK_TIME_RADIUS = 10
+PEAK_MIN_DB_ABOVE_MEDIAN = 10.0
+# Each anchor peak is paired with up to FAN_OUT later peaks within MAX_DT frames
+FAN_OUT = 3
+MAX_DT = 63
+MAX_DF = 127
+# Spectrogram frames processed per peak-picking block
+BLOCK_FRAMES = 1024
+
+_TIME_BITS = 24
+_TIME_MASK = (1 << _TIME_BITS) - 1
+
+LANDMARK_SNAPSHOT_MAGIC = b"STRMLMS1"
+# magic, video count, posting count, watermark (ms since epoch, Mongo time), built at (unix seconds)
+_LANDMARK_HEADER = struct.Struct("<8sQQqd")
+_WINDOW = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+
+
+def _landmark_hash(f1, f2, dt):
+    """Pack (anchor bin, target bin, frame delta) into one 24-bit hash."""
+    return (f1 << 15) | (f2 << 6) | dt
+
+
+class _LandmarkExtractor:
+    """
+    Incremental spectral-peak landmark extraction. Audio is fed in chunks;
+    spectrogram columns are peak-picked block by block with enough overlap
+    that the result doesn't depend on how the audio was chunked.
+    """
+
+    def __init__(self):
+        self._samples = np.zeros(0, dtype=np.float32)
+        self._columns = []
+        # Absolute frame index of self._columns[0]
+        self._column_base = 0
+        # Frames whose peaks have been decided
+        self._peaks_done = 0
+        self._peaks = []
+        self.landmarks = []
+
+    def feed(self, samples):
+        self._samples = np.concatenate([self._samples, samples.astype(np.float32, copy=False)])
+        if len(self._samples) < N_FFT:
+            return
+        n_frames = 1 + (len(self._samples) - N_FFT) // HOP_LENGTH
+        idx = np.arange(N_FFT)[None, :] + HOP_LENGTH * np.arange(n_frames)[:, None]
+        spectrum = np.abs(np.fft.rfft(self._samples[idx] * _WINDOW, axis=1))
+        self._columns.extend(20 * np.log10(spectrum + 1e-10))
+        self._samples = self._samples[n_frames * HOP_LENGTH:]
+        self._pick_peaks(final=False)
+        self._pair(final=False)
+
+    def finish(self):
+        self._pick_peaks(final=True)
+        self._pair(final=True)
+        return self.landmarks
+
+    def _pick_peaks(self, final):
+        total = self._column_base + len(self._columns)
+        while True:
+            end = total if final else min(total - PEAK_TIME_RADIUS, self._peaks_done + BLOCK_FRAMES)
+            if end <= self._peaks_done or (not final and end - self._peaks_done < BLOCK_FRAMES):
+                break
+            lo = max(self._column_base, self._peaks_done - PEAK_TIME_RADIUS)
+            hi = min(total, end + PEAK_TIME_RADIUS)
+            block = np.array(self._columns[lo - self._column_base:hi - self._column_base])
+            # Median over the block being decided, so chunking doesn't change it
+            core = slice(self._peaks_done - lo, end - lo)
+            is_peak = block == maximum_filter(
+                block, size=(2 * PEAK_TIME_RADIUS + 1, 2 * PEAK_FREQ_RADIUS + 1), mode="constant", cval=-np.inf
+            )
+            is_peak &= block > np.median(block[core]) + PEAK_MIN_DB_ABOVE_MEDIAN
+            times, freqs = np.nonzero(is_peak[core])
+            self._peaks.extend(zip((times + self._peaks_done).tolist(), freqs.tolist()))
+            self._peaks_done = end
+            # Keep only the columns the next block still needs
+            drop = max(0, self._peaks_done - PEAK_TIME_RADIUS - self._column_base)
+            del self._columns[:drop]
+            self._column_base += drop
+            if final:
+                break
+
+    def _pair(self, final):
+        peaks = self._peaks
+        i = 0
+        while i < len(peaks):
+            t1, f1 = peaks[i]
+            # Targets up to t1 + MAX_DT must all be known before pairing this anchor
+            if not final and t1 + MAX_DT >= self._peaks_done:
+                break
+            fanned = 0
+            for j in range(i + 1, len(peaks)):
+                t2, f2 = peaks[j]
+                dt = t2 - t1
+                if dt > MAX_DT or fanned >= FAN_OUT:
+                    break
+                if dt == 0 or abs(f2 - f1) > MAX_DF:
+                    continue
+                self.landmarks.append((_landmark_hash(f1, f2, dt), t1))
+                fanned += 1
+            i += 1
+        # Targets are always later than their anchor, so paired anchors are done with
+        del peaks[:i]
+
+
+def extract_landmarks(chunks, max_landmarks: int = LANDMARK_MAX_PER_VIDEO) -> np.ndarray:
+    """
+    Spectral-peak landmarks for mono audio at LANDMARK_SAMPLE_RATE, fed as an
+    iterable of float32 chunks. Returns an (n, 2) uint32 array of (hash, frame).
+    """
+    extractor = _LandmarkExtractor()
+    # Chunks may be decoded lazily, only the extraction itself is timed
+    extract_seconds = 0.0
+    for chunk in chunks:
+        start = time.perf_counter()
+        extractor.feed(chunk)
+        extract_seconds += time.perf_counter() - start
+        if len(extractor.landmarks) >= max_landmarks:
+            break
+    start = time.perf_counter()
+    landmarks = extractor.finish()[:max_landmarks]
+    metrics.record_stage("audio_landmarks", extract_seconds + time.perf_counter() - start)
+    return np.array(landmarks, dtype=np.uint32).reshape(-1, 2)
+
+
+def landmarks_to_bytes(landmarks: np.ndarray) -> bytes:
+    return np.ascontiguousarray(landmarks, dtype="<u4").tobytes()
+
+
+def landmarks_from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype="<u4").reshape(-1, 2).astype(np.uint32)
+
+
+def _pack_keys(packed, frames, row_offset: int = 0):
+    """(row, stored frame - query frame) for each posting, packed into one int64."""
+    rows = (packed >> np.uint64(_TIME_BITS)).astype(np.int64) + row_offset
+    offsets = (packed & np.uint64(_TIME_MASK)).astype(np.int64) - frames
+    # Offsets shifted to be non-negative
+    return (rows << (_TIME_BITS + 1)) | (offsets + (1 << _TIME_BITS))
+
+
+def _offset_keys(postings, frame, row_offset: int = 0):
+    """_pack_keys for one in-memory posting list and the query frame its hash came from."""
+    # The buffer view is released on return, before anyone appends to the array again
+    return _pack_keys(np.frombuffer(postings, dtype=np.uint64), frame, row_offset)
+
+
+def _range_offset_keys(postings, starts, counts, frames):
+    """_pack_keys for the postings[start:start + count] runs of a snapshot, one run per query landmark."""
+    total = int(counts.sum())
+    # Position of every posting: its run's start plus its place within the run
+    run_starts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    packed = np.asarray(postings[run_starts + np.arange(total)])
+    return _pack_keys(packed, np.repeat(frames, counts))
+
+
+class LandmarkSnapshot(FingerprintSnapshot):
+    """
+    A read-only memory map of a landmark snapshot: `postings` are the packed
+    (row, frame) postings of every video sorted by `hashes`, their landmark
+    hash, and `ids` the video ids of the rows, sorted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, count, n_postings, self.watermark_ms, self.built_at = _LANDMARK_HEADER.unpack(
+                f.read(_LANDMARK_HEADER.size)
+            )
+            stat = os.fstat(f.fileno())
+        if magic != LANDMARK_SNAPSHOT_MAGIC:
+            raise ValueError(f"❌ {path} is not a landmark snapshot")
+        self.inode = stat.st_ino
+        offset = HEADER_BYTES
+        if n_postings:
+            self.postings = np.memmap(path, dtype=np.uint64, mode="r", offset=offset, shape=(n_postings,))
+            self.hashes = np.memmap(path, dtype=np.uint32, mode="r", offset=offset + 8 * n_postings, shape=(n_postings,))
+        else:
+            self.postings = np.zeros(0, dtype=np.uint64)
+            self.hashes = np.zeros(0, dtype=np.uint32)
+        offset += 12 * n_postings
+        if count:
+            self.ids = np.memmap(path, dtype=f"S{ID_BYTES}", mode="r", offset=offset, shape=(count,))
+        else:
+            self.ids = np.zeros(0, dtype=f"S{ID_BYTES}")
+
+
+def write_landmark_snapshot(path: str, ids, hashes, rows, frames, watermark_ms: int):
+    """
+    Write landmark postings as a snapshot: hashes[i] was seen at frames[i] in
+    the video ids[rows[i]]. The file is replaced atomically.
+    """
+    ids = snapshot_ids(ids)
+    order = np.argsort(ids, kind="stable")
+    # Rows are renumbered to follow the sorted ids
+    sorted_rows = np.empty(len(ids), dtype=np.uint64)
+    sorted_rows[order] = np.arange(len(ids), dtype=np.uint64)
+    postings = (sorted_rows[np.asarray(rows, dtype=np.int64)] << np.uint64(_TIME_BITS)) | (
+        np.asarray(frames, dtype=np.uint64) & np.uint64(_TIME_MASK)
+    )
+    hashes = np.asarray(hashes, dtype=np.uint32)
+    by_hash = np.argsort(hashes, kind="stable")
+    header = _LANDMARK_HEADER.pack(
+        LANDMARK_SNAPSHOT_MAGIC, len(ids), len(hashes), watermark_ms, time.time()
+    ).ljust(HEADER_BYTES, b"\0")
+    write_atomic(path, [header, postings[by_hash].tobytes(), hashes[by_hash].tobytes(), ids[order].tobytes()])
+
+
+def build_landmark_snapshot(collection, field: str, path: str) -> LandmarkSnapshot:
+    """Full scan of the landmark collection into a new snapshot file."""
+    # Taken before the scan, so anything written during it is polled again by the first sync
+    watermark_ms = latest_update_ms(collection, field)
+    ids, hashes, rows, frames = [], [], [], []
+    with metrics.stage("mongo_scan"):
+        cursor = collection.find({field: {"$exists": True, "$ne": None}}, {"_id": 1, field: 1}, batch_size=1000)
+        for doc in cursor:
+            landmarks = landmarks_from_bytes(doc[field])
+            hashes.append(landmarks[:, 0])
+            frames.append(landmarks[:, 1])
+            rows.append(np.full(len(landmarks), len(ids), dtype=np.int64))
+            ids.append(str(doc["_id"]))
+    metrics.count("mongo_scan", "documents", len(ids))
+    if not ids:
+        hashes = frames = rows = [np.zeros(0, dtype=np.uint32)]
+    write_landmark_snapshot(
+        path, ids, np.concatenate(hashes), np.concatenate(rows), np.concatenate(frames), watermark_ms
+    )
+    print(f"💾 Wrote '{field}' snapshot with landmarks for {len(ids)} videos to {path}")
+    return LandmarkSnapshot(path)
+
+
+class LandmarkIndex:
+    """
+    Inverted index from landmark hash to (video, frame) postings. A query
+    only touches the postings of its own hashes and scores each video by the
+    largest number of landmarks agreeing on one time offset, so partial clips
+    match at whatever position they came from. The postings are either all
+    in memory (load) or a mapped LandmarkSnapshot plus the videos written
+    since (load_snapshot, kept current by LandmarkSnapshotSync).
+    """
+
+    def __init__(self, field: str = "landmarks"):
+        self.field = field
+        self.watermark_ms = 0
+        # video_id -> write time of the version applied within the sync overlap window (None: added
+        # locally, time not known yet), so a poll doesn't add the same landmarks again
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._reset_locked(None)
+        # Writes made while load() is scanning Mongo, replayed after the swap
+        self._reload_log = None
+
+    def _reset_locked(self, base):
+        # Mapped snapshot rows come first; rows hidden by later writes are in _base_dead
+        self._base = base
+        self._base_dead = set()
+        self._postings = defaultdict(lambda: array("Q"))
+        self._doc_ids = []
+        self._doc_rows = {}
+        self._alive = []
+        # Replaced or removed in-memory rows whose postings are still in _postings
+        self.dead_rows = 0
+
+    @property
+    def _base_rows(self):
+        return 0 if self._base is None else len(self._base)
+
+    def __len__(self):
+        return len(self._doc_rows) + self._base_rows - len(self._base_dead)
+
+    def _hide_base_row(self, video_id):
+        if not self._base_rows:
+            return
+        key = video_id.encode()
+        row = int(np.searchsorted(self._base.ids, key))
+        if row < self._base_rows and self._base.ids[row] == key:
+            self._base_dead.add(row)
+
+    def _add_locked(self, video_id, landmarks):
+        old_row = self._doc_rows.get(video_id)
+        if old_row is not None:
+            self._alive[old_row] = False
+            self.dead_rows += 1
+        self._hide_base_row(video_id)
+        row = len(self._doc_ids)
+        self._doc_ids.append(video_id)
+        self._alive.append(True)
+        self._doc_rows[video_id] = row
+        for landmark_hash, frame in landmarks.tolist():
+            self._postings[landmark_hash].append((row << _TIME_BITS) | (frame & _TIME_MASK))
+
+    def _remove_locked(self, video_id):
+        row = self._doc_rows.pop(video_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self.dead_rows += 1
+        self._hide_base_row(video_id)
+
+    def _write_locked(self, video_id, landmarks):
+        if landmarks is None:
+            self._remove_locked(video_id)
+        else:
+            self._add_locked(video_id, landmarks)
+        if self._reload_log is not None:
+            self._reload_log.append((video_id, landmarks))
+
+    def add(self, video_id: str, landmarks: np.ndarray):
+        """Insert or replace a video's landmarks (replaced postings are skipped until compaction)."""
+        video_id = str(video_id)
+        with self._lock:
+            self._write_locked(video_id, landmarks)
+            self._recent[video_id] = None
+
+    def remove(self, video_id: str):
+        with self._lock:
+            self._write_locked(str(video_id), None)
+
+    def apply(self, video_id: str, updated_ms: int, data) -> bool:
+        """Apply a write polled from Mongo, unless this index already has it. Returns whether it did."""
+        landmarks = landmarks_from_bytes(data) if data else None
+        with self._lock:
+            seen = self._recent.get(video_id, 0)
+            self._recent[video_id] = updated_ms
+            if seen is None or seen == updated_ms:
+                return False
+            self._write_locked(video_id, landmarks)
+            return True
+
+    def forget_before(self, cutoff_ms: int):
+        """Drop polled writes older than cutoff_ms from the ones apply() skips."""
+        with self._lock:
+            self._recent = {k: v for k, v in self._recent.items() if v is None or v >= cutoff_ms}
+
+    def query(self, landmarks: np.ndarray, min_matches: int = LANDMARK_MIN_MATCHES, exclude_id: str = None):
+        """Return [(video_id, score), ...] for videos with at least min_matches aligned landmarks."""
+        if len(landmarks) == 0:
+            return []
+        landmarks = np.asarray(landmarks)
+        in_memory = []
+        with self._lock:
+            base = self._base
+            base_rows = self._base_rows
+            # Copied: writes after the lock is released may hide more rows
+            base_dead = set(self._base_dead)
+            for i, (landmark_hash, frame) in enumerate(landmarks.tolist()):
+                postings = self._postings.get(landmark_hash)
+                if postings and len(postings) <= LANDMARK_MAX_POSTINGS:
+                    # In-memory rows are numbered after the snapshot's
+                    in_memory.append((i, _offset_keys(postings, frame, base_rows)))
+            alive = np.array(self._alive, dtype=bool)
+            doc_ids = self._doc_ids
+
+        # The snapshot is read-only, so its postings are looked up outside the lock
+        starts = counts = np.zeros(len(landmarks), dtype=np.int64)
+        if base_rows:
+            query_hashes = landmarks[:, 0].astype(np.uint32)
+            starts = np.searchsorted(base.hashes, query_hashes, side="left")
+            counts = np.searchsorted(base.hashes, query_hashes, side="right") - starts
+        totals = counts.copy()
+        for i, keys in in_memory:
+            totals[i] += len(keys)
+        usable = totals <= LANDMARK_MAX_POSTINGS
+        keys = [keys for i, keys in in_memory if usable[i]]
+        from_base = usable & (counts > 0)
+        if from_base.any():
+            keys.append(_range_offset_keys(
+                base.postings, starts[from_base], counts[from_base], landmarks[from_base, 1].astype(np.int64)
+            ))
+        if not keys:
+            return []
+
+        pairs, counts = np.unique(np.concatenate(keys), return_counts=True)
+        # Resampling and hop alignment jitter peaks by a frame, so merge each offset with the next one
+        neighbour = np.searchsorted(pairs, pairs + 1)
+        has_neighbour = neighbour < len(pairs)
+        has_neighbour[has_neighbour] = pairs[neighbour[has_neighbour]] == pairs[has_neighbour] + 1
+        counts = counts + np.where(has_neighbour, counts[np.minimum(neighbour, len(pairs) - 1)], 0)
+
+        hits = counts >= min_matches
+        best = defaultdict(int)
+        for row, count in zip((pairs[hits] >> (_TIME_BITS + 1)).tolist(), counts[hits].tolist()):
+            live = row not in base_dead if row < base_rows else alive[row - base_rows]
+            if live and count > best[row]:
+                best[row] = count
+        matches = [
+            (base.ids[row].decode() if row < base_rows else doc_ids[row - base_rows], score)
+            for row, score in best.items()
+        ]
+        if exclude_id is not None:
+            matches = [m for m in matches if m[0] != str(exclude_id)]
+        return sorted(matches, key=lambda m: -m[1])
+
+    def load_snapshot(self, snapshot: LandmarkSnapshot):
+        """Replace the index contents with a mapped snapshot's postings."""
+        with self._lock:
+            self._reset_locked(snapshot)
+            # The sync polls everything after the snapshot's watermark again
+            self._recent = {}
+            if self._reload_log is not None:
+                for video_id, landmarks in self._reload_log:
+                    self._write_locked(video_id, landmarks)
+                self._reload_log = None
+
+    def export(self):
+        """Live contents as (ids, hashes, rows, frames), rows indexing ids, e.g. to write a new snapshot."""
+        with self._lock:
+            ids, hashes, rows, frames = [], [], [], []
+            live_base = 0
+            if self._base_rows:
+                live = np.ones(self._base_rows, dtype=bool)
+                live[list(self._base_dead)] = False
+                new_rows = np.cumsum(live) - 1
+                packed = np.asarray(self._base.postings)
+                keep = live[packed >> np.uint64(_TIME_BITS)]
+                ids.append(np.asarray(self._base.ids)[live])
+                hashes.append(np.asarray(self._base.hashes)[keep])
+                rows.append(new_rows[packed[keep] >> np.uint64(_TIME_BITS)])
+                frames.append(packed[keep] & np.uint64(_TIME_MASK))
+                live_base = int(live.sum())
+            if self._postings:
+                alive = np.array(self._alive, dtype=bool)
+                new_rows = live_base + np.cumsum(alive) - 1
+                packed = np.frombuffer(b"".join(p.tobytes() for p in self._postings.values()), dtype=np.uint64)
+                keep = alive[packed >> np.uint64(_TIME_BITS)]
+                lengths = [len(p) for p in self._postings.values()]
+                ids.append(np.array(self._doc_ids, dtype=f"S{ID_BYTES}")[alive])
+                hashes.append(np.repeat(np.fromiter(self._postings.keys(), dtype=np.uint32), lengths)[keep])
+                rows.append(new_rows[packed[keep] >> np.uint64(_TIME_BITS)])
+                frames.append(packed[keep] & np.uint64(_TIME_MASK))
+        if not ids:
+            return np.zeros(0, dtype=f"S{ID_BYTES}"), np.zeros(0, np.uint32), np.zeros(0, np.int64), np.zeros(0, np.uint64)
+        return np.concatenate(ids), np.concatenate(hashes), np.concatenate(rows), np.concatenate(frames)
+
+    def needs_compaction(self) -> bool:
+        """True once replaced and removed rows make up LANDMARK_COMPACT_DEAD_RATIO of the in-memory rows."""
+        return self.dead_rows > 0 and self.dead_rows >= LANDMARK_COMPACT_DEAD_RATIO * len(self._doc_ids)
+
+    def load(self, collection, batch_size: int = 1000):
+        """(Re)build the index from every document in the landmark collection, dropping dead postings."""
+        # Taken before the scan, so anything written during it is polled again by the first sync
+        watermark_ms = latest_update_ms(collection, self.field)
+        timestamp_field = updated_field(self.field)
+        cutoff = watermark_ms - int(FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS * 1000)
+        recent = {}
+        with self._lock:
+            self._reload_log = []
+        fresh = LandmarkIndex(self.field)
+        try:
+            cursor = collection.find(
+                {self.field: {"$exists": True, "$ne": None}},
+                {"_id": 1, self.field: 1, timestamp_field: 1},
+                batch_size=batch_size,
+            )
+            with metrics.stage("mongo_scan"):
+                for doc in cursor:
+                    video_id = str(doc["_id"])
+                    fresh._add_locked(video_id, landmarks_from_bytes(doc[self.field]))
+                    if doc.get(timestamp_field) is not None and datetime_to_ms(doc[timestamp_field]) >= cutoff:
+                        # The first sync polls these again
+                        recent[video_id] = datetime_to_ms(doc[timestamp_field])
+            metrics.count("mongo_scan", "documents", len(fresh))
+        except Exception:
+            with self._lock:
+                self._reload_log = None
+            raise
+        with self._lock:
+            self._reset_locked(None)
+            self._postings = fresh._postings
+            self._doc_ids = fresh._doc_ids
+            self._doc_rows = fresh._doc_rows
+            self._alive = fresh._alive
+            for video_id, landmarks in self._reload_log:
+                if landmarks is None:
+                    self._remove_locked(video_id)
+                else:
+                    self._add_locked(video_id, landmarks)
+                    recent[video_id] = None
+            self._reload_log = None
+            self._recent = recent
+            self.watermark_ms = watermark_ms
+        print(f"✅ Loaded landmarks for {len(fresh)} videos into index")
+        return len(fresh)
+
+    def sync(self, collection, batch_size: int = 1000) -> int:
+        """
+        Apply landmarks written since the watermark, instead of a full reload,
+        and reload once dead postings pile up. Returns how many were applied.
+        """
+        timestamp_field = updated_field(self.field)
+        overlap_ms = int(FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS * 1000)
+        with self._lock:
+            watermark_ms = self.watermark_ms
+        cursor = collection.find(
+            {timestamp_field: {"$gte": ms_to_datetime(max(0, watermark_ms - overlap_ms))}},
+            {"_id": 1, self.field: 1, timestamp_field: 1},
+            batch_size=batch_size,
+        )
+        applied = 0
+        with metrics.stage("mongo_sync"):
+            for doc in cursor:
+                updated_ms = datetime_to_ms(doc[timestamp_field])
+                watermark_ms = max(watermark_ms, updated_ms)
+                if self.apply(str(doc["_id"]), updated_ms, doc.get(self.field)):
+                    applied += 1
+        with self._lock:
+            self.watermark_ms = max(self.watermark_ms, watermark_ms)
+            cutoff_ms = self.watermark_ms - overlap_ms
+        self.forget_before(cutoff_ms)
+        metrics.count("mongo_sync", "documents", applied)
+        if self.needs_compaction():
+            print(f"🧹 {self.dead_rows} of {len(self._doc_ids)} '{self.field}' rows are dead, reloading")
+            self.load(collection)
+        return applied
+
+
+class LandmarkSnapshotSync(SnapshotSync):
+    """SnapshotSync for a LandmarkIndex: maps the host's landmark snapshot and polls the landmark collection."""
+
+    suffix = "lms"
+    compact_rows = LANDMARK_SNAPSHOT_COMPACT_ROWS
+
+    def _open(self):
+        return LandmarkSnapshot(self.path)
+
+    def _build(self):
+        return build_landmark_snapshot(self.collection, self.field, self.path)
+
+    def _write_export(self, watermark_ms: int):
+        write_landmark_snapshot(self.path, *self.index.export(), watermark_ms)
+        return LandmarkSnapshot(self.path)
+
+    def _apply(self, video_id: str, updated_ms: int, value) -> bool:
+        # The index also knows which videos this worker wrote itself
+        return self.index.apply(video_id, updated_ms, value)
+
+    def _forget(self, cutoff_ms: int):
+        self.index.forget_before(cutoff_ms)
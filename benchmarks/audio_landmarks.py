@@ -0,0 +1,116 @@
+"""
+Recall, false positives and query latency of the audio landmark index on a
+synthetic catalog. Queries are excerpts of catalog tracks with noise, gain
+changes or resampling applied; negatives are tracks that were never indexed.
+
+    python -m benchmarks.audio_landmarks --catalog 200 --queries 100
+"""
+import argparse
+import json
+import time
+import numpy as np
+from scipy.signal import resample_poly
+from audio_landmarks import LANDMARK_SAMPLE_RATE, LandmarkIndex, extract_landmarks
+
+SR = LANDMARK_SAMPLE_RATE
+
+
+def synthetic_track(seconds, seed):
+    """Overlapping decaying notes with harmonics over a little background noise."""
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SR)
+    y = 0.02 * rng.standard_normal(n)
+    pos = 0
+    while pos < n:
+        length = min(int(rng.uniform(0.3, 1.0) * SR), n - pos)
+        t = np.arange(length) / SR
+        freq = rng.uniform(100, 3000)
+        envelope = np.exp(-t * rng.uniform(3, 8))
+        y[pos:pos + length] += envelope * (np.sin(2 * np.pi * freq * t) + 0.5 * np.sin(4 * np.pi * freq * t))
+        pos += int(rng.uniform(0.05, 0.3) * SR)
+    return (y / 2).astype(np.float32)
+
+
+def excerpt(track, seconds, rng):
+    start = int(rng.integers(0, len(track) - int(seconds * SR)))
+    return track[start:start + int(seconds * SR)].copy()
+
+
+def distort(clip, kind, rng):
+    if kind == "noise":
+        # ~10 dB SNR
+        return clip + np.float32(np.std(clip) / 3) * rng.standard_normal(len(clip)).astype(np.float32)
+    if kind == "gain":
+        return clip * np.float32(0.25)
+    if kind == "resample":
+        # Round-trip through 44.1 kHz, as a re-encode would
+        return resample_poly(resample_poly(clip, 441, 80), 80, 441).astype(np.float32)
+    return clip
+
+
+def chunked(y, seconds=5):
+    step = int(seconds * SR)
+    return [y[i:i + step] for i in range(0, len(y), step)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--catalog", type=int, default=200, help="indexed tracks")
+    parser.add_argument("--track-seconds", type=float, default=60)
+    parser.add_argument("--queries", type=int, default=100, help="queries per distortion")
+    parser.add_argument("--query-seconds", type=float, default=10)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tracks = [synthetic_track(args.track_seconds, seed) for seed in range(args.catalog)]
+    index = LandmarkIndex()
+    start = time.perf_counter()
+    total_landmarks = 0
+    for i, track in enumerate(tracks):
+        landmarks = extract_landmarks(chunked(track))
+        total_landmarks += len(landmarks)
+        index.add(f"video-{i}", landmarks)
+    build_seconds = time.perf_counter() - start
+
+    report = {
+        "catalog": args.catalog,
+        "landmarks_per_second_of_audio": round(total_landmarks / (args.catalog * args.track_seconds), 1),
+        "build_s": round(build_seconds, 2),
+        "results": [],
+    }
+    for kind in ("clean", "noise", "gain", "resample", "negative"):
+        hits = false_positives = 0
+        latencies = []
+        for q in range(args.queries):
+            if kind == "negative":
+                target = None
+                clip = excerpt(synthetic_track(args.track_seconds, 10_000_000 + q), args.query_seconds, rng)
+            else:
+                target = int(rng.integers(0, args.catalog))
+                clip = distort(excerpt(tracks[target], args.query_seconds, rng), kind, rng)
+            landmarks = extract_landmarks(chunked(clip))
+            start = time.perf_counter()
+            matches = index.query(landmarks)
+            latencies.append(time.perf_counter() - start)
+            matched = {video_id for video_id, _ in matches}
+            if target is not None and f"video-{target}" in matched:
+                hits += 1
+            false_positives += len(matched - {f"video-{target}"})
+        stats = {
+            "queries": kind,
+            "recall": None if kind == "negative" else round(hits / args.queries, 3),
+            "false_positives_per_query": round(false_positives / args.queries, 3),
+            "query_ms_p50": round(float(np.percentile(latencies, 50)) * 1000, 3),
+            "query_ms_p99": round(float(np.percentile(latencies, 99)) * 1000, 3),
+        }
+        print(json.dumps(stats))
+        report["results"].append(stats)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Worker cold-start benchmark. For each role set, a fresh interpreter times
+`import main` and then loading every model the roles need (what
+WORKER_PREWARM does in the background, or the first event pays for), so
+the numbers include the torch/transformers/librosa import cost.
+
+    python -m benchmarks.cold_start --roles video_fingerprint audio_fingerprint video_fingerprint,audio_fingerprint nsfw_detection --output cold_start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+import models
+import_s = time.perf_counter() - start
+heavy_at_import = sorted(m for m in ("torch", "transformers", "librosa", "cv2") if m in sys.modules)
+for role in main.WORKER_ROLES:
+    for name in main.EVENT_MODELS[role]:
+        models.get(name)
+print(json.dumps({
+    "import_main_s": round(import_s, 4),
+    "model_load_s": {k: round(v, 4) for k, v in models.load_times().items()},
+    "ready_s": round(time.perf_counter() - start, 4),
+    "heavy_modules_at_import": heavy_at_import,
+}))
+"""
+
+
+def probe(roles):
+    env = {**os.environ, "WORKER_ROLES": roles}
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    # models.get() logs each load, the JSON is the last line
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--roles", nargs="+", default=["video_fingerprint", "audio_fingerprint", "nsfw_detection"],
+                        help="WORKER_ROLES values to measure, one per worker configuration")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for roles in args.roles:
+        runs = [probe(roles) for _ in range(args.repeat)]
+        stats = {
+            "roles": roles,
+            "import_main_median_s": round(statistics.median(r["import_main_s"] for r in runs), 4),
+            "ready_median_s": round(statistics.median(r["ready_s"] for r in runs), 4),
+            "heavy_modules_at_import": runs[0]["heavy_modules_at_import"],
+            "runs": runs,
+        }
+        print(json.dumps({k: v for k, v in stats.items() if k != "runs"}))
+        results.append(stats)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark the fingerprint index backends against each other on synthetic
+256-bit fingerprints.
+
+    python -m benchmarks.fingerprint_index --sizes 1000000,10000000
+"""
+import argparse
+import json
+import time
+import numpy as np
+from fingerprint_index import FINGERPRINT_INDEX_BACKENDS, FINGERPRINT_WORDS
+from hash_math import words_to_hex
+
+
+def make_queries(rng, words, count, threshold):
+    """Pick stored fingerprints and flip 0..threshold+1 random bits in each."""
+    queries = []
+    for i in range(count):
+        query = words[rng.integers(len(words))].copy()
+        for bit in rng.choice(256, size=i % (threshold + 2), replace=False):
+            query[bit // 64] ^= np.uint64(1 << (63 - bit % 64))
+        queries.append(words_to_hex(query))
+    return queries
+
+
+def bench_backend(name, ids, words, queries, extra_words, threshold):
+    index = FINGERPRINT_INDEX_BACKENDS[name]("fingerprint")
+
+    start = time.perf_counter()
+    index.bulk_load(ids, words)
+    build_s = time.perf_counter() - start
+
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        matches = index.query(query, threshold)
+        latencies.append(time.perf_counter() - start)
+        results.append(sorted(video_id for video_id, _ in matches))
+
+    start = time.perf_counter()
+    for i, row in enumerate(extra_words):
+        index.add(f"new-{i}", words_to_hex(row))
+    insert_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(len(extra_words)):
+        index.remove(f"new-{i}")
+    delete_s = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    return results, {
+        "backend": name,
+        "build_s": round(build_s, 3),
+        "query_ms_mean": round(float(latencies_ms.mean()), 3),
+        "query_ms_p50": round(float(np.percentile(latencies_ms, 50)), 3),
+        "query_ms_p99": round(float(np.percentile(latencies_ms, 99)), 3),
+        "insert_us_mean": round(insert_s / max(len(extra_words), 1) * 1e6, 2),
+        "delete_us_mean": round(delete_s / max(len(extra_words), 1) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000000,10000000")
+    parser.add_argument("--backends", default=",".join(FINGERPRINT_INDEX_BACKENDS))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--threshold", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    report = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        words = rng.integers(0, 2**64, size=(size, FINGERPRINT_WORDS), dtype=np.uint64)
+        ids = [str(i) for i in range(size)]
+        queries = make_queries(rng, words, args.queries, args.threshold)
+        extra_words = rng.integers(0, 2**64, size=(args.updates, FINGERPRINT_WORDS), dtype=np.uint64)
+
+        baseline = None
+        for name in args.backends.split(","):
+            results, stats = bench_backend(name, ids, words, queries, extra_words, args.threshold)
+            if baseline is None:
+                baseline = results
+            stats["size"] = size
+            stats["matches_agree"] = results == baseline
+            print(json.dumps(stats))
+            report.append(stats)
+        del words, ids
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+NSFW classifier backend benchmark and accuracy-parity check. A fixed frame
+set (sampled from --video, read from --images, or generated from ffmpeg's
+lavfi test sources) is classified by each NSFW_BACKEND in its own process.
+Reports load time, frames/sec, peak RSS, and label agreement and max
+probability difference against the fp32 "torch" backend. Exits non-zero
+when a backend agrees on fewer than --min-agreement of the frames.
+
+    python -m benchmarks.nsfw_backends --backends torch torch_int8 onnx --threads 4 --output nsfw_backends.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# Deterministic lavfi sources used when no frames are given
+SYNTHETIC_SOURCES = ["testsrc2", "smptehdbars", "mandelbrot", "life", "cellauto", "rgbtestsrc"]
+
+
+def synthetic_frames(count, size):
+    frames = []
+    per_source = max(1, -(-count // len(SYNTHETIC_SOURCES)))
+    for source in SYNTHETIC_SOURCES:
+        cmd = [
+            "ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"{source}=size={size}x{size}:rate=5",
+            "-frames:v", str(per_source), "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1",
+        ]
+        raw = subprocess.run(cmd, capture_output=True, check=True).stdout
+        frames.extend(np.frombuffer(raw, dtype=np.uint8).reshape(-1, size, size, 3))
+    return np.stack(frames[:count])
+
+
+def video_frames(path, count):
+    from nsfw import iter_frames
+    frames = []
+    for image in iter_frames(path):
+        frames.append(np.asarray(image))
+        if len(frames) == count:
+            break
+    return np.stack(frames)
+
+
+def image_frames(directory, count, size):
+    from PIL import Image
+    names = sorted(os.listdir(directory))[:count]
+    return np.stack([
+        np.asarray(Image.open(os.path.join(directory, name)).convert("RGB").resize((size, size)))
+        for name in names
+    ])
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(frames_path, batch_size, repeat, output_path):
+    """Child process: load the backend selected by NSFW_BACKEND and time it on the saved frames."""
+    from PIL import Image
+    import models
+    import nsfw
+
+    frames = [Image.fromarray(f) for f in np.load(frames_path)["frames"]]
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    classifier = models.get("nsfw_classifier")
+    load_s = time.perf_counter() - start
+
+    batches = [frames[i:i + batch_size] for i in range(0, len(frames), batch_size)]
+    logits = np.concatenate([classifier.logits(batch) for batch in batches])
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for batch in batches:
+            classifier.logits(batch)
+        samples.append(time.perf_counter() - start)
+    np.save(output_path, logits)
+    return {
+        "backend": classifier.backend,
+        "intra_op_threads": nsfw.NSFW_INTRA_OP_THREADS,
+        "load_s": round(load_s, 3),
+        "frames_per_s": round(len(frames) / min(samples), 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "model_rss_mb": round(peak_rss_mb() - rss_before, 1),
+        "id2label": {str(k): v for k, v in classifier.id2label.items()},
+    }
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(-1, keepdims=True))
+    return exp / exp.sum(-1, keepdims=True)
+
+
+def compare(reference, logits, id2label):
+    ref_labels, labels = reference.argmax(-1), logits.argmax(-1)
+    nsfw_ids = [int(k) for k, v in id2label.items() if v == "nsfw"]
+    return {
+        "label_agreement": round(float((ref_labels == labels).mean()), 4),
+        "nsfw_flag_agreement": round(float((np.isin(ref_labels, nsfw_ids) == np.isin(labels, nsfw_ids)).mean()), 4),
+        "max_prob_diff": round(float(np.abs(softmax(reference) - softmax(logits)).max()), 5),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "torch_int8", "onnx"])
+    parser.add_argument("--video", help="sample the frame set from this video with nsfw.iter_frames")
+    parser.add_argument("--images", help="directory of images to use as the frame set")
+    parser.add_argument("--frames", type=int, default=96, help="frames in the fixed set")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="NSFW_INTRA_OP_THREADS for every backend")
+    parser.add_argument("--min-agreement", type=float, default=0.99)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--child", nargs=3, metavar=("FRAMES", "LOGITS", "RESULT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        frames_path, logits_path, result_path = args.child
+        with open(result_path, "w") as f:
+            json.dump(run_backend(frames_path, args.batch_size, args.repeat, logits_path), f)
+        return 0
+
+    from nsfw import NSFW_INPUT_SIZE
+    if args.video:
+        frames = video_frames(args.video, args.frames)
+    elif args.images:
+        frames = image_frames(args.images, args.frames, NSFW_INPUT_SIZE)
+    else:
+        frames = synthetic_frames(args.frames, NSFW_INPUT_SIZE)
+
+    # The fp32 model is the reference, so it always runs first
+    backends = ["torch"] + [b for b in args.backends if b != "torch"]
+    results, failed = [], False
+    with tempfile.TemporaryDirectory(prefix="strmly_nsfw_bench_") as work_dir:
+        frames_path = os.path.join(work_dir, "frames.npz")
+        np.savez(frames_path, frames=frames)
+        reference = None
+        for backend in backends:
+            logits_path = os.path.join(work_dir, f"{backend}.npy")
+            result_path = os.path.join(work_dir, f"{backend}.json")
+            env = {**os.environ, "NSFW_BACKEND": backend, "NSFW_INTRA_OP_THREADS": str(args.threads)}
+            # A process per backend so load time and RSS aren't shared between them
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.nsfw_backends", "--batch-size", str(args.batch_size),
+                 "--repeat", str(args.repeat), "--child", frames_path, logits_path, result_path],
+                env=env, check=True,
+            )
+            with open(result_path) as f:
+                stats = {"frames": len(frames), "batch_size": args.batch_size, **json.load(f)}
+            logits = np.load(logits_path)
+            if reference is None:
+                reference = logits
+            stats.update(compare(reference, logits, stats.pop("id2label")))
+            if stats["label_agreement"] < args.min_agreement:
+                print(f"❌ {backend} agrees with torch on {stats['label_agreement']:.2%} of frames")
+                failed = True
+            print(json.dumps(stats))
+            if backend in args.backends:
+                results.append(stats)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Measure NSFW classifier throughput (frames/sec) at several batch sizes, both
+calling the model directly and through the shared micro-batcher with many
+concurrent videos.
+
+    python -m benchmarks.nsfw_batching --batch-sizes 1,4,8,16,32
+"""
+import argparse
+import json
+import threading
+import time
+import numpy as np
+from PIL import Image
+import nsfw
+
+
+def synthetic_frames(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 256, size=(360, 640, 3), dtype=np.uint8))
+        for _ in range(count)
+    ]
+
+
+def bench_direct(frames, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        nsfw.classify_frames(frames[i:i + batch_size])
+    return len(frames) / (time.perf_counter() - start)
+
+
+def bench_batcher(frames, batch_size, videos, max_wait_ms):
+    batcher = nsfw.NsfwBatcher(max_batch_size=batch_size, max_wait_ms=max_wait_ms)
+    per_video = len(frames) // videos
+
+    def run_video(video_frames):
+        for i in range(0, len(video_frames), batch_size):
+            batcher.classify(video_frames[i:i + batch_size])
+
+    threads = [
+        threading.Thread(target=run_video, args=(frames[v * per_video:(v + 1) * per_video],))
+        for v in range(videos)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return per_video * videos / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-sizes", default="1,4,8,16,32")
+    parser.add_argument("--frames", type=int, default=128)
+    parser.add_argument("--videos", type=int, default=8, help="concurrent callers for the batcher run")
+    parser.add_argument("--max-wait-ms", type=float, default=nsfw.NSFW_MAX_WAIT_MS)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    frames = synthetic_frames(args.frames)
+    # Warm up so the first measurement doesn't include lazy init
+    nsfw.classify_frames(frames[:2])
+
+    report = []
+    for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+        stats = {
+            "batch_size": batch_size,
+            "direct_frames_per_s": round(bench_direct(frames, batch_size), 2),
+            "batcher_frames_per_s": round(bench_batcher(frames, batch_size, args.videos, args.max_wait_ms), 2),
+            "concurrent_videos": args.videos,
+        }
+        print(json.dumps(stats))
+        report.append(stats)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+End-to-end pipeline benchmark with local stand-ins. Synthetic videos are
+generated with ffmpeg's testsrc2/sine sources and served from a moto S3
+bucket, Redis is fakeredis and MongoDB is mongomock. Measures each
+analysis, the duplicate checks and worker() throughput, and writes JSON
+that can be diffed between runs.
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.pipeline --durations 10,60 --resolutions 640x360,1280x720 --ingest-modes download,stream --output results.json
+"""
+import os
+import tempfile
+
+# Stand-in configuration, set before the worker modules read it at import time
+BENCH_DIR = tempfile.mkdtemp(prefix="strmly_bench_")
+os.environ["MEDIA_CACHE_DIR"] = os.path.join(BENCH_DIR, "media_cache")
+os.environ["AWS_S3_BUCKET"] = "strmly-bench"
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["AWS_REGION"] = "us-east-1"
+# Stage counts report the S3 bytes each analysis transferred
+os.environ.setdefault("METRICS_ENABLED", "true")
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import shutil
+import signal
+import statistics
+import subprocess
+import time
+import fakeredis
+import mongomock
+import numpy as np
+from bson import Binary, ObjectId
+from moto import mock_aws
+
+import metrics
+import s3
+from s3 import init_s3_client
+from video_fingerprint import fingerprint_video
+from audio_fingerprint import analyze_audio, fingerprint_audio
+from audio_landmarks import LandmarkIndex, landmarks_to_bytes
+from fingerprint_index import create_fingerprint_index
+from mongodb import landmark_collection
+
+
+def make_video(path, duration, resolution, fps=25):
+    """Synthetic H.264/AAC video: moving test pattern with a sine tone."""
+    cmd = [
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=duration={duration}:size={resolution}:rate={fps}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:beep_factor=4:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", path,
+    ]
+    subprocess.run(cmd, check=True)
+    return path
+
+
+def reset_media_cache():
+    """Drop the process-wide media cache so the next analysis downloads again."""
+    s3._media_cache = None
+    shutil.rmtree(os.environ["MEDIA_CACHE_DIR"], ignore_errors=True)
+
+
+def summarize(samples):
+    return {
+        "runs": len(samples),
+        "min_s": round(min(samples), 4),
+        "median_s": round(statistics.median(samples), 4),
+        "max_s": round(max(samples), 4),
+    }
+
+
+def time_call(func, args, repeat, cold_cache):
+    samples = []
+    cpu_samples = []
+    transferred = 0
+    for _ in range(repeat):
+        if cold_cache:
+            reset_media_cache()
+        # ffmpeg runs as a child process, its CPU time is the decode cost
+        cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        with metrics.capture() as record:
+            func(*args)
+        samples.append(time.perf_counter() - start)
+        cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_samples.append(cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime)
+        transferred = sum(record["counts"].get(k, 0) for k in ("s3_download_bytes", "s3_stream_bytes"))
+    # Bytes read from S3 by the last run (0 when it was served from the media cache)
+    return {**summarize(samples), "decode_cpu_median_s": round(statistics.median(cpu_samples), 4), "s3_bytes": transferred}
+
+
+def bench_analyses(s3_client, videos, repeat, cold_cache, include_nsfw, ingest_modes):
+    analyses = [
+        ("fingerprint_video", lambda key: (fingerprint_video, (key, key, s3_client))),
+        ("fingerprint_audio", lambda key: (fingerprint_audio, (key, key, s3_client))),
+        ("analyze_audio", lambda key: (analyze_audio, (key, key, s3_client))),
+    ]
+    if include_nsfw:
+        from nsfw import detect_nsfw_video
+        from full_analysis import analyze_video
+        analyses.append(("detect_nsfw_video", lambda key: (detect_nsfw_video, (key, key, s3_client))))
+        # Compare with the sum of the three separate analyses above
+        analyses.append(("full_analysis", lambda key: (analyze_video, (key, key, s3_client))))
+
+    results = []
+    for mode in ingest_modes:
+        s3.S3_INGEST_MODE = mode
+        for video in videos:
+            for name, make_call in analyses:
+                func, args = make_call(video["key"])
+                # Warm-up run pays for lazy imports and model loading
+                func(*args)
+                stats = {"analysis": name, "ingest_mode": mode, **video, **time_call(func, args, repeat, cold_cache)}
+                stats["realtime_factor"] = round(video["duration_s"] / stats["median_s"], 2)
+                stats["s3_bytes_share"] = round(stats["s3_bytes"] / video["size_bytes"], 3)
+                print(json.dumps(stats))
+                results.append(stats)
+    s3.S3_INGEST_MODE = "download"
+    return results
+
+
+def seed_catalog(collection, size, rng):
+    """LongVideo documents with random fingerprints, and their landmarks."""
+    docs = []
+    landmark_docs = []
+    for _ in range(size):
+        landmarks = np.stack([
+            rng.integers(0, 1 << 24, 300, dtype=np.uint32),
+            np.sort(rng.integers(0, 20000, 300)).astype(np.uint32),
+        ], axis=1)
+        docs.append({
+            "_id": ObjectId(),
+            "videoUrl": "catalog.mp4",
+            "fingerprint": rng.bytes(32).hex(),
+            "audio_fingerprint": rng.bytes(32).hex(),
+        })
+        landmark_docs.append({
+            "_id": docs[-1]["_id"],
+            "audio_fingerprint": docs[-1]["audio_fingerprint"],
+            "landmarks": Binary(landmarks_to_bytes(landmarks)),
+        })
+        if len(docs) == 10000:
+            collection.insert_many(docs)
+            landmark_collection(collection).insert_many(landmark_docs)
+            docs = []
+            landmark_docs = []
+    if docs:
+        collection.insert_many(docs)
+        landmark_collection(collection).insert_many(landmark_docs)
+
+
+async def bench_duplicate_checks(catalog_size, matches, repeat, rng):
+    import main
+
+    db = mongomock.MongoClient().bench
+    long_videos, copyrights = db.longvideos, db.autocopyrights
+    seed_catalog(long_videos, catalog_size, rng)
+
+    # `matches` copies of the query so every check has work to publish
+    query_hex = rng.bytes(32).hex()
+    query_landmarks = landmark_collection(long_videos).find_one()["landmarks"]
+    copies = [
+        {"_id": ObjectId(), "videoUrl": "copy.mp4", "fingerprint": query_hex, "audio_fingerprint": query_hex}
+        for _ in range(matches)
+    ]
+    long_videos.insert_many(copies)
+    landmark_collection(long_videos).insert_many([
+        {"_id": doc["_id"], "audio_fingerprint": query_hex, "landmarks": query_landmarks} for doc in copies
+    ])
+
+    start = time.perf_counter()
+    video_index = create_fingerprint_index("fingerprint")
+    audio_index = create_fingerprint_index("audio_fingerprint")
+    landmark_index = LandmarkIndex()
+    for index in (video_index, audio_index):
+        index.load(long_videos)
+    landmark_index.load(landmark_collection(long_videos))
+    load_seconds = time.perf_counter() - start
+
+    r = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    landmarks = np.frombuffer(query_landmarks, dtype="<u4").reshape(-1, 2)
+    user_id = str(ObjectId())
+    checks = {
+        "video": lambda video_id: main.check_video_fingerprint_duplicates(
+            long_videos, r, video_id, user_id, "query.mp4", query_hex, "bench_results", copyrights, video_index
+        ),
+        "audio": lambda video_id: main.check_audio_fingerprint_duplicates(
+            long_videos, r, video_id, user_id, "query.mp4", query_hex, landmarks, "bench_results",
+            copyrights, audio_index, landmark_index
+        ),
+    }
+    results = []
+    for name, make_check in checks.items():
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await make_check(str(ObjectId()))
+            samples.append(time.perf_counter() - start)
+        stats = {
+            "check": name,
+            "catalog": catalog_size + matches,
+            "matches_per_check": matches,
+            "index_load_s": round(load_seconds, 4),
+            **summarize(samples),
+        }
+        print(json.dumps(stats))
+        results.append(stats)
+    await r.aclose()
+    return results
+
+
+async def bench_worker(s3_client, videos, events, event_types):
+    """Run main.worker() against the stand-ins until `events` queued events are acked."""
+    import main
+
+    r = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    mongo = mongomock.MongoClient()
+    db = mongo.bench
+    main.init_redis = lambda: r
+    main.init_s3_client = lambda: s3_client
+    main.connect_database = lambda: (mongo, db.longvideos, db.autocopyrights, db.autonsfws)
+
+    docs = [{"_id": ObjectId(), "videoUrl": videos[i % len(videos)]["key"]} for i in range(events)]
+    db.longvideos.insert_many(docs)
+    await r.xgroup_create(main.STREAM_KEY, main.GROUP_NAME, id="0", mkstream=True)
+    for i, doc in enumerate(docs):
+        await r.xadd(main.STREAM_KEY, {
+            "type": event_types[i % len(event_types)],
+            "videoId": str(doc["_id"]),
+            "videoUrl": doc["videoUrl"],
+            "userId": str(ObjectId()),
+        })
+
+    start = time.perf_counter()
+    worker_task = asyncio.create_task(main.worker())
+    while True:
+        await asyncio.sleep(0.2)
+        if worker_task.done():
+            worker_task.result()
+        groups = await r.xinfo_groups(main.STREAM_KEY)
+        group = next(g for g in groups if g["name"] == main.GROUP_NAME)
+        if group["pending"] == 0 and group["last-delivered-id"] == (await r.xinfo_stream(main.STREAM_KEY))["last-generated-id"]:
+            break
+    elapsed = time.perf_counter() - start
+    stats = {
+        "events": events,
+        "event_types": event_types,
+        "elapsed_s": round(elapsed, 3),
+        "events_per_s": round(events / elapsed, 2),
+        "results_published": await r.xlen(main.RESULT_STREAM_KEY),
+    }
+
+    # worker() stops on SIGTERM like it would in a pod
+    os.kill(os.getpid(), signal.SIGTERM)
+    await worker_task
+    print(json.dumps(stats))
+    return stats
+
+
+def run_metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    ffmpeg = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg,
+        "args": vars(args),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="10,60", help="video durations in seconds")
+    parser.add_argument("--resolutions", default="640x360,1280x720")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm-cache", action="store_true", help="keep downloaded videos between runs")
+    parser.add_argument("--ingest-modes", default="download,stream", help="S3_INGEST_MODE values to compare")
+    parser.add_argument("--nsfw", action="store_true", help="include detect_nsfw_video (loads the ViT model)")
+    parser.add_argument("--catalog", type=int, default=10000, help="documents in the duplicate-check catalog")
+    parser.add_argument("--matches", type=int, default=50, help="duplicates each check finds")
+    parser.add_argument("--worker-events", type=int, default=40, help="events pushed through worker(), 0 to skip")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    report = {"meta": run_metadata(args)}
+    rng = np.random.default_rng(0)
+    try:
+        with mock_aws():
+            s3_client = init_s3_client()
+            s3_client.create_bucket(Bucket=os.environ["AWS_S3_BUCKET"])
+            videos = []
+            video_dir = os.path.join(BENCH_DIR, "videos")
+            os.makedirs(video_dir)
+            for duration in (int(d) for d in args.durations.split(",")):
+                for resolution in args.resolutions.split(","):
+                    key = f"bench/{resolution}_{duration}s.mp4"
+                    path = make_video(os.path.join(video_dir, os.path.basename(key)), duration, resolution)
+                    s3_client.upload_file(path, os.environ["AWS_S3_BUCKET"], key)
+                    videos.append({
+                        "key": key,
+                        "duration_s": duration,
+                        "resolution": resolution,
+                        "size_bytes": os.path.getsize(path),
+                    })
+
+            report["analyses"] = bench_analyses(
+                s3_client, videos, args.repeat, not args.warm_cache, args.nsfw, args.ingest_modes.split(",")
+            )
+            report["duplicate_checks"] = asyncio.run(bench_duplicate_checks(args.catalog, args.matches, args.repeat, rng))
+            if args.worker_events:
+                event_types = ["video_fingerprint", "audio_fingerprint"] + (["nsfw_detection", "full_analysis"] if args.nsfw else [])
+                reset_media_cache()
+                report["worker"] = asyncio.run(bench_worker(s3_client, videos, args.worker_events, event_types))
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
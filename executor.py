@@ -0,0 +1,124 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import metrics
+import models
+from s3 import get_known_head, known_head
+
+# "thread" runs analyses in asyncio.to_thread, "process" in pre-warmed process pools
+WORKER_EXECUTION_MODE = os.getenv("WORKER_EXECUTION_MODE", "thread")
+# Empty values (as in .env.example) fall back to the defaults
+FINGERPRINT_PROCESS_WORKERS = int(os.getenv("FINGERPRINT_PROCESS_WORKERS") or str(max(1, (os.cpu_count() or 2) - 1)))
+
+# Which pool handles each event type in process mode. None keeps it in a thread of the worker even then:
+# NSFW inference goes through nsfw.batcher, which only batches frames of videos analysed in the same
+# process, and a pool process runs one analysis at a time.
+EVENT_POOLS = {
+    "nsfw_detection": None,
+    "video_fingerprint": "fingerprint",
+    "audio_fingerprint": "fingerprint",
+    "full_analysis": None,
+}
+
+# Modules each pool imports up front so the first event doesn't pay for it
+POOL_WARM_MODULES = {
+    "fingerprint": ["video_fingerprint", "audio_fingerprint"],
+}
+
+# Lazily loaded entries (see models.py) each event type needs, pre-warmed for the roles a worker runs
+EVENT_MODELS = {
+    "nsfw_detection": ["nsfw_classifier"],
+    "video_fingerprint": [],
+    "audio_fingerprint": ["librosa"],
+    "full_analysis": ["nsfw_classifier", "librosa"],
+}
+
+# S3 clients can't be pickled, each pool process creates its own
+_process_s3_client = None
+
+
+def _init_pool_process(pool_name, model_names):
+    global _process_s3_client
+    # Shutdown is coordinated by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from s3 import init_s3_client
+    _process_s3_client = init_s3_client()
+    for module_name in POOL_WARM_MODULES.get(pool_name, []):
+        importlib.import_module(module_name)
+    for name in model_names:
+        models.get(name)
+
+
+def _warm_pool_process():
+    # Keep the process busy briefly so the pool spawns the next one
+    time.sleep(0.2)
+    return os.getpid()
+
+
+def _call_in_pool_process(module_name, func_name, args, head=None):
+    func = getattr(importlib.import_module(module_name), func_name)
+    # Stage metrics recorded here are sent back with the result and replayed in the worker
+    with metrics.capture() as record, known_head(*head) if head else nullcontext():
+        result = func(*args, _process_s3_client)
+    return result, record
+
+
+class AnalysisExecutor:
+    """
+    Runs the CPU-heavy analyses (fingerprint_video, fingerprint_audio,
+    detect_nsfw_video) either in threads or in per-event-type process pools.
+    The NSFW analyses stay in threads in process mode (see EVENT_POOLS).
+    Functions must take the S3 client as their last argument.
+    """
+
+    def __init__(self, mode: str = WORKER_EXECUTION_MODE, event_types=None):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Invalid WORKER_EXECUTION_MODE: {mode}")
+        self.mode = mode
+        # Only the pools (and models) these event types need are started
+        self.event_types = list(event_types or EVENT_POOLS)
+        self._pools = {}
+
+    def start(self):
+        """Create the process pools and warm every process (no-op in thread mode)."""
+        if self.mode != "process":
+            return
+        # spawn avoids forking a process that holds threads, sockets and torch state
+        context = multiprocessing.get_context("spawn")
+        sizes = {"fingerprint": FINGERPRINT_PROCESS_WORKERS}
+        for pool_name, size in sizes.items():
+            pool_events = [t for t in self.event_types if EVENT_POOLS[t] == pool_name]
+            if not pool_events:
+                continue
+            model_names = list(dict.fromkeys(name for t in pool_events for name in EVENT_MODELS[t]))
+            pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=context,
+                initializer=_init_pool_process,
+                initargs=(pool_name, model_names),
+            )
+            pids = {f.result() for f in [pool.submit(_warm_pool_process) for _ in range(size)]}
+            self._pools[pool_name] = pool
+            print(f"✅ Process pool '{pool_name}' ready with {len(pids)} warm processes")
+
+    async def run(self, event_type: str, func, *args, s3_client=None):
+        if self.mode == "thread" or EVENT_POOLS[event_type] is None:
+            return await asyncio.to_thread(func, *args, s3_client)
+        pool = self._pools[EVENT_POOLS[event_type]]
+        loop = asyncio.get_running_loop()
+        # A HEAD response the worker already has goes along, the pool process would otherwise repeat it
+        result, record = await loop.run_in_executor(
+            pool, _call_in_pool_process, func.__module__, func.__name__, args, get_known_head()
+        )
+        metrics.replay(record)
+        return result
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        self._pools = {}
@@ -0,0 +1,409 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from itertools import combinations
+import numpy as np
+from hash_math import hamming_distances, hex_to_words
+import metrics
+
+FINGERPRINT_BITS = 256
+FINGERPRINT_WORDS = FINGERPRINT_BITS // 64
+FINGERPRINT_HEX_LEN = FINGERPRINT_BITS // 4
+
+# "linear" (vectorized scan) or "mih" (multi-index hashing)
+FINGERPRINT_INDEX_BACKEND = os.getenv("FINGERPRINT_INDEX_BACKEND", "linear")
+# Number of substrings the 256-bit hash is split into for multi-index hashing
+FINGERPRINT_MIH_CHUNKS = int(os.getenv("FINGERPRINT_MIH_CHUNKS", "8"))
+
+
+def pack_fingerprint(hex_str):
+    """Pack a 256-bit hex fingerprint into 4 big-endian uint64 words, or None if it isn't one."""
+    return hex_to_words(hex_str, FINGERPRINT_BITS)
+
+
+def scan_fingerprints(collection, field: str, batch_size: int = 10000):
+    """Read every indexable fingerprint in a collection. Returns (ids, words, skipped)."""
+    cursor = collection.find(
+        {field: {"$nin": ["", None]}},
+        {"_id": 1, field: 1},
+        batch_size=batch_size,
+    )
+    ids = []
+    rows = []
+    skipped = 0
+    for doc in cursor:
+        packed = pack_fingerprint(doc.get(field))
+        if packed is None:
+            skipped += 1
+            continue
+        ids.append(str(doc["_id"]))
+        rows.append(packed)
+    words = np.vstack(rows) if rows else np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64)
+    return ids, words, skipped
+
+
+class FingerprintIndex(ABC):
+    """
+    Base class for in-memory 256-bit fingerprint indexes.
+    Subclasses implement the *_locked storage methods; this class handles
+    packing, locking and replaying writes made during a reload.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self._lock = threading.Lock()
+        # Writes made while load() is scanning Mongo, replayed after the swap
+        self._reload_log = None
+
+    def add(self, video_id: str, fingerprint_hex: str) -> bool:
+        """Insert or replace the fingerprint for a video. Returns False if it can't be indexed."""
+        packed = pack_fingerprint(fingerprint_hex)
+        if packed is None:
+            self.remove(video_id)
+            return False
+        video_id = str(video_id)
+        with self._lock:
+            self._add_locked(video_id, packed)
+            if self._reload_log is not None:
+                self._reload_log.append((video_id, packed))
+        return True
+
+    def remove(self, video_id: str):
+        """Drop a video from the index."""
+        video_id = str(video_id)
+        with self._lock:
+            self._remove_locked(video_id)
+            if self._reload_log is not None:
+                self._reload_log.append((video_id, None))
+
+    def query(self, fingerprint_hex: str, threshold: int = 5, exclude_id: str = None):
+        """
+        Return [(video_id, distance), ...] for every stored fingerprint whose
+        Hamming distance to fingerprint_hex is below threshold.
+        """
+        packed = pack_fingerprint(fingerprint_hex)
+        if packed is None or threshold <= 0:
+            return []
+        with self._lock:
+            matches = self._query_locked(packed, threshold)
+        if exclude_id is not None:
+            matches = [m for m in matches if m[0] != str(exclude_id)]
+        return matches
+
+    def bulk_load(self, ids, words):
+        """Replace the index contents with ids and their (n, 4) uint64 words."""
+        with self._lock:
+            self._reset_locked(list(ids), np.ascontiguousarray(words, dtype=np.uint64))
+            self._replay_reload_log_locked()
+
+    def load_snapshot(self, snapshot):
+        """Replace the index contents with a fingerprint_snapshot.FingerprintSnapshot's rows."""
+        with self._lock:
+            self._attach_locked(snapshot)
+            self._replay_reload_log_locked()
+
+    def export(self):
+        """Current contents as (ids, words), e.g. to write a new snapshot."""
+        with self._lock:
+            return self._export_locked()
+
+    def _replay_reload_log_locked(self):
+        if self._reload_log is not None:
+            for video_id, packed in self._reload_log:
+                if packed is None:
+                    self._remove_locked(video_id)
+                else:
+                    self._add_locked(video_id, packed)
+            self._reload_log = None
+
+    def load(self, collection, batch_size: int = 10000):
+        """(Re)build the index from every document with a non-empty fingerprint field."""
+        with self._lock:
+            self._reload_log = []
+        try:
+            with metrics.stage("mongo_scan"):
+                ids, words, skipped = scan_fingerprints(collection, self.field, batch_size)
+            metrics.count("mongo_scan", "documents", len(ids) + skipped)
+        except Exception:
+            with self._lock:
+                self._reload_log = None
+            raise
+        self.bulk_load(ids, words)
+        print(f"✅ Loaded {len(ids)} '{self.field}' fingerprints into index ({skipped} skipped)")
+        return len(ids)
+
+    @abstractmethod
+    def __len__(self):
+        """Number of indexed videos."""
+
+    @abstractmethod
+    def _add_locked(self, video_id, packed):
+        """Insert or replace one video's packed fingerprint."""
+
+    @abstractmethod
+    def _remove_locked(self, video_id):
+        """Drop a video if it is indexed."""
+
+    @abstractmethod
+    def _reset_locked(self, ids, words):
+        """Replace the whole index with ids and their (n, 4) uint64 words."""
+
+    @abstractmethod
+    def _query_locked(self, packed, threshold):
+        """[(video_id, distance), ...] for rows closer than threshold bits."""
+
+    def _attach_locked(self, snapshot):
+        # Copies the rows; backends that can query the mapped arrays in place override this
+        self._reset_locked(snapshot.id_list(), np.asarray(snapshot.words))
+
+    @abstractmethod
+    def _export_locked(self):
+        """(ids, words) of every live row."""
+
+
+class LinearFingerprintIndex(FingerprintIndex):
+    """
+    Packed uint64 rows, queried with a vectorized XOR + popcount over every row.
+
+    A loaded snapshot is scanned in place from its memory map, so processes
+    sharing a snapshot share its pages. Its ids are sorted, which lets writes
+    find and hide the snapshot row they replace without a per-row dict; the
+    replacement lives in the in-memory rows like any other insert.
+    """
+
+    def __init__(self, field: str, initial_capacity: int = 1024):
+        super().__init__(field)
+        self._ids = []
+        self._rows = {}
+        self._words = np.zeros((initial_capacity, FINGERPRINT_WORDS), dtype=np.uint64)
+        self._base_ids = np.zeros(0, dtype="S24")
+        self._base_words = np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64)
+        self._base_dead = set()
+
+    def __len__(self):
+        return len(self._ids) + len(self._base_ids) - len(self._base_dead)
+
+    def _hide_base_row(self, video_id):
+        key = video_id.encode()
+        row = int(np.searchsorted(self._base_ids, key))
+        if row < len(self._base_ids) and self._base_ids[row] == key:
+            self._base_dead.add(row)
+
+    def _grow(self):
+        grown = np.zeros((self._words.shape[0] * 2, FINGERPRINT_WORDS), dtype=np.uint64)
+        grown[: len(self._ids)] = self._words[: len(self._ids)]
+        self._words = grown
+
+    def _add_locked(self, video_id, packed):
+        row = self._rows.get(video_id)
+        if row is None:
+            if len(self._ids) == self._words.shape[0]:
+                self._grow()
+            row = len(self._ids)
+            self._ids.append(video_id)
+            self._rows[video_id] = row
+            self._hide_base_row(video_id)
+        self._words[row] = packed
+
+    def _remove_locked(self, video_id):
+        self._hide_base_row(video_id)
+        # Swap the last row into the freed slot
+        row = self._rows.pop(video_id, None)
+        if row is None:
+            return
+        last = len(self._ids) - 1
+        if row != last:
+            moved_id = self._ids[last]
+            self._ids[row] = moved_id
+            self._words[row] = self._words[last]
+            self._rows[moved_id] = row
+        self._ids.pop()
+
+    def _reset_locked(self, ids, words):
+        capacity = max(len(ids), 1024)
+        self._words = np.zeros((capacity, FINGERPRINT_WORDS), dtype=np.uint64)
+        self._words[: len(ids)] = words
+        self._ids = ids
+        self._rows = {video_id: i for i, video_id in enumerate(ids)}
+        self._base_ids = np.zeros(0, dtype="S24")
+        self._base_words = np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64)
+        self._base_dead = set()
+
+    def _attach_locked(self, snapshot):
+        self._reset_locked([], np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64))
+        self._base_ids = snapshot.ids
+        self._base_words = snapshot.words
+
+    def _export_locked(self):
+        size = len(self._ids)
+        live = np.ones(len(self._base_ids), dtype=bool)
+        live[list(self._base_dead)] = False
+        ids = np.concatenate([self._base_ids[live], np.array(self._ids, dtype="S24")])
+        return ids, np.vstack([self._base_words[live], self._words[:size]])
+
+    def _query_locked(self, packed, threshold):
+        matches = []
+        if len(self._base_ids):
+            distances = hamming_distances(packed, self._base_words)
+            for i in np.nonzero(distances < threshold)[0]:
+                if i not in self._base_dead:
+                    matches.append((self._base_ids[i].decode(), int(distances[i])))
+        size = len(self._ids)
+        if size == 0:
+            return matches
+        distances = hamming_distances(packed, self._words[:size])
+        hits = np.nonzero(distances < threshold)[0]
+        return matches + [(self._ids[i], int(distances[i])) for i in hits]
+
+
+class MultiIndexHashIndex(FingerprintIndex):
+    """
+    Multi-index hashing: the 256-bit hash is split into `chunks` substrings and
+    each substring gets an exact-match table. Any fingerprint within radius r
+    has at least one substring within r // chunks bits of the query's, so only
+    those buckets are probed and the candidates verified by full distance.
+
+    Tables are sorted NumPy arrays plus a small dict delta for recent inserts,
+    merged once the delta grows. Deletes are tombstones dropped on merge.
+    """
+
+    def __init__(self, field: str, chunks: int = FINGERPRINT_MIH_CHUNKS, initial_capacity: int = 1024):
+        if chunks not in (4, 8, 16):
+            raise ValueError(f"MultiIndexHashIndex supports 4, 8 or 16 chunks, got {chunks}")
+        super().__init__(field)
+        self.chunks = chunks
+        self.chunk_bits = FINGERPRINT_BITS // chunks
+        self._chunks_per_word = 64 // self.chunk_bits
+        self._chunk_mask = np.uint64((1 << self.chunk_bits) - 1)
+        self._chunk_shifts = np.array(
+            [(self._chunks_per_word - 1 - k) * self.chunk_bits for k in range(self._chunks_per_word)],
+            dtype=np.uint64,
+        )
+        self._reset_locked([], np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64), initial_capacity)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _chunk_values(self, words):
+        """(n, 4) words -> (n, chunks) substring values."""
+        values = (words[:, :, None] >> self._chunk_shifts) & self._chunk_mask
+        return values.reshape(words.shape[0], self.chunks)
+
+    def _reset_locked(self, ids, words, initial_capacity=1024):
+        size = len(ids)
+        self._words = np.zeros((max(size, initial_capacity), FINGERPRINT_WORDS), dtype=np.uint64)
+        self._words[:size] = words
+        self._ids = list(ids)
+        self._alive = np.zeros(self._words.shape[0], dtype=bool)
+        self._alive[:size] = True
+        self._rows = {video_id: i for i, video_id in enumerate(self._ids)}
+        self._size = size
+        self._dead = 0
+        self._rebuild_tables()
+
+    def _rebuild_tables(self):
+        values = self._chunk_values(self._words[: self._size])
+        self._sorted_keys = []
+        self._sorted_rows = []
+        for j in range(self.chunks):
+            order = np.argsort(values[:, j], kind="stable")
+            self._sorted_keys.append(values[order, j])
+            self._sorted_rows.append(order.astype(np.int64))
+        self._indexed_upto = self._size
+        self._delta = [{} for _ in range(self.chunks)]
+
+    def _export_locked(self):
+        live = np.nonzero(self._alive[: self._size])[0]
+        return [self._ids[i] for i in live], self._words[live]
+
+    def _compact_and_rebuild(self):
+        live = np.nonzero(self._alive[: self._size])[0]
+        ids = [self._ids[i] for i in live]
+        self._reset_locked(ids, self._words[live], self._words.shape[0])
+
+    def _add_locked(self, video_id, packed):
+        if video_id in self._rows:
+            self._remove_locked(video_id)
+        if self._size == self._words.shape[0]:
+            capacity = self._words.shape[0] * 2
+            grown = np.zeros((capacity, FINGERPRINT_WORDS), dtype=np.uint64)
+            grown[: self._size] = self._words[: self._size]
+            self._words = grown
+            alive = np.zeros(capacity, dtype=bool)
+            alive[: self._size] = self._alive[: self._size]
+            self._alive = alive
+        row = self._size
+        self._words[row] = packed
+        self._alive[row] = True
+        self._ids.append(video_id)
+        self._rows[video_id] = row
+        self._size += 1
+        for j, value in enumerate(self._chunk_values(packed[None, :])[0]):
+            self._delta[j].setdefault(int(value), []).append(row)
+        pending = self._size - self._indexed_upto
+        if pending > max(4096, self._indexed_upto // 8):
+            self._compact_and_rebuild()
+
+    def _remove_locked(self, video_id):
+        row = self._rows.pop(video_id, None)
+        if row is None:
+            return
+        self._alive[row] = False
+        self._dead += 1
+        if self._dead > max(4096, self._size // 4):
+            self._compact_and_rebuild()
+
+    def _probe_values(self, value, radius):
+        """Yield every chunk value within `radius` bits of value."""
+        yield value
+        for r in range(1, radius + 1):
+            for bits in combinations(range(self.chunk_bits), r):
+                flipped = value
+                for b in bits:
+                    flipped ^= 1 << b
+                yield flipped
+
+    def _query_locked(self, packed, threshold):
+        if self._size == 0:
+            return []
+        # dist < threshold means at most threshold - 1 differing bits
+        chunk_radius = (threshold - 1) // self.chunks
+        query_values = self._chunk_values(packed[None, :])[0]
+        candidates = []
+        for j in range(self.chunks):
+            keys = self._sorted_keys[j]
+            rows = self._sorted_rows[j]
+            delta = self._delta[j]
+            for value in self._probe_values(int(query_values[j]), chunk_radius):
+                key = np.uint64(value)
+                lo = np.searchsorted(keys, key, side="left")
+                hi = np.searchsorted(keys, key, side="right")
+                if hi > lo:
+                    candidates.append(rows[lo:hi])
+                if value in delta:
+                    candidates.append(np.asarray(delta[value], dtype=np.int64))
+        if not candidates:
+            return []
+        rows = np.unique(np.concatenate(candidates))
+        rows = rows[self._alive[rows]]
+        if rows.size == 0:
+            return []
+        distances = hamming_distances(packed, self._words[rows])
+        hits = np.nonzero(distances < threshold)[0]
+        return [(self._ids[rows[i]], int(distances[i])) for i in hits]
+
+
+FINGERPRINT_INDEX_BACKENDS = {
+    "linear": LinearFingerprintIndex,
+    "mih": MultiIndexHashIndex,
+}
+
+
+def create_fingerprint_index(field: str, backend: str = None) -> FingerprintIndex:
+    """Create a fingerprint index using the configured search backend."""
+    backend = backend or FINGERPRINT_INDEX_BACKEND
+    try:
+        index_cls = FINGERPRINT_INDEX_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"❌ Unknown FINGERPRINT_INDEX_BACKEND: {backend}")
+    return index_cls(field)
@@ -0,0 +1,340 @@
+"""
+Sharded fingerprint index. Video ids are hashed into a fixed number of
+partitions and each partition is owned by one shard process, chosen by
+rendezvous hashing over the shards currently heartbeating in Redis, so
+every node derives the same assignment and adding a shard moves only the
+partitions it wins. Workers send each query to every live shard's request
+list and gather the replies until every partition has answered or the
+deadline passes.
+
+    python -m fingerprint_shard --shard-id shard-a
+"""
+import argparse
+import hashlib
+import json
+import os
+import signal
+import socket
+import time
+import uuid
+from dotenv import load_dotenv
+
+# Before the project imports: run as a CLI, this module is the first to read the settings
+load_dotenv()
+
+from fingerprint_index import create_fingerprint_index, pack_fingerprint
+from fingerprint_snapshot import FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS, datetime_to_ms, latest_update_ms, ms_to_datetime, updated_field
+import metrics
+
+# Query shard processes over Redis instead of holding the fingerprint indexes in every worker
+FINGERPRINT_SHARDS_ENABLED = os.getenv("FINGERPRINT_SHARDS_ENABLED", "false").lower() in ("1", "true", "yes")
+# Redis key prefix for the shard membership set and the request/reply lists
+FINGERPRINT_SHARD_PREFIX = os.getenv("FINGERPRINT_SHARD_PREFIX", "fingerprint_shards")
+# Hash partitions of _id; shards own whole partitions. Every shard and worker must agree on it.
+FINGERPRINT_SHARD_PARTITIONS = int(os.getenv("FINGERPRINT_SHARD_PARTITIONS", "256"))
+FINGERPRINT_SHARD_FIELDS = [
+    f.strip() for f in os.getenv("FINGERPRINT_SHARD_FIELDS", "fingerprint,audio_fingerprint").split(",") if f.strip()
+]
+FINGERPRINT_SHARD_HEARTBEAT_SECONDS = float(os.getenv("FINGERPRINT_SHARD_HEARTBEAT_SECONDS", "2"))
+# A shard without a heartbeat for this long is dropped and its partitions reassigned
+FINGERPRINT_SHARD_TTL_SECONDS = float(os.getenv("FINGERPRINT_SHARD_TTL_SECONDS", "10"))
+# Partitions a shard loses to a new member are still served this long, so queries see no gap
+FINGERPRINT_SHARD_HANDOFF_SECONDS = float(os.getenv("FINGERPRINT_SHARD_HANDOFF_SECONDS", "30"))
+# How often shards poll Mongo for fingerprints written by workers they didn't hear from
+FINGERPRINT_SHARD_SYNC_SECONDS = float(os.getenv("FINGERPRINT_SHARD_SYNC_SECONDS", "5"))
+# Deadline for every partition to answer a query
+FINGERPRINT_SHARD_QUERY_TIMEOUT_SECONDS = float(os.getenv("FINGERPRINT_SHARD_QUERY_TIMEOUT_SECONDS", "2"))
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+def partition_of(video_id: str) -> int:
+    return _hash64(str(video_id)) % FINGERPRINT_SHARD_PARTITIONS
+
+
+def owner_of(partition: int, members) -> str:
+    """Rendezvous hashing: the member with the highest score for the partition owns it."""
+    return max(members, key=lambda member: _hash64(f"{member}:{partition}"))
+
+
+def members_key() -> str:
+    return f"{FINGERPRINT_SHARD_PREFIX}:members"
+
+
+def requests_key(shard_id: str) -> str:
+    return f"{FINGERPRINT_SHARD_PREFIX}:requests:{shard_id}"
+
+
+def live_members(r) -> list:
+    """Shards that heartbeated within the TTL."""
+    return sorted(r.zrangebyscore(members_key(), time.time() - FINGERPRINT_SHARD_TTL_SECONDS, "+inf"))
+
+
+def scan_partitions(collection, field: str, partitions, batch_size: int = 10000) -> dict:
+    """{partition: (ids, rows)} for the documents whose _id hashes into partitions."""
+    found = {p: ([], []) for p in partitions}
+    cursor = collection.find({field: {"$nin": ["", None]}}, {"_id": 1, field: 1}, batch_size=batch_size)
+    for doc in cursor:
+        video_id = str(doc["_id"])
+        rows = found.get(partition_of(video_id))
+        if rows is None:
+            continue
+        packed = pack_fingerprint(doc.get(field))
+        if packed is not None:
+            rows[0].append(video_id)
+            rows[1].append(packed)
+    return found
+
+
+class FingerprintShard:
+    """
+    One shard process: holds a FingerprintIndex per (field, partition) it
+    owns and answers the requests pushed to its list. Partitions are loaded
+    before the shard joins (or takes over a departed shard's partitions), and
+    ones it loses stay queryable for FINGERPRINT_SHARD_HANDOFF_SECONDS.
+    """
+
+    def __init__(self, shard_id: str, r, collection, fields=None):
+        self.shard_id = shard_id
+        self.r = r
+        self.collection = collection
+        self.fields = fields or FINGERPRINT_SHARD_FIELDS
+        # (field, partition) -> FingerprintIndex
+        self.indexes = {}
+        # partition -> when it was handed to another shard
+        self.releasing = {}
+        self.watermarks = {}
+        self._stop = False
+
+    def held_partitions(self) -> set:
+        return {partition for _, partition in self.indexes}
+
+    def rebalance(self):
+        """Load the partitions this shard now owns and drop the ones handed off long enough ago."""
+        members = set(live_members(self.r)) | {self.shard_id}
+        owned = {p for p in range(FINGERPRINT_SHARD_PARTITIONS) if owner_of(p, members) == self.shard_id}
+        held = self.held_partitions()
+        for partition in owned:
+            self.releasing.pop(partition, None)
+        now = time.time()
+        for partition in held - owned:
+            self.releasing.setdefault(partition, now)
+        expired = [p for p, since in self.releasing.items() if now - since >= FINGERPRINT_SHARD_HANDOFF_SECONDS]
+        for partition in expired:
+            del self.releasing[partition]
+            for field in self.fields:
+                self.indexes.pop((field, partition), None)
+        if expired:
+            print(f"📤 Shard {self.shard_id} released {len(expired)} partitions")
+        if owned - held:
+            self._load(owned - held)
+
+    def _load(self, partitions):
+        start = time.perf_counter()
+        loaded = 0
+        for field in self.fields:
+            # Anything written during the scan is polled again
+            self.watermarks.setdefault(field, latest_update_ms(self.collection, field))
+            with metrics.stage("mongo_scan"):
+                found = scan_partitions(self.collection, field, partitions)
+            for partition, (ids, rows) in found.items():
+                index = create_fingerprint_index(field)
+                if ids:
+                    index.bulk_load(ids, rows)
+                self.indexes[(field, partition)] = index
+                loaded += len(ids)
+        print(
+            f"📥 Shard {self.shard_id} loaded {len(partitions)} partitions ({loaded} fingerprints) "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zadd(members_key(), {self.shard_id: now})
+        pipe.zremrangebyscore(members_key(), "-inf", now - FINGERPRINT_SHARD_TTL_SECONDS)
+        pipe.execute()
+
+    def poll(self):
+        """Apply fingerprints written since the last poll to the partitions held here."""
+        for field in self.fields:
+            watermark = self.watermarks.get(field, 0)
+            since = ms_to_datetime(max(0, watermark - int(FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS * 1000)))
+            cursor = self.collection.find(
+                {updated_field(field): {"$gte": since}}, {"_id": 1, field: 1, updated_field(field): 1}
+            )
+            with metrics.stage("mongo_sync"):
+                for doc in cursor:
+                    self._apply(field, str(doc["_id"]), doc.get(field))
+                    watermark = max(watermark, datetime_to_ms(doc[updated_field(field)]))
+            self.watermarks[field] = watermark
+
+    def _apply(self, field, video_id, fingerprint_hex):
+        index = self.indexes.get((field, partition_of(video_id)))
+        if index is not None:
+            # A cleared or invalid fingerprint removes the video
+            index.add(video_id, fingerprint_hex)
+
+    def handle(self, request: dict):
+        op = request.get("op")
+        if op == "add":
+            self._apply(request["field"], request["video_id"], request.get("fingerprint"))
+        elif op == "query":
+            if time.time() > request["deadline"]:
+                return
+            field = request["field"]
+            matches = []
+            partitions = []
+            for (index_field, partition), index in self.indexes.items():
+                if index_field != field:
+                    continue
+                partitions.append(partition)
+                matches.extend(index.query(request["fingerprint"], request["threshold"], request.get("exclude_id")))
+            reply = json.dumps({"shard": self.shard_id, "partitions": partitions, "matches": matches})
+            pipe = self.r.pipeline(transaction=False)
+            pipe.rpush(request["reply_to"], reply)
+            pipe.expire(request["reply_to"], max(1, int(FINGERPRINT_SHARD_QUERY_TIMEOUT_SECONDS * 2)))
+            pipe.execute()
+        else:
+            print(f"⚠️ Shard {self.shard_id} ignored unknown request op: {op}")
+
+    def stop(self):
+        self._stop = True
+
+    def serve(self):
+        """Load, join and answer requests until stop() is called."""
+        self.rebalance()
+        self.heartbeat()
+        print(f"🧱 Shard {self.shard_id} serving {len(self.held_partitions())} partitions of {', '.join(self.fields)}")
+        next_heartbeat = time.time() + FINGERPRINT_SHARD_HEARTBEAT_SECONDS
+        next_poll = time.time() + FINGERPRINT_SHARD_SYNC_SECONDS
+        try:
+            while not self._stop:
+                item = self.r.blpop([requests_key(self.shard_id)], timeout=1)
+                if item:
+                    try:
+                        self.handle(json.loads(item[1]))
+                    except Exception as e:
+                        print(f"❌ Shard {self.shard_id} failed a request: {e}")
+                now = time.time()
+                if now >= next_heartbeat:
+                    self.heartbeat()
+                    self.rebalance()
+                    next_heartbeat = now + FINGERPRINT_SHARD_HEARTBEAT_SECONDS
+                if now >= next_poll:
+                    try:
+                        self.poll()
+                    except Exception as e:
+                        print(f"⚠️ Shard {self.shard_id} failed to poll Mongo: {e}")
+                    next_poll = now + FINGERPRINT_SHARD_SYNC_SECONDS
+        finally:
+            # The others take over at their next heartbeat
+            self.r.zrem(members_key(), self.shard_id)
+            print(f"👋 Shard {self.shard_id} left")
+
+
+class FingerprintShardsUnavailable(RuntimeError):
+    """Not every partition could be reached, so a query's result would be partial."""
+
+
+class ShardedFingerprintIndex:
+    """
+    FingerprintIndex stand-in for workers: add/remove go to the partition's
+    owner, query fans out to every live shard. Blocking, like the local
+    index, so callers keep running it in a thread.
+    """
+
+    def __init__(self, field: str, r, timeout: float = FINGERPRINT_SHARD_QUERY_TIMEOUT_SECONDS):
+        self.field = field
+        self.r = r
+        self.timeout = timeout
+
+    def _members(self):
+        members = live_members(self.r)
+        if not members:
+            raise FingerprintShardsUnavailable(f"❌ No live fingerprint shards for '{self.field}'")
+        return members
+
+    def add(self, video_id: str, fingerprint_hex: str) -> bool:
+        """Send the write to the partition's owner; shards polling Mongo catch any that are lost."""
+        video_id = str(video_id)
+        owner = owner_of(partition_of(video_id), self._members())
+        self.r.rpush(requests_key(owner), json.dumps({
+            "op": "add", "field": self.field, "video_id": video_id, "fingerprint": fingerprint_hex,
+        }))
+        return pack_fingerprint(fingerprint_hex) is not None
+
+    def remove(self, video_id: str):
+        self.add(video_id, None)
+
+    def query(self, fingerprint_hex: str, threshold: int = 5, exclude_id: str = None):
+        """
+        Same result as FingerprintIndex.query, gathered from the shards.
+        Raises FingerprintShardsUnavailable if some partitions didn't answer before the deadline.
+        """
+        if pack_fingerprint(fingerprint_hex) is None or threshold <= 0:
+            return []
+        members = self._members()
+        reply_to = f"{FINGERPRINT_SHARD_PREFIX}:replies:{uuid.uuid4().hex}"
+        deadline = time.time() + self.timeout
+        request = json.dumps({
+            "op": "query", "field": self.field, "fingerprint": fingerprint_hex, "threshold": threshold,
+            "exclude_id": None if exclude_id is None else str(exclude_id), "reply_to": reply_to, "deadline": deadline,
+        })
+        pipe = self.r.pipeline(transaction=False)
+        for member in members:
+            pipe.rpush(requests_key(member), request)
+        pipe.execute()
+
+        covered = set()
+        best = {}
+        replies = 0
+        try:
+            while len(covered) < FINGERPRINT_SHARD_PARTITIONS and replies < len(members):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                item = self.r.blpop([reply_to], timeout=remaining)
+                if item is None:
+                    break
+                reply = json.loads(item[1])
+                replies += 1
+                covered.update(reply["partitions"])
+                # A partition mid-handoff answers from both shards
+                for video_id, distance in reply["matches"]:
+                    best[video_id] = min(distance, best.get(video_id, distance))
+        finally:
+            self.r.delete(reply_to)
+        metrics.count("shard_query", "replies", replies)
+        if len(covered) < FINGERPRINT_SHARD_PARTITIONS:
+            raise FingerprintShardsUnavailable(
+                f"❌ Fingerprint shards answered for {len(covered)}/{FINGERPRINT_SHARD_PARTITIONS} "
+                f"'{self.field}' partitions within {self.timeout}s"
+            )
+        return list(best.items())
+
+
+def main():
+    from mongodb import connect_database
+    from redis_client import init_sync_redis
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shard-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    args = parser.parse_args()
+
+    client, long_video_collection, _, _ = connect_database()
+    r = init_sync_redis()
+    shard = FingerprintShard(args.shard_id, r, long_video_collection)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: shard.stop())
+    try:
+        shard.serve()
+    finally:
+        r.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import fcntl
+import os
+import struct
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from fingerprint_index import FINGERPRINT_WORDS, scan_fingerprints
+import metrics
+
+# Where snapshots are kept; workers on one host share them. Unset disables snapshots (full reloads instead).
+FINGERPRINT_SNAPSHOT_DIR = os.getenv("FINGERPRINT_SNAPSHOT_DIR", "")
+# How often fingerprints written since the snapshot's watermark are polled from Mongo
+FINGERPRINT_SNAPSHOT_SYNC_SECONDS = float(os.getenv("FINGERPRINT_SNAPSHOT_SYNC_SECONDS", "30"))
+# Each poll looks this far behind the watermark, for writes that committed out of timestamp order
+FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS = float(os.getenv("FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS", "60"))
+# Rows added since the snapshot before one worker writes a new one
+FINGERPRINT_SNAPSHOT_COMPACT_ROWS = int(os.getenv("FINGERPRINT_SNAPSHOT_COMPACT_ROWS", "10000"))
+# Age after which the snapshot is rebuilt with a full scan, which also drops deleted videos
+FINGERPRINT_SNAPSHOT_REBUILD_SECONDS = float(os.getenv("FINGERPRINT_SNAPSHOT_REBUILD_SECONDS", "86400"))
+
+SNAPSHOT_MAGIC = b"STRMFPS1"
+# magic, row count, watermark (ms since epoch, Mongo time), built at (unix seconds); padded so the words stay aligned
+_HEADER = struct.Struct("<8sQqd")
+HEADER_BYTES = 64
+ID_BYTES = 24
+_EPOCH = datetime(1970, 1, 1)
+
+
+def updated_field(field: str) -> str:
+    """Document field holding when `field` was last written ($currentDate), polled by the sync."""
+    return f"{field}_updated_at"
+
+
+def datetime_to_ms(value) -> int:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
+def ms_to_datetime(ms: int) -> datetime:
+    return _EPOCH + timedelta(milliseconds=ms)
+
+
+class FingerprintSnapshot:
+    """
+    A read-only memory map of a snapshot file: `words` is (n, 4) uint64 and
+    `ids` the n video ids as 24-byte strings, sorted. Every process that
+    opens the same file shares its pages through the page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, count, self.watermark_ms, self.built_at = _HEADER.unpack(f.read(_HEADER.size))
+            stat = os.fstat(f.fileno())
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"❌ {path} is not a fingerprint snapshot")
+        self.inode = stat.st_ino
+        if count:
+            self.words = np.memmap(path, dtype=np.uint64, mode="r", offset=HEADER_BYTES, shape=(count, FINGERPRINT_WORDS))
+            self.ids = np.memmap(path, dtype=f"S{ID_BYTES}", mode="r", offset=HEADER_BYTES + self.words.nbytes, shape=(count,))
+        else:
+            self.words = np.zeros((0, FINGERPRINT_WORDS), dtype=np.uint64)
+            self.ids = np.zeros(0, dtype=f"S{ID_BYTES}")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id_list(self):
+        return [video_id.decode() for video_id in self.ids]
+
+    def replaced(self) -> bool:
+        """True once another process has written a newer file at this path."""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+
+def snapshot_ids(ids) -> np.ndarray:
+    """Video ids as the fixed-width strings snapshots store."""
+    ids = np.asarray(ids, dtype=f"S{ID_BYTES}")
+    if len(ids) and max(len(video_id) for video_id in ids.tolist()) > ID_BYTES:
+        raise ValueError(f"❌ Snapshot ids must be at most {ID_BYTES} bytes")
+    return ids
+
+
+def write_atomic(path: str, chunks):
+    """Write the byte chunks to path through a temporary file, so readers see the old or the new file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_snapshot(path: str, ids, words, watermark_ms: int):
+    """Write ids and their words as a snapshot, sorted by id. The file is replaced atomically."""
+    ids = snapshot_ids(ids)
+    order = np.argsort(ids, kind="stable")
+    words = np.ascontiguousarray(np.asarray(words, dtype=np.uint64)[order])
+    header = _HEADER.pack(SNAPSHOT_MAGIC, len(ids), watermark_ms, time.time()).ljust(HEADER_BYTES, b"\0")
+    write_atomic(path, [header, words.tobytes(), ids[order].tobytes()])
+
+
+@contextmanager
+def _file_lock(path: str, blocking: bool = True):
+    """Host-wide lock on a snapshot path. Yields False when non-blocking and held elsewhere."""
+    with open(f"{path}.lock", "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def latest_update_ms(collection, field: str) -> int:
+    """Newest `field` write time in the collection, 0 if nothing has one yet."""
+    doc = collection.find_one(
+        {updated_field(field): {"$exists": True}}, {updated_field(field): 1}, sort=[(updated_field(field), -1)]
+    )
+    return datetime_to_ms(doc[updated_field(field)]) if doc else 0
+
+
+def build_snapshot(collection, field: str, path: str) -> FingerprintSnapshot:
+    """Full scan of the collection into a new snapshot file."""
+    # Taken before the scan, so anything written during it is polled again by the first sync
+    watermark_ms = latest_update_ms(collection, field)
+    with metrics.stage("mongo_scan"):
+        ids, words, skipped = scan_fingerprints(collection, field)
+    metrics.count("mongo_scan", "documents", len(ids) + skipped)
+    write_snapshot(path, ids, words, watermark_ms)
+    print(f"💾 Wrote '{field}' snapshot with {len(ids)} fingerprints ({skipped} skipped) to {path}")
+    return FingerprintSnapshot(path)
+
+
+class SnapshotSync:
+    """
+    Keeps a FingerprintIndex current from a shared on-disk snapshot plus
+    Mongo. Startup maps the snapshot (building it once per host if it's
+    missing) and polls only the fingerprints written after its watermark,
+    so it doesn't scan the whole collection. Later syncs poll again; once
+    enough rows have accumulated, or the snapshot is old, one worker on the
+    host writes a new snapshot and the others switch to it on their next
+    sync. Subclasses override the _open/_build/_write_export/_apply hooks
+    to keep another kind of index the same way.
+    """
+
+    # Snapshot file extension
+    suffix = "fps"
+    # Rows added since the snapshot before one worker writes a new one
+    compact_rows = FINGERPRINT_SNAPSHOT_COMPACT_ROWS
+
+    def __init__(self, collection, index, directory: str = None):
+        self.collection = collection
+        self.index = index
+        self.field = index.field
+        directory = directory or FINGERPRINT_SNAPSHOT_DIR
+        if not directory:
+            raise ValueError("❌ FINGERPRINT_SNAPSHOT_DIR is not set")
+        os.makedirs(directory, exist_ok=True)
+        name = f"{collection.database.name}.{collection.name}.{self.field}.{self.suffix}"
+        self.path = os.path.join(directory, name)
+        self.snapshot = None
+        self.watermark_ms = 0
+        # Polled rows written after the attached snapshot's watermark
+        self.synced_rows = 0
+        # video_id -> write time of rows applied within the overlap window, which every poll reads again
+        self._recent = {}
+
+    def start(self):
+        """Attach the host's snapshot, building it first if no worker has, then catch up from Mongo."""
+        start = time.perf_counter()
+        with _file_lock(self.path):
+            if os.path.exists(self.path):
+                snapshot = self._open()
+            else:
+                snapshot = self._build()
+        self._attach(snapshot)
+        synced = self.poll()
+        print(
+            f"✅ Mapped {len(snapshot)} '{self.field}' videos from {self.path} "
+            f"and synced {synced} newer in {time.perf_counter() - start:.2f}s"
+        )
+        return len(self.index)
+
+    def _attach(self, snapshot):
+        self.index.load_snapshot(snapshot)
+        self.snapshot = snapshot
+        self.watermark_ms = snapshot.watermark_ms
+        self.synced_rows = 0
+        self._recent = {}
+
+    def _open(self):
+        return FingerprintSnapshot(self.path)
+
+    def _build(self):
+        return build_snapshot(self.collection, self.field, self.path)
+
+    def _write_export(self, watermark_ms: int):
+        """Write the index's current contents as the new snapshot."""
+        ids, words = self.index.export()
+        write_snapshot(self.path, ids, words, watermark_ms)
+        return FingerprintSnapshot(self.path)
+
+    def _apply(self, video_id: str, updated_ms: int, value) -> bool:
+        """Apply one polled row to the index. Returns False if an earlier poll already did."""
+        if self._recent.get(video_id) == updated_ms:
+            # Already applied by an earlier poll of the overlap window
+            return False
+        self._recent[video_id] = updated_ms
+        # A cleared or invalid fingerprint removes the video
+        self.index.add(video_id, value)
+        return True
+
+    def _forget(self, cutoff_ms: int):
+        """Drop rows older than the next poll's window from the applied ones."""
+        self._recent = {k: v for k, v in self._recent.items() if v >= cutoff_ms}
+
+    def poll(self, batch_size: int = 10000) -> int:
+        """Apply fingerprints written since the watermark to the index. Returns how many were applied."""
+        overlap_ms = int(FINGERPRINT_SNAPSHOT_SYNC_OVERLAP_SECONDS * 1000)
+        since = ms_to_datetime(max(0, self.watermark_ms - overlap_ms))
+        cursor = self.collection.find(
+            {updated_field(self.field): {"$gte": since}},
+            {"_id": 1, self.field: 1, updated_field(self.field): 1},
+            batch_size=batch_size,
+        )
+        applied = 0
+        with metrics.stage("mongo_sync"):
+            for doc in cursor:
+                video_id = str(doc["_id"])
+                updated_ms = datetime_to_ms(doc[updated_field(self.field)])
+                self.watermark_ms = max(self.watermark_ms, updated_ms)
+                if not self._apply(video_id, updated_ms, doc.get(self.field)):
+                    continue
+                if updated_ms > self.snapshot.watermark_ms:
+                    self.synced_rows += 1
+                applied += 1
+        self._forget(self.watermark_ms - overlap_ms)
+        metrics.count("mongo_sync", "documents", applied)
+        return applied
+
+    def sync(self):
+        """Poll Mongo, switching to a newer snapshot first if another worker wrote one, and compact when due."""
+        if self.snapshot.replaced():
+            self._attach(self._open())
+        self.poll()
+        if time.time() - self.snapshot.built_at >= FINGERPRINT_SNAPSHOT_REBUILD_SECONDS:
+            self._write(rebuild=True)
+        elif self.synced_rows >= self.compact_rows:
+            self._write(rebuild=False)
+
+    def _write(self, rebuild: bool):
+        """Write a new snapshot unless another worker on the host is already writing one."""
+        with _file_lock(self.path, blocking=False) as locked:
+            if not locked or self.snapshot.replaced():
+                return
+            if rebuild:
+                snapshot = self._build()
+            else:
+                # The index already holds the snapshot plus everything polled up to the watermark
+                snapshot = self._write_export(self.watermark_ms)
+                print(f"💾 Compacted {len(snapshot)} '{self.field}' videos into {self.path}")
+        self._attach(snapshot)
+        self.poll()
@@ -0,0 +1,219 @@
+import contextvars
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import numpy as np
+from PIL import Image
+import metrics
+from s3 import open_media
+from video_fingerprint import (
+    FINGERPRINT_FRAME_SOURCE, PHASH_IMAGE_SIZE, VIDEO_FINGERPRINT_RESULT_VERSION, bitwise_avg_hashes, cleanup,
+    ffmpeg_probe, generate_phash, generate_phash_from_frames,
+)
+from nsfw import NSFW_INPUT_SIZE, NSFW_RESULT_VERSION, NSFW_SAMPLE_INTERVAL_SECONDS, nsfw_detection, sample_frames, sampling_filter
+from audio_fingerprint import (
+    AUDIO_CHUNK_SECONDS, AUDIO_FINGERPRINT_RESULT_VERSION, AUDIO_FINGERPRINT_SAMPLE_RATE, WAV_OUTPUT_ARGS,
+    generate_audio_fingerprint, mfcc_fingerprint,
+)
+from audio_landmarks import LANDMARK_RESULT_VERSION, LANDMARK_SAMPLE_RATE, extract_landmarks
+
+# Frames (at 1 fps) hashed into the video fingerprint, as in video_fingerprint.iter_gray_frames
+PHASH_MAX_FRAMES = 100
+PIPE_READ_BYTES = 1 << 16
+# Part of the result cache key: bump the leading number when the single pass changes a result
+FULL_ANALYSIS_RESULT_VERSION = (
+    f"1:{VIDEO_FINGERPRINT_RESULT_VERSION}:{NSFW_RESULT_VERSION}:{AUDIO_FINGERPRINT_RESULT_VERSION}:{LANDMARK_RESULT_VERSION}"
+)
+
+
+def _iter_frames(stream, frame_shape):
+    frame_bytes = int(np.prod(frame_shape))
+    while True:
+        buf = stream.read(frame_bytes)
+        if len(buf) < frame_bytes:
+            return
+        yield np.frombuffer(buf, dtype=np.uint8).reshape(frame_shape)
+
+
+def _iter_samples(stream, sample_rate):
+    chunk_bytes = int(sample_rate * AUDIO_CHUNK_SECONDS) * 4
+    while True:
+        buf = stream.read(chunk_bytes)
+        if buf:
+            yield np.frombuffer(buf[:len(buf) - len(buf) % 4], dtype="<f4")
+        if len(buf) < chunk_bytes:
+            return
+
+
+def _video_fingerprint(stream):
+    p_hashes = generate_phash_from_frames(_iter_frames(stream, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE)))
+    if not p_hashes:
+        raise RuntimeError("No video frames decoded")
+    return bitwise_avg_hashes(p_hashes)
+
+
+class _NsfwConsumer:
+    def __init__(self):
+        self.frames = 0
+
+    def _images(self, stream):
+        for frame in _iter_frames(stream, (NSFW_INPUT_SIZE, NSFW_INPUT_SIZE, 3)):
+            self.frames += 1
+            yield Image.fromarray(frame)
+
+    def __call__(self, stream):
+        return nsfw_detection(self._images(stream))
+
+
+def _consume(stream, consumer):
+    """Run consumer on a pipe, then drain what it didn't read (early NSFW exit, landmark cap) so ffmpeg never blocks on it."""
+    try:
+        return consumer(stream)
+    finally:
+        while stream.read(PIPE_READ_BYTES):
+            pass
+        stream.close()
+
+
+def run_single_pass(video_path: str, output_dir: str) -> dict:
+    """
+    Run every analysis from one ffmpeg process. The file is opened twice:
+    the first input is fully decoded for its first PHASH_MAX_FRAMES seconds
+    (the 1 fps pHash frames), the second decodes keyframes only for the
+    sampled NSFW frames and decodes the audio once for both the landmarks
+    and the MFCC fingerprint. Each output is a pipe read by its own thread,
+    so the analyzers run concurrently with the decode. Unless
+    FINGERPRINT_FRAME_SOURCE is "pipe", the pHash frames are written as the
+    same JPEGs fingerprint_video writes and hashed once ffmpeg exits, so the
+    fingerprint matches it. Returns the results and, per analysis, the
+    error that prevented one. A video without audio has no audio
+    fingerprint or landmarks and no error for them.
+    """
+    duration, with_audio = ffmpeg_probe(video_path)
+    pipe_fingerprint = FINGERPRINT_FRAME_SOURCE == "pipe"
+    phash_filter = f"fps=1,scale={PHASH_IMAGE_SIZE}:{PHASH_IMAGE_SIZE}:flags=lanczos,format=gray" if pipe_fingerprint else "fps=1"
+    filter_graph = (
+        f"[0:v:0]{phash_filter}[phash];"
+        f"[1:v:0]{sampling_filter()},scale={NSFW_INPUT_SIZE}:{NSFW_INPUT_SIZE},format=rgb24[nsfw]"
+    )
+    nsfw_consumer = _NsfwConsumer()
+    # (name, output options, consumer) for each piped output
+    outputs = [
+        ("nsfw_detection", ["-map", "[nsfw]", "-vsync", "0", "-f", "rawvideo", "-pix_fmt", "rgb24"], nsfw_consumer),
+    ]
+    if pipe_fingerprint:
+        outputs.insert(0, ("video_fingerprint", ["-map", "[phash]", "-frames:v", str(PHASH_MAX_FRAMES), "-f", "rawvideo", "-pix_fmt", "gray"],
+                           _video_fingerprint))
+    wav_path = None
+    if with_audio:
+        outputs.append(("audio_landmarks", ["-map", "1:a:0", "-ac", "1", "-ar", str(LANDMARK_SAMPLE_RATE), "-f", "f32le"],
+                        lambda stream: extract_landmarks(_iter_samples(stream, LANDMARK_SAMPLE_RATE))))
+        if AUDIO_FINGERPRINT_SAMPLE_RATE:
+            sample_rate = int(AUDIO_FINGERPRINT_SAMPLE_RATE)
+            outputs.append(("audio_fingerprint", ["-map", "1:a:0", "-ac", "1", "-ar", str(sample_rate), "-f", "f32le"],
+                            lambda stream: mfcc_fingerprint(_iter_samples(stream, sample_rate), sample_rate)))
+        else:
+            # The exact-match fingerprint hashes the same WAV extract_audio would write
+            wav_path = os.path.join(output_dir, "audio.wav")
+
+    # pHash only looks at the first PHASH_MAX_FRAMES seconds, so nothing after them is decoded twice
+    cmd = ["ffmpeg", "-v", "error", "-y", "-t", str(PHASH_MAX_FRAMES), "-i", video_path]
+    cmd += ["-skip_frame", "nokey", "-i", video_path, "-filter_complex", filter_graph]
+    frames_dir = None
+    if not pipe_fingerprint:
+        # Same frames, encoder and defaults as video_fingerprint.get_frames
+        frames_dir = os.path.join(output_dir, "frames")
+        os.makedirs(frames_dir, exist_ok=True)
+        cmd += ["-map", "[phash]", "-frames:v", str(PHASH_MAX_FRAMES), os.path.join(frames_dir, "frame_%04d.jpg")]
+    pipes = {}
+    try:
+        for name, options, _ in outputs:
+            read_fd, write_fd = os.pipe()
+            pipes[name] = (read_fd, write_fd)
+            # ffmpeg writes this output straight to the inherited descriptor
+            cmd += options + [f"pipe:{write_fd}"]
+        if wav_path:
+            cmd += ["-map", "1:a:0", *WAV_OUTPUT_ARGS, wav_path]
+
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            pass_fds=[write_fd for _, write_fd in pipes.values()],
+        )
+    except BaseException:
+        for read_fd, write_fd in pipes.values():
+            os.close(read_fd)
+            os.close(write_fd)
+        raise
+    # Only ffmpeg holds the write ends now, so readers see EOF when it exits
+    for _, write_fd in pipes.values():
+        os.close(write_fd)
+
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=len(outputs) + 2, thread_name_prefix="full-analysis") as pool:
+        futures = {
+            # Each thread records its stages into the current message's timings
+            name: pool.submit(contextvars.copy_context().run, _consume, os.fdopen(pipes[name][0], "rb"), consumer)
+            for name, _, consumer in outputs
+        }
+        stderr_future = pool.submit(proc.stderr.read)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = f"{type(e).__name__}: {e}"
+        stderr = stderr_future.result()
+    returncode = proc.wait()
+    proc.stderr.close()
+    metrics.record_stage("ffmpeg_decode_full", time.perf_counter() - start)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+    if frames_dir:
+        try:
+            files = [os.path.join(frames_dir, name) for name in os.listdir(frames_dir) if name.endswith(".jpg")]
+            if not files:
+                raise RuntimeError("No video frames decoded")
+            results["video_fingerprint"] = bitwise_avg_hashes(generate_phash(files))
+        except Exception as e:
+            errors["video_fingerprint"] = f"{type(e).__name__}: {e}"
+
+    if results.get("nsfw_detection") is False and nsfw_consumer.frames < duration // NSFW_SAMPLE_INTERVAL_SECONDS / 2:
+        # Too few keyframes for the sample interval, same fallback as nsfw.iter_frames
+        try:
+            with closing(sample_frames(video_path)) as frames:
+                results["nsfw_detection"] = nsfw_detection(frames)
+        except Exception as e:
+            errors["nsfw_detection"] = f"{type(e).__name__}: {e}"
+
+    if wav_path:
+        try:
+            results["audio_fingerprint"] = generate_audio_fingerprint(wav_path)
+        except Exception as e:
+            errors["audio_fingerprint"] = f"{type(e).__name__}: {e}"
+    # Without an audio stream the audio results are None, not an error: there is nothing to fingerprint
+    if "audio_landmarks" in errors:
+        errors["audio_fingerprint"] = errors.pop("audio_landmarks")
+    return {
+        "fingerprint": results.get("video_fingerprint"),
+        "is_nsfw": results.get("nsfw_detection"),
+        "audio_fingerprint": results.get("audio_fingerprint") if "audio_fingerprint" not in errors else None,
+        "landmarks": results.get("audio_landmarks") if "audio_fingerprint" not in errors else None,
+        "errors": errors,
+    }
+
+
+def analyze_video(video_url, video_id, s3_client):
+    """
+    Video fingerprint, NSFW flag, audio fingerprint and audio landmarks from
+    one decode of the upload. See run_single_pass for the returned dict.
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        with open_media(video_url, s3_client, "full_analysis") as input_file_path:
+            return run_single_pass(input_file_path, output_dir)
+    finally:
+        cleanup(output_dir)
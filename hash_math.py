@@ -0,0 +1,65 @@
+import numpy as np
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hex_to_bits(hex_str: str) -> np.ndarray:
+    """Hex string -> uint8 array of 0/1, 4 bits per hex character (same order as hex_to_binary)."""
+    padded = hex_str if len(hex_str) % 2 == 0 else "0" + hex_str
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex(padded), dtype=np.uint8))
+    return bits[len(padded) * 4 - len(hex_str) * 4:]
+
+
+def bits_to_hex(bits: np.ndarray) -> str:
+    """uint8 array of 0/1 -> hex string, 4 bits per character."""
+    pad = (-len(bits)) % 8
+    packed = np.packbits(np.concatenate([np.zeros(pad, dtype=np.uint8), bits.astype(np.uint8)]))
+    return packed.tobytes().hex()[pad // 4:]
+
+
+def hex_to_words(hex_str: str, bits: int = 256):
+    """Pack a `bits`-wide hex hash into big-endian uint64 words, or None if it isn't one."""
+    if not hex_str or len(hex_str) != bits // 4:
+        return None
+    try:
+        raw = int(hex_str, 16).to_bytes(bits // 8, "big")
+    except ValueError:
+        return None
+    return np.frombuffer(raw, dtype=">u8").astype(np.uint64)
+
+
+def words_to_hex(words) -> str:
+    return "".join(f"{int(w):016x}" for w in words)
+
+
+def popcount64(words):
+    """Count set bits per element of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.uint16)
+
+
+def majority_vote_hex(hashes) -> str:
+    """
+    Bitwise majority vote over equal-length hex hashes: a bit is set when it is
+    set in more than half of them. Same output as the old string-based loop.
+    """
+    bit_matrix = np.vstack([hex_to_bits(h) for h in hashes])
+    bit_sums = bit_matrix.sum(axis=0, dtype=np.int64)
+    return bits_to_hex((bit_sums > len(hashes) / 2).astype(np.uint8))
+
+
+def hamming_distance(hex1: str, hex2: str):
+    """Hamming distance between two hex hashes, or None if either is empty or not hex or their lengths differ."""
+    if not hex1 or not hex2 or len(hex1) != len(hex2):
+        return None
+    try:
+        return bin(int(hex1, 16) ^ int(hex2, 16)).count("1")
+    except (TypeError, ValueError):
+        return None
+
+
+def hamming_distances(packed, rows) -> np.ndarray:
+    """Distances from one hash packed by hex_to_words to each row of an (n, words) uint64 array."""
+    return popcount64(rows ^ packed).sum(axis=1, dtype=np.int64)
@@ -0,0 +1,95 @@
+import os
+
+# Priority lanes as "name:weight[:slo_seconds]", e.g. "interactive:4:15,bulk:1:600".
+# Empty keeps one lane fed straight from the shared stream.
+WORKER_LANES = os.getenv("WORKER_LANES", "")
+# Lane per event type as "event_type=lane,..."; types not listed use the last lane
+LANE_EVENT_TYPES = os.getenv("LANE_EVENT_TYPES", "video_fingerprint=interactive,audio_fingerprint=interactive")
+# Lane per creator tier as "tier=lane,...", checked before the event type
+LANE_CREATOR_TIERS = os.getenv("LANE_CREATOR_TIERS", "")
+# Event field holding the creator tier
+LANE_TIER_FIELD = os.getenv("LANE_TIER_FIELD", "creatorTier")
+
+DEFAULT_LANE = "default"
+
+
+class Lane:
+    """A share of the worker: its weight in reads and slot grants, and the wait it should stay under."""
+
+    def __init__(self, name: str, weight: float = 1.0, slo_seconds: float = None):
+        if weight <= 0:
+            raise ValueError(f"❌ Lane '{name}' needs a positive weight")
+        self.name = name
+        self.weight = weight
+        self.slo_seconds = slo_seconds
+
+    def __repr__(self):
+        return f"Lane({self.name!r}, weight={self.weight}, slo_seconds={self.slo_seconds})"
+
+
+def parse_lanes(spec: str):
+    """Lanes from a "name:weight[:slo_seconds],..." string, in order."""
+    lanes = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, *rest = [part.strip() for part in entry.split(":")]
+        if not name or len(rest) > 2 or any(lane.name == name for lane in lanes):
+            raise ValueError(f"❌ Invalid lane '{entry.strip()}' in WORKER_LANES")
+        weight = float(rest[0]) if rest and rest[0] else 1.0
+        slo_seconds = float(rest[1]) if len(rest) > 1 and rest[1] else None
+        lanes.append(Lane(name, weight, slo_seconds))
+    return lanes
+
+
+def parse_mapping(spec: str) -> dict:
+    """{key: lane} from a "key=lane,..." string."""
+    mapping = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        key, sep, lane = entry.partition("=")
+        if not sep or not key.strip() or not lane.strip():
+            raise ValueError(f"❌ Invalid lane mapping '{entry.strip()}'")
+        mapping[key.strip()] = lane.strip()
+    return mapping
+
+
+class LanePolicy:
+    """
+    Picks the lane of an event: an explicit "lane" field naming a configured
+    lane, else its creator tier's lane, else its event type's lane, else the
+    last (lowest priority) lane.
+    """
+
+    def __init__(self, lanes, event_types: dict = None, creator_tiers: dict = None, tier_field: str = LANE_TIER_FIELD):
+        if not lanes:
+            raise ValueError("❌ At least one lane is required")
+        self.lanes = list(lanes)
+        self.by_name = {lane.name: lane for lane in self.lanes}
+        self.tier_field = tier_field
+        # Mappings to lanes this worker doesn't run are ignored, so one LANE_EVENT_TYPES fits any WORKER_LANES
+        self.event_types = {k: v for k, v in (event_types or {}).items() if v in self.by_name}
+        self.creator_tiers = {k: v for k, v in (creator_tiers or {}).items() if v in self.by_name}
+        self.default = self.lanes[-1].name
+
+    @classmethod
+    def from_env(cls):
+        """The configured lanes, or None when WORKER_LANES is empty."""
+        lanes = parse_lanes(WORKER_LANES)
+        if not lanes:
+            return None
+        return cls(lanes, parse_mapping(LANE_EVENT_TYPES), parse_mapping(LANE_CREATOR_TIERS))
+
+    @property
+    def names(self):
+        return [lane.name for lane in self.lanes]
+
+    def lane_for(self, event: dict) -> str:
+        lane = str(event.get("lane", ""))
+        if lane in self.by_name:
+            return lane
+        tier = str(event.get(self.tier_field, ""))
+        if tier in self.creator_tiers:
+            return self.creator_tiers[tier]
+        return self.event_types.get(str(event.get("type", "")), self.default)
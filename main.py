@@ -1,25 +1,99 @@
 import asyncio
 import json
 import os
+import signal
+import time
 from dotenv import load_dotenv
+
+# Before the project imports: their settings are module constants read at import time
+load_dotenv()
+
 import redis.asyncio as redis  # ✅ async redis client
-from mongodb import connect_database
+from mongodb import connect_database, ensure_indexes, landmark_collection
 from typing import Any
 from pymongo.collection import Collection
 from nsfw import detect_nsfw_video
 from video_fingerprint import fingerprint_video,compare_hamming_distance
-from audio_fingerprint import fingerprint_audio
-from redis_client import init_redis  # this must be async
+from audio_fingerprint import analyze_audio
+from full_analysis import analyze_video
+from audio_landmarks import LANDMARK_MIN_MATCHES, LandmarkIndex, LandmarkSnapshotSync, landmarks_to_bytes
+from redis_client import init_redis, init_sync_redis  # this must be async
+from redis_io import StreamWriter
+from stream_recovery import MAX_DELIVERIES, VISIBILITY_TIMEOUT_SECONDS, PendingReclaimer, consumer_name
 from s3 import init_s3_client
-from bson import ObjectId
-load_dotenv()
+from fingerprint_index import FingerprintIndex, create_fingerprint_index
+from fingerprint_snapshot import FINGERPRINT_SNAPSHOT_DIR, FINGERPRINT_SNAPSHOT_SYNC_SECONDS, SnapshotSync, updated_field
+from fingerprint_shard import FINGERPRINT_SHARDS_ENABLED, FingerprintShardsUnavailable, ShardedFingerprintIndex
+from scheduler import EventScheduler
+from result_cache import ResultCache
+from lanes import DEFAULT_LANE, LanePolicy
+from executor import EVENT_MODELS, EVENT_POOLS, AnalysisExecutor
+import metrics
+import models
+from bson import Binary, ObjectId
 
 STREAM_KEY = os.getenv("REDIS_STREAM_KEY", "video_events")
 RESULT_STREAM_KEY = os.getenv("REDIS_RESULT_STREAM_KEY", "video_results")
 GROUP_NAME = os.getenv("REDIS_CONSUMER_GROUP", "video_workers")
-CONSUMER_NAME = os.getenv("REDIS_CONSUMER_NAME", "worker_1")
-
-
+# Unique per process unless REDIS_CONSUMER_NAME pins it
+CONSUMER_NAME = consumer_name()
+# Upper bound on messages per XREADGROUP call; each read asks for the scheduler's free capacity
+READ_BATCH_SIZE = int(os.getenv("READ_BATCH_SIZE", "100"))
+# XREADGROUP block while some lane is full, so its streams are read again soon after it frees up
+LANE_FULL_READ_BLOCK_MS = int(os.getenv("LANE_FULL_READ_BLOCK_MS", "200"))
+# How long pending events may run after SIGTERM before they are cancelled
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "60"))
+SCHEDULER_STATS_INTERVAL_SECONDS = float(os.getenv("SCHEDULER_STATS_INTERVAL_SECONDS", "30"))
+# Duplicates are fingerprints with a Hamming distance below this many bits
+FINGERPRINT_MATCH_THRESHOLD = int(os.getenv("FINGERPRINT_MATCH_THRESHOLD", "5"))
+# Full reload of the fingerprint and landmark indexes when neither snapshots nor shards are on, picks up other workers' writes
+FINGERPRINT_INDEX_REFRESH_SECONDS = int(os.getenv("FINGERPRINT_INDEX_REFRESH_SECONDS", "300"))
+# Candidate documents fetched, and matches written, per round-trip in the duplicate checks
+DUPLICATE_BATCH_SIZE = int(os.getenv("DUPLICATE_BATCH_SIZE", "500"))
+# Event types this worker handles, e.g. "video_fingerprint,audio_fingerprint" for a worker that never loads torch.
+# Other types read from REDIS_STREAM_KEY are moved to their own "<stream>:<event_type>" stream.
+WORKER_ROLES = [role.strip() for role in os.getenv("WORKER_ROLES", ",".join(EVENT_POOLS)).split(",") if role.strip()]
+# Load the models the roles need in the background while the consumer groups are set up
+WORKER_PREWARM = os.getenv("WORKER_PREWARM", "true").lower() in ("1", "true", "yes")
+# Field a forwarded event carries its original enqueue time in (ms since epoch)
+ENQUEUED_AT_FIELD = "enqueuedAt"
+# How long a full_analysis event left pending remembers its finished parts, past its last redelivery
+FULL_ANALYSIS_DONE_TTL_SECONDS = int(VISIBILITY_TIMEOUT_SECONDS * (MAX_DELIVERIES + 1) * 2)
+
+
+
+
+async def find_in_batches(collection: Collection, ids, extra_filter: dict, projection: dict, batch_size: int = DUPLICATE_BATCH_SIZE):
+    """
+    Yield lists of at most batch_size documents for the given _ids, so only one
+    batch of candidates is held in memory at a time.
+    """
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        query = {"_id": {"$in": [ObjectId(i) for i in ids[start:start + batch_size]]}, **extra_filter}
+        with metrics.stage("mongo_find"):
+            batch = await asyncio.to_thread(
+                lambda: list(collection.find(query, projection, batch_size=batch_size))
+            )
+        metrics.count("mongo_find", "documents", len(batch))
+        if batch:
+            yield batch
+
+
+async def publish_duplicate_matches(r, events: list, records: list, RESULT_STREAM_KEY: str, auto_copyright_collection):
+    """Publish match events in one Redis pipeline and write their AutoCopyright records in one insert_many."""
+    if not events:
+        return
+    pipe = r.pipeline(transaction=False)
+    for event in events:
+        pipe.xadd(RESULT_STREAM_KEY, event)
+    with metrics.stage("redis_publish"):
+        await pipe.execute()
+    with metrics.stage("mongo_insert"):
+        result = await asyncio.to_thread(
+            lambda: auto_copyright_collection.insert_many(records, ordered=False)
+        )
+    print(f"Inserted {len(result.inserted_ids)} AutoCopyright records")
 
 
 async def check_video_fingerprint_duplicates(
@@ -30,50 +104,49 @@ async def check_video_fingerprint_duplicates(
     video_url: str,
     fingerprint_hex: str,
     RESULT_STREAM_KEY: str,
-    auto_copyright_collection
+    auto_copyright_collection,
+    video_index: FingerprintIndex
 ):
     """
-    Checks all LongVideo entries for duplicate fingerprints using compare_hamming_distance.
-    Fires Redis event if a match is found.
+    Looks up duplicate video fingerprints in the in-memory index, then re-checks
+    the matched LongVideo entries with compare_hamming_distance.
+    Fires Redis events for the matches found.
     """
     print("checking video duplicates...")
-    # Fetch all other videos with non-empty fingerprint
-    other_videos = await asyncio.to_thread(
-        lambda: list(
-            long_video_collection.find(
-                {
-                    "_id": {"$ne": ObjectId(video_id)},
-                    "fingerprint": {"$ne": ""}
-                },
-                {
-                    "_id": 1,
-                    "videoUrl": 1,
-                    "fingerprint": 1
-                }
-            )
-        )
-    )
-
-    for doc in other_videos:
-        db_fingerprint = doc.get("fingerprint")
-        if not db_fingerprint:
-            continue
-
-        # Compare using your existing function
-        if compare_hamming_distance(fingerprint_hex, db_fingerprint):
-            print("video duplicate found, firing redis event")
-            await r.xadd(RESULT_STREAM_KEY, {
-                "event_type": "duplicate_detected_using_video_fingerprint",
-                "videoId": video_id,
-                "userId": user_id,
-                "videoUrl": video_url,
-                "fingerprint": fingerprint_hex,
-                "matchedVideoId": str(doc.get("_id")),
-                "matchedFingerPrint": db_fingerprint,
-                "matchedVideoUrl": doc.get("videoUrl"),
-            })
-            result = await asyncio.to_thread(
-                lambda: auto_copyright_collection.insert_one({
+    with metrics.stage("index_query"):
+        matches = await asyncio.to_thread(video_index.query, fingerprint_hex, FINGERPRINT_MATCH_THRESHOLD, video_id)
+    if not matches:
+        print("video duplicates checked successfully")
+        return
+
+    # Fetch only the candidate videos the index returned
+    async for matched_videos in find_in_batches(
+        long_video_collection,
+        [matched_id for matched_id, _ in matches],
+        {"fingerprint": {"$ne": ""}},
+        {"_id": 1, "videoUrl": 1, "fingerprint": 1},
+    ):
+        events = []
+        records = []
+        for doc in matched_videos:
+            db_fingerprint = doc.get("fingerprint")
+            if not db_fingerprint:
+                continue
+
+            # Guard against a stale index entry
+            if compare_hamming_distance(fingerprint_hex, db_fingerprint, FINGERPRINT_MATCH_THRESHOLD):
+                print("video duplicate found, firing redis event")
+                events.append({
+                    "event_type": "duplicate_detected_using_video_fingerprint",
+                    "videoId": video_id,
+                    "userId": user_id,
+                    "videoUrl": video_url,
+                    "fingerprint": fingerprint_hex,
+                    "matchedVideoId": str(doc.get("_id")),
+                    "matchedFingerPrint": db_fingerprint,
+                    "matchedVideoUrl": doc.get("videoUrl"),
+                })
+                records.append({
                     "flagged_video_id": ObjectId(video_id),
                     "flagged_video_owner": ObjectId(user_id),
                     "flagged_video_url": video_url,
@@ -83,9 +156,7 @@ async def check_video_fingerprint_duplicates(
                     "matched_video_fingerprint": db_fingerprint,
                     "fingerprint_type": "video_fingerprint",
                 })
-            )
-
-            print(f"Inserted AutoCopyright record with _id: {result.inserted_id}")
+        await publish_duplicate_matches(r, events, records, RESULT_STREAM_KEY, auto_copyright_collection)
     print("video duplicates checked successfully")
 
 async def check_audio_fingerprint_duplicates(
@@ -95,41 +166,52 @@ async def check_audio_fingerprint_duplicates(
     user_id: str,
     video_url: str,
     fingerprint_hex: str,
+    landmarks,
     RESULT_STREAM_KEY: str,
-    auto_copyright_collection
+    auto_copyright_collection,
+    audio_index: FingerprintIndex,
+    landmark_index: LandmarkIndex
 ):
     """
-    Checks all LongVideo entries for duplicate fingerprints using compare_hamming_distance.
-    Fires Redis event if a match is found.
+    Looks up duplicate audio in the in-memory indexes: exact MFCC fingerprint
+    matches, plus landmark matches that also catch re-encodes and partial clips.
+    Fingerprint matches are re-checked with compare_hamming_distance.
+    Fires Redis events for the matches found.
     """
     print("checking audio duplicates...")
-    # Fetch all other videos with non-empty fingerprint
-    other_videos = await asyncio.to_thread(
-        lambda: list(
-            long_video_collection.find(
-                {
-                    "_id": {"$ne": ObjectId(video_id)},
-                    "audio_fingerprint": {"$ne": ""}
-                },
-                {
-                    "_id": 1,
-                    "videoUrl": 1,
-                    "audio_fingerprint": 1
-                }
+    with metrics.stage("index_query"):
+        matches = await asyncio.to_thread(audio_index.query, fingerprint_hex, FINGERPRINT_MATCH_THRESHOLD, video_id)
+    with metrics.stage("landmark_query"):
+        landmark_matches = await asyncio.to_thread(landmark_index.query, landmarks, LANDMARK_MIN_MATCHES, video_id)
+    landmark_scores = dict(landmark_matches)
+    candidate_ids = {matched_id for matched_id, _ in matches} | set(landmark_scores)
+    if not candidate_ids:
+        print("audio duplicates checked successfully")
+        return
+
+    # Fetch only the candidate videos the indexes returned
+    async for matched_videos in find_in_batches(
+        long_video_collection,
+        candidate_ids,
+        {},
+        {"_id": 1, "videoUrl": 1, "audio_fingerprint": 1},
+    ):
+        events = []
+        records = []
+        for doc in matched_videos:
+            db_fingerprint = doc.get("audio_fingerprint") or ""
+            landmark_score = landmark_scores.get(str(doc.get("_id")), 0)
+
+            # Guard against a stale index entry
+            fingerprint_match = bool(db_fingerprint) and compare_hamming_distance(
+                fingerprint_hex, db_fingerprint, FINGERPRINT_MATCH_THRESHOLD
             )
-        )
-    )
+            if not fingerprint_match and not landmark_score:
+                continue
 
-
-    for doc in other_videos:
-        db_fingerprint = doc.get("audio_fingerprint")
-        if not db_fingerprint:
-            continue
-
-        # Compare using your existing function
-        if compare_hamming_distance(fingerprint_hex, db_fingerprint):
-            print("audio duplicate found, firing redis event")
-            await r.xadd(RESULT_STREAM_KEY, {
+            match_type = "fingerprint" if fingerprint_match else "landmarks"
+            print(f"audio duplicate found ({match_type}), firing redis event")
+            events.append({
                 "event_type": "duplicate_detected_using_audio_fingerprint",
                 "videoId": video_id,
                 "userId": user_id,
@@ -138,28 +220,199 @@ async def check_audio_fingerprint_duplicates(
                 "matchedVideoId": str(doc.get("_id")),
                 "matchedAudioFingerprint": db_fingerprint,
                 "matchedVideoUrl": doc.get("videoUrl"),
+                "matchType": match_type,
+                "landmarkMatches": landmark_score,
             })
-            result = await asyncio.to_thread(
-                lambda: auto_copyright_collection.insert_one({
-                    "flagged_video_id": ObjectId(video_id),
-                    "flagged_video_owner": ObjectId(user_id),
-                    "flagged_video_url": video_url,
-                    "flagged_video_fingerprint": fingerprint_hex,
-                    "matched_video_id": ObjectId(doc.get("_id")),
-                    "matched_video_url": doc.get("videoUrl"),
-                    "matched_video_fingerprint": db_fingerprint,
-                    "fingerprint_type": "audio_fingerprint",
-                })
+            records.append({
+                "flagged_video_id": ObjectId(video_id),
+                "flagged_video_owner": ObjectId(user_id),
+                "flagged_video_url": video_url,
+                "flagged_video_fingerprint": fingerprint_hex,
+                "matched_video_id": ObjectId(doc.get("_id")),
+                "matched_video_url": doc.get("videoUrl"),
+                "matched_video_fingerprint": db_fingerprint,
+                "fingerprint_type": "audio_fingerprint",
+                "match_type": match_type,
+                "landmark_matches": landmark_score,
+            })
+        await publish_duplicate_matches(r, events, records, RESULT_STREAM_KEY, auto_copyright_collection)
+    print("audio duplicates checked successfully")
+
+
+
+
+
+async def refresh_fingerprint_indexes(long_video_collection, *indexes):
+    """Periodically rebuild the fingerprint indexes from MongoDB."""
+    while True:
+        await asyncio.sleep(FINGERPRINT_INDEX_REFRESH_SECONDS)
+        for index in indexes:
+            try:
+                await asyncio.to_thread(index.load, long_video_collection)
+            except Exception as e:
+                print(f"⚠️ Failed to refresh '{index.field}' index: {e}")
+
+
+async def sync_landmark_index(landmarks_collection, landmark_index: LandmarkIndex):
+    """Periodically apply landmarks other workers wrote since the last poll."""
+    while True:
+        await asyncio.sleep(FINGERPRINT_SNAPSHOT_SYNC_SECONDS)
+        try:
+            await asyncio.to_thread(landmark_index.sync, landmarks_collection)
+        except Exception as e:
+            print(f"⚠️ Failed to sync '{landmark_index.field}' index: {e}")
+
+
+async def sync_fingerprint_snapshots(*syncs: SnapshotSync):
+    """Periodically apply fingerprints other workers wrote since the last poll."""
+    while True:
+        await asyncio.sleep(FINGERPRINT_SNAPSHOT_SYNC_SECONDS)
+        for sync in syncs:
+            try:
+                await asyncio.to_thread(sync.sync)
+            except Exception as e:
+                print(f"⚠️ Failed to sync '{sync.field}' snapshot: {e}")
+
+
+async def publish_nsfw_result(redis_writer: StreamWriter, video_id, user_id, video_url, is_nsfw, auto_nsfw_collection):
+    print(f"✅ NSFW result for {video_id}: {is_nsfw}")
+    if is_nsfw:
+        print(f"nsfw video found:{video_id}")
+        await redis_writer.xadd(RESULT_STREAM_KEY, {
+            "event_type": "nsfw_detected",
+            "videoId": video_id,
+            "userId": user_id,
+            "videoUrl": video_url,
+            "is_nsfw": json.dumps(is_nsfw)
+        })
+        result = await asyncio.to_thread(
+            lambda: auto_nsfw_collection.insert_one({
+                "flagged_video_id": ObjectId(video_id),
+                "flagged_video_owner": ObjectId(user_id),
+                "flagged_video_url": video_url,
+            })
+        )
+
+        print(f"Inserted AutoNSFW record with _id: {result.inserted_id}")
+
+
+async def store_video_fingerprint(r, video_id, user_id, video_url, fingerprint, long_video_collection, auto_copyright_collection, video_index):
+    """Save the video fingerprint, add it to the index and run the duplicate check."""
+    fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
+    print(f"✅ Video fingerprint for {video_id}: {fingerprint}")
+    with metrics.stage("mongo_update"):
+        result = await asyncio.to_thread(
+            lambda: long_video_collection.update_one(
+            {"_id": ObjectId(video_id)},
+            {"$set": {"fingerprint": fingerprint_hex}, "$currentDate": {updated_field("fingerprint"): True}}
+            )
+        )
+    if result.modified_count == 0:
+        print(f"⚠️ No document updated for videoId: {video_id}")
+    if result.matched_count:
+        # A Redis round-trip when the index is sharded
+        await asyncio.to_thread(video_index.add, video_id, fingerprint_hex)
+    await check_video_fingerprint_duplicates(long_video_collection,r,video_id,user_id,video_url,fingerprint_hex,RESULT_STREAM_KEY,auto_copyright_collection,video_index)
+
+
+async def store_audio_fingerprint(r, video_id, user_id, video_url, fingerprint, landmarks, long_video_collection, auto_copyright_collection, audio_index, landmark_index):
+    """Save the audio fingerprint and landmarks, add them to the indexes and run the duplicate check."""
+    fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
+    print(f"✅ Audio fingerprint for {video_id}: {fingerprint} ({len(landmarks)} landmarks)")
+    with metrics.stage("mongo_update"):
+        result = await asyncio.to_thread(
+            lambda: long_video_collection.update_one(
+            {"_id": ObjectId(video_id)},
+            {"$set": {"audio_fingerprint": fingerprint_hex}, "$currentDate": {updated_field("audio_fingerprint"): True}}
+            )
+        )
+    if result.modified_count == 0:
+        print(f"⚠️ No document updated for videoId: {video_id}")
+    if result.matched_count:
+        # The fingerprint is stored with them too, so a result cache hit can tell they belong together
+        with metrics.stage("mongo_update"):
+            await asyncio.to_thread(
+                lambda: landmark_collection(long_video_collection).update_one(
+                    {"_id": ObjectId(video_id)},
+                    {"$set": {
+                        "audio_fingerprint": fingerprint_hex,
+                        "landmarks": Binary(landmarks_to_bytes(landmarks)),
+                    }, "$currentDate": {updated_field("landmarks"): True}},
+                    upsert=True,
+                )
             )
+        await asyncio.to_thread(audio_index.add, video_id, fingerprint_hex)
+        # A Python loop over up to LANDMARK_MAX_PER_VIDEO landmarks, kept off the event loop
+        await asyncio.to_thread(landmark_index.add, video_id, landmarks)
+    await check_audio_fingerprint_duplicates(long_video_collection,r,video_id,user_id,video_url,fingerprint_hex,landmarks,RESULT_STREAM_KEY,auto_copyright_collection,audio_index,landmark_index)
 
-            print(f"Inserted AutoCopyright record with _id: {result.inserted_id}")
-    print("audio duplicates checked successfully")
 
+def role_stream(event_type: str) -> str:
+    """Stream that holds events of one type for workers running that role."""
+    return f"{STREAM_KEY}:{event_type}"
 
 
+def lane_stream(event_type: str, lane: str) -> str:
+    """Stream that holds one lane's events of one type, when WORKER_LANES is set."""
+    return f"{role_stream(event_type)}:lane:{lane}"
 
 
-async def process_event(r: redis.Redis, event_data: dict, msg_id: str,long_video_collection,s3_client,auto_copyright_collection,auto_nsfw_collection):
+def plan_read(streams, stream_lanes: dict, scheduler: EventScheduler, turn: int = 0):
+    """
+    (streams, count) for one XREADGROUP. COUNT applies to each stream, so a lane's free capacity is
+    split across its streams and the total across lanes stays within the scheduler's. A lane with
+    fewer free slots than streams reads only that many of them, starting from a different one each turn.
+    Streams that only forward (not in stream_lanes) are always read.
+    """
+    selected = [s for s in streams if s not in stream_lanes]
+    count = READ_BATCH_SIZE
+    by_lane = {}
+    for stream in streams:
+        if stream in stream_lanes:
+            by_lane.setdefault(stream_lanes[stream], []).append(stream)
+    taking = []
+    for lane, lane_streams in by_lane.items():
+        free = scheduler.free_capacity(lane)
+        if not free:
+            continue
+        start = turn % len(lane_streams)
+        chosen = (lane_streams[start:] + lane_streams[:start])[:free]
+        count = min(count, free // len(chosen))
+        taking += chosen
+    free = scheduler.free_capacity()
+    if len(taking) > free:
+        taking = taking[:free]
+    if taking:
+        count = min(count, free // len(taking))
+    chosen = set(selected + taking)
+    return [s for s in streams if s in chosen], count
+
+
+def event_enqueued_at(event_data: dict, msg_id: str) -> float:
+    """Unix time the event entered the first stream it was added to, carried over forwards."""
+    try:
+        return int(event_data[ENQUEUED_AT_FIELD]) / 1000
+    except (KeyError, ValueError):
+        return metrics.message_timestamp(msg_id)
+
+
+async def forward_event(redis_writer: StreamWriter, event_data: dict, msg_id: str, source: str = STREAM_KEY, target: str = None):
+    """Move an event from source to target, by default the role stream of its type."""
+    event_type = str(event_data.get("type", ""))
+    target = target or role_stream(event_type)
+    # Waits and SLOs count from the original enqueue, not from the forward
+    event_data = {**event_data, ENQUEUED_AT_FIELD: str(round(event_enqueued_at(event_data, msg_id) * 1000))}
+    try:
+        # ACK only once the XADD has succeeded
+        await redis_writer.xadd(target, event_data)
+        await redis_writer.ack(source, GROUP_NAME, msg_id)
+        print(f"↪️ Forwarded {event_type} event {msg_id} to '{target}'")
+    except Exception as e:
+        # Left pending on the shared stream, the reclaimer retries it
+        print(f"❌ Failed to forward event {msg_id}: {e}")
+
+
+async def process_event(r: redis.Redis, redis_writer: StreamWriter, event_data: dict, msg_id: str,long_video_collection,s3_client,auto_copyright_collection,auto_nsfw_collection,video_index,audio_index,landmark_index,executor,stream: str = STREAM_KEY,result_cache: ResultCache = None):
     video_id = str(event_data.get("videoId", ""))
     video_url = str(event_data.get("videoUrl", ""))
     user_id = str(event_data.get("userId", ""))
@@ -170,93 +423,286 @@ async def process_event(r: redis.Redis, event_data: dict, msg_id: str,long_video
     print(f"user_id:{user_id}")
     print(f"event_type:{event_type}")
 
+    def analyse(func, *args):
+        compute = lambda: executor.run(event_type, func, *args, s3_client=s3_client)
+        # Identical content analysed before (a re-upload or a retry) skips the download and decode
+        return result_cache.run(event_type, video_url, s3_client, compute, video_id) if result_cache else compute()
+
     try:
         print(f"🚀 Processing {event_type} for video {video_id}")
 
         if event_type == "nsfw_detection":
-            is_nsfw = await asyncio.to_thread(detect_nsfw_video, video_url,video_id,s3_client)
-            print(f"✅ NSFW result for {video_id}: {is_nsfw}")
-            if is_nsfw:
-                print(f"nsfw video found:{video_id}")
-                await r.xadd(RESULT_STREAM_KEY, {
-                    "event_type": "nsfw_detected",
-                    "videoId": video_id,
-                    "userId": user_id,
-                    "videoUrl": video_url,
-                    "is_nsfw": json.dumps(is_nsfw)
-                })
-                result = await asyncio.to_thread(
-                    lambda: auto_nsfw_collection.insert_one({
-                        "flagged_video_id": ObjectId(video_id),
-                        "flagged_video_owner": ObjectId(user_id),
-                        "flagged_video_url": video_url,
-                    })
-                )
-
-                print(f"Inserted AutoNSFW record with _id: {result.inserted_id}")
+            is_nsfw = await analyse(detect_nsfw_video, video_url, video_id)
+            await publish_nsfw_result(redis_writer, video_id, user_id, video_url, is_nsfw, auto_nsfw_collection)
             print(f"nsfw check completed {msg_id}")
 
         elif event_type == "video_fingerprint":
-            fingerprint = await asyncio.to_thread(fingerprint_video, video_id,video_url,s3_client)
-            fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
-            print(f"✅ Video fingerprint for {video_id}: {fingerprint}")
-            result = await asyncio.to_thread(
-                lambda: long_video_collection.update_one(
-                {"_id": ObjectId(video_id)},
-                {"$set": {"fingerprint": fingerprint_hex}}
-                )
-            )
-            if result.modified_count == 0:
-                print(f"⚠️ No document updated for videoId: {video_id}")
-            await check_video_fingerprint_duplicates(long_video_collection,r,video_id,user_id,video_url,fingerprint_hex,RESULT_STREAM_KEY,auto_copyright_collection)
+            fingerprint = await analyse(fingerprint_video, video_id, video_url)
+            await store_video_fingerprint(r, video_id, user_id, video_url, fingerprint, long_video_collection, auto_copyright_collection, video_index)
             print(f"duplicate check using video fingerprints completed {msg_id}")
 
         elif event_type == "audio_fingerprint":
-            fingerprint = await asyncio.to_thread(fingerprint_audio, video_url, video_id,s3_client)
-            fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
-            print(f"✅ Audio fingerprint for {video_id}: {fingerprint}")
-            result = await asyncio.to_thread(
-                lambda: long_video_collection.update_one(
-                {"_id": ObjectId(video_id)},
-                {"$set": {"audio_fingerprint": fingerprint_hex}}
-                )
-            )
-            if result.modified_count == 0:
-                print(f"⚠️ No document updated for videoId: {video_id}")
-            await check_audio_fingerprint_duplicates(long_video_collection,r,video_id,user_id,video_url,fingerprint_hex,RESULT_STREAM_KEY,auto_copyright_collection)
+            fingerprint, landmarks = await analyse(analyze_audio, video_url, video_id)
+            await store_audio_fingerprint(r, video_id, user_id, video_url, fingerprint, landmarks, long_video_collection, auto_copyright_collection, audio_index, landmark_index)
             print(f"duplicate check using audio fingerprints completed {msg_id}")
 
+        elif event_type == "full_analysis":
+            # One decode for all three analyses, then the same result handling as the separate events
+            result = await analyse(analyze_video, video_url, video_id)
+            # Parts a previous delivery finished before it was left pending, not published or stored twice
+            done_key = f"{stream}:full_analysis_done:{msg_id}"
+            done = set(await r.smembers(done_key))
+            handlers = {}
+            if result["is_nsfw"] is not None and "nsfw" not in done:
+                handlers["nsfw"] = publish_nsfw_result(redis_writer, video_id, user_id, video_url, result["is_nsfw"], auto_nsfw_collection)
+            if result["fingerprint"] is not None and "video" not in done:
+                handlers["video"] = store_video_fingerprint(r, video_id, user_id, video_url, result["fingerprint"], long_video_collection, auto_copyright_collection, video_index)
+            if result["audio_fingerprint"] is not None and "audio" not in done:
+                handlers["audio"] = store_audio_fingerprint(r, video_id, user_id, video_url, result["audio_fingerprint"], result["landmarks"], long_video_collection, auto_copyright_collection, audio_index, landmark_index)
+            outcomes = dict(zip(handlers, await asyncio.gather(*handlers.values(), return_exceptions=True)))
+            failures = [e for e in outcomes.values() if isinstance(e, Exception)]
+            for failure in failures:
+                if isinstance(failure, FingerprintShardsUnavailable):
+                    finished = [part for part, outcome in outcomes.items() if not isinstance(outcome, Exception)]
+                    if finished:
+                        await r.sadd(done_key, *finished)
+                        await r.expire(done_key, FULL_ANALYSIS_DONE_TTL_SECONDS)
+                    raise failure
+            if done:
+                await r.delete(done_key)
+            if result["errors"] or failures:
+                raise RuntimeError(f"Full analysis incomplete: {result['errors']} {failures}")
+            print(f"full analysis completed {msg_id}")
+
         else:
             raise Exception(f"Invalid event_type: {event_type}")
 
+    except asyncio.CancelledError:
+        # Shutdown cut this event short, leave it un-acked so it is delivered again
+        print(f"⚠️ Processing of {msg_id} cancelled, leaving it pending")
+        raise
+
+    except FingerprintShardsUnavailable as e:
+        # Acking would lose this upload's duplicate check; the reclaimer redelivers it once it has been idle
+        # for REDIS_VISIBILITY_TIMEOUT_SECONDS, and the result cache skips the analysis on the retry
+        metrics.mark_error()
+        print(f"⚠️ Duplicate check for {video_id} incomplete, leaving {msg_id} pending: {e}")
+        return
+
     except Exception as e:
+        metrics.mark_error()
         print(f"❌ Error processing video {video_id}: {e}")
 
-    finally:
-        await r.xack(STREAM_KEY, GROUP_NAME, msg_id)
+    # Batched with other events' ACKs, sent after any results queued above
+    await redis_writer.ack(stream, GROUP_NAME, msg_id)
+
+
+async def report_scheduler_stats(scheduler: EventScheduler):
+    """Periodically log queue depth and in-flight counts while the worker is busy."""
+    while True:
+        await asyncio.sleep(SCHEDULER_STATS_INTERVAL_SECONDS)
+        if scheduler.pending:
+            print(f"📊 Scheduler: {scheduler.stats()}")
+
+
+def register_scheduler_gauges(scheduler: EventScheduler):
+    """Expose scheduler queue depth and in-flight counts, read at scrape time."""
+    for state in ("queued", "in_flight"):
+        metrics.REGISTRY.register(metrics.Gauge(
+            f"worker_events_{state}", f"Events {state.replace('_', ' ')} per event type", ("event_type",),
+            callback=lambda state=state: {(k,): v for k, v in scheduler.stats()[state].items()},
+        ))
+    metrics.REGISTRY.register(metrics.Gauge(
+        "worker_events_pending", "Events read from the stream and not finished yet",
+        callback=lambda: {(): scheduler.pending},
+    ))
+    metrics.REGISTRY.register(metrics.Gauge(
+        "worker_lane_pending", "Events pending per lane", ("lane",),
+        callback=lambda: {(k,): v["pending"] for k, v in scheduler.stats()["lanes"].items()},
+    ))
+
+
+async def report_stream_lag(r: redis.Redis, streams):
+    """Periodically record the consumer group's lag and pending count on each stream."""
+    while True:
+        try:
+            for stream in streams:
+                for group in await r.xinfo_groups(stream):
+                    if group["name"] != GROUP_NAME:
+                        continue
+                    # "lag" needs Redis 7+
+                    if group.get("lag") is not None:
+                        metrics.STREAM_LAG.set(group["lag"], stream=stream, group=GROUP_NAME)
+                    metrics.STREAM_PENDING.set(group["pending"], stream=stream, group=GROUP_NAME)
+        except Exception as e:
+            print(f"⚠️ Failed to read stream lag: {e}")
+        await asyncio.sleep(SCHEDULER_STATS_INTERVAL_SECONDS)
+
+
+async def open_fingerprint_indexes(long_video_collection):
+    """
+    The video and audio fingerprint indexes, set up the configured way (shards, snapshots or a full scan).
+    Returns (video_index, audio_index, tasks keeping them current, shard Redis client to close or None).
+    """
+    if FINGERPRINT_SHARDS_ENABLED:
+        # The fingerprints live in the fingerprint_shard processes, queries fan out to them over Redis
+        shard_redis = init_sync_redis()
+        return (
+            ShardedFingerprintIndex("fingerprint", shard_redis),
+            ShardedFingerprintIndex("audio_fingerprint", shard_redis),
+            [],
+            shard_redis,
+        )
+    video_index = create_fingerprint_index("fingerprint")
+    audio_index = create_fingerprint_index("audio_fingerprint")
+    if FINGERPRINT_SNAPSHOT_DIR:
+        # Map the host's snapshots and poll what changed since, instead of a full scan per worker
+        syncs = [SnapshotSync(long_video_collection, index) for index in (video_index, audio_index)]
+        for sync in syncs:
+            await asyncio.to_thread(sync.start)
+        return video_index, audio_index, [asyncio.create_task(sync_fingerprint_snapshots(*syncs))], None
+    await asyncio.to_thread(video_index.load, long_video_collection)
+    await asyncio.to_thread(audio_index.load, long_video_collection)
+    task = asyncio.create_task(refresh_fingerprint_indexes(long_video_collection, video_index, audio_index))
+    return video_index, audio_index, [task], None
+
+
+async def open_landmark_index(landmarks_collection):
+    """The landmark index and the task that keeps it current."""
+    landmark_index = LandmarkIndex()
+    if FINGERPRINT_SNAPSHOT_DIR:
+        # Map the host's landmark snapshot and poll what changed since, instead of a full scan per worker
+        sync = LandmarkSnapshotSync(landmarks_collection, landmark_index)
+        await asyncio.to_thread(sync.start)
+        return landmark_index, asyncio.create_task(sync_fingerprint_snapshots(sync))
+    if FINGERPRINT_SHARDS_ENABLED:
+        print("⚠️ FINGERPRINT_SNAPSHOT_DIR is not set: every worker loads all landmarks into memory")
+    await asyncio.to_thread(landmark_index.load, landmarks_collection)
+    if FINGERPRINT_SHARDS_ENABLED:
+        # Poll what changed instead of reloading every worker's copy from Mongo
+        return landmark_index, asyncio.create_task(sync_landmark_index(landmarks_collection, landmark_index))
+    return landmark_index, asyncio.create_task(refresh_fingerprint_indexes(landmarks_collection, landmark_index))
 
 
 async def worker():
+    started = time.perf_counter()
+    unknown_roles = [role for role in WORKER_ROLES if role not in EVENT_POOLS]
+    if unknown_roles or not WORKER_ROLES:
+        raise ValueError(f"Invalid WORKER_ROLES: {','.join(unknown_roles) or '(empty)'}")
+    if WORKER_PREWARM:
+        # Runs alongside the index loads and group setup below; first use waits for it if it isn't done
+        models.prewarm(dict.fromkeys(name for role in WORKER_ROLES for name in EVENT_MODELS[role]))
+    print(f"🧩 Worker roles: {', '.join(WORKER_ROLES)}")
+
     r = await init_redis()  # ✅ async init
     s3_client=init_s3_client() #init s3 client
     client, long_video_collection,auto_copyright_collection,auto_nsfw_collection = connect_database()
-
-    # Ensure consumer group exists
-    try:
-        await r.xgroup_create(STREAM_KEY, GROUP_NAME, id="0", mkstream=True)
-        print(f"✅ Consumer group '{GROUP_NAME}' created")
-    except redis.ResponseError as e:
-        if "BUSYGROUP" in str(e):
-            print(f"ℹ️ Consumer group '{GROUP_NAME}' already exists")
-        else:
-            raise
-
-    print(f"📡 Listening on stream '{STREAM_KEY}' as '{CONSUMER_NAME}'...")
-
-    while True:
+    await asyncio.to_thread(ensure_indexes, long_video_collection, auto_copyright_collection)
+
+    # Load fingerprint indexes once, duplicate checks query these instead of scanning Mongo
+    video_index, audio_index, refresh_tasks, shard_redis = await open_fingerprint_indexes(long_video_collection)
+    landmark_index, landmark_task = await open_landmark_index(landmark_collection(long_video_collection))
+    refresh_tasks.append(landmark_task)
+
+    # Every worker reads the shared stream, plus the role streams other workers forward to
+    ingress = [STREAM_KEY] + [role_stream(role) for role in WORKER_ROLES]
+    lanes = LanePolicy.from_env()
+    if lanes:
+        # Ingress events are forwarded to their lane's stream; only the lane streams take scheduler capacity
+        stream_lanes = {lane_stream(role, lane): lane for lane in lanes.names for role in WORKER_ROLES}
+        print(f"🚦 Lanes: {', '.join(f'{lane.name} (weight {lane.weight}, SLO {lane.slo_seconds}s)' for lane in lanes.lanes)}")
+    else:
+        stream_lanes = dict.fromkeys(ingress, DEFAULT_LANE)
+    streams = list(dict.fromkeys(ingress + list(stream_lanes)))
+
+    # Ensure consumer groups exist
+    for stream in streams:
+        try:
+            await r.xgroup_create(stream, GROUP_NAME, id="0", mkstream=True)
+            print(f"✅ Consumer group '{GROUP_NAME}' created on '{stream}'")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" in str(e):
+                print(f"ℹ️ Consumer group '{GROUP_NAME}' already exists on '{stream}'")
+            else:
+                raise
+
+    # Start (and warm) process pools before reading, when WORKER_EXECUTION_MODE=process
+    executor = AnalysisExecutor(event_types=WORKER_ROLES)
+    await asyncio.to_thread(executor.start)
+
+    # Result XADDs and XACKs share pipelines instead of one round-trip each
+    redis_writer = StreamWriter(r)
+    redis_writer.start()
+    # Landmarks are read back from the landmark collection on a shared hit
+    result_cache = ResultCache(r, landmark_collection(long_video_collection))
+    scheduler = EventScheduler(lanes=lanes.lanes if lanes else None)
+    stats_task = asyncio.create_task(report_scheduler_stats(scheduler))
+    background_tasks = refresh_tasks + [stats_task]
+    if metrics.METRICS_ENABLED:
+        register_scheduler_gauges(scheduler)
+        background_tasks.append(asyncio.create_task(report_stream_lag(r, streams)))
+        metrics.start_metrics_server()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Forwards don't take scheduler capacity, they are awaited before the writer closes
+    forwarding = set()
+
+    def forward(stream, msg_id, data, target=None):
+        task = asyncio.create_task(forward_event(redis_writer, data, msg_id, stream, target))
+        forwarding.add(task)
+        task.add_done_callback(forwarding.discard)
+
+    def submit_event(stream, msg_id, data):
+        event_type = str(data.get("type", ""))
+        lane = stream_lanes.get(stream)
+        if lanes and lane is None and event_type in EVENT_POOLS:
+            forward(stream, msg_id, data, lane_stream(event_type, lanes.lane_for(data)))
+            return
+        if not lanes and stream == STREAM_KEY and event_type in EVENT_POOLS and event_type not in WORKER_ROLES:
+            forward(stream, msg_id, data)
+            return
+        enqueued_at = event_enqueued_at(data, msg_id)
+        task = scheduler.submit(
+            event_type,
+            metrics.timed_message(
+                msg_id, event_type,
+                process_event(r, redis_writer, data, msg_id,long_video_collection,s3_client,auto_copyright_collection,auto_nsfw_collection,video_index,audio_index,landmark_index,executor,stream,result_cache),
+                enqueued_at,
+            ),
+            lane=lane or lanes.default,
+            enqueued_at=enqueued_at,
+        )
+        reclaimers[stream].track(msg_id, task)
+
+    # Picks up entries left pending by consumers that died mid-job
+    reclaimers = {stream: PendingReclaimer(r, stream, GROUP_NAME, CONSUMER_NAME) for stream in streams}
+    reclaim_tasks = [
+        asyncio.create_task(reclaimer.run(
+            scheduler, lambda msg_id, data, stream=stream: submit_event(stream, msg_id, data), stream_lanes.get(stream)
+        ))
+        for stream, reclaimer in reclaimers.items()
+    ]
+    heartbeat_tasks = [asyncio.create_task(reclaimer.run_heartbeats()) for reclaimer in reclaimers.values()]
+
+    print(f"📡 Listening on {', '.join(repr(s) for s in streams)} as '{CONSUMER_NAME}' (started in {time.perf_counter() - started:.2f}s)...")
+
+    read_turn = 0
+    while not stop.is_set():
         try:
+            # Backpressure: a lane's streams are only read while it has room; forwarding needs none
+            readable, count = plan_read(streams, stream_lanes, scheduler, read_turn)
+            read_turn += 1
+            if not readable:
+                await scheduler.wait_for_capacity(timeout=1)
+                continue
+
             messages = await r.xreadgroup(
-                GROUP_NAME, CONSUMER_NAME, {STREAM_KEY: ">"}, count=5, block=5000
+                GROUP_NAME, CONSUMER_NAME, {stream: ">" for stream in readable},
+                count=count,
+                block=5000 if len(readable) == len(streams) else LANE_FULL_READ_BLOCK_MS,
             )
 
             if messages:
@@ -264,7 +710,7 @@ async def worker():
                     for msg_id, data in events:
                         try:
                             print(f"task arrived in queue {msg_id}")
-                            asyncio.create_task(process_event(r, data, msg_id,long_video_collection,s3_client,auto_copyright_collection,auto_nsfw_collection))
+                            submit_event(stream, msg_id, data)
                         except Exception as e:
                             print(f"❌ Failed to schedule event {msg_id}: {e}")
 
@@ -272,6 +718,22 @@ async def worker():
             print(f"⚠️ Redis connection lost: {e}")
             await asyncio.sleep(5)
 
+    print("🛑 Shutdown requested, no longer reading new events")
+    for task in reclaim_tasks:
+        task.cancel()
+    await scheduler.drain(SHUTDOWN_DRAIN_SECONDS)
+    if forwarding:
+        await asyncio.gather(*forwarding, return_exceptions=True)
+    await redis_writer.close()
+    for task in background_tasks + heartbeat_tasks:
+        task.cancel()
+    await asyncio.to_thread(executor.shutdown)
+    await r.aclose()
+    if shard_redis is not None:
+        shard_redis.close()
+    client.close()
+    print("👋 Worker stopped")
+
 
 if __name__ == "__main__":
     asyncio.run(worker())
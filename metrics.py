@@ -0,0 +1,329 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# Print one JSON line with the stage timings of every processed message
+METRICS_LOG_TIMINGS = os.getenv("METRICS_LOG_TIMINGS", "false").lower() in ("1", "true", "yes")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labelnames, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(k, "")) for k in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A gauge that is either set directly or computed at scrape time by callback() -> {labels tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                print(f"⚠️ Gauge {self.name} callback failed: {e}")
+                values = {}
+            with self._lock:
+                self._values = {tuple(str(v) for v in key): value for key, value in values.items()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self._values.items())
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "worker_stage_seconds", "Time spent per processing stage", ("stage",)
+))
+STAGE_ITEMS = REGISTRY.register(Counter(
+    "worker_stage_items_total", "Bytes, documents, frames or commands handled per stage", ("stage", "unit")
+))
+EVENT_SECONDS = REGISTRY.register(Histogram(
+    "worker_event_seconds", "End-to-end handling time per event", ("event_type", "outcome")
+))
+EVENT_QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "worker_event_queue_wait_seconds", "Time from XADD to the start of processing", ("event_type",)
+))
+LANE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "worker_lane_wait_seconds", "Time from XADD to the start of processing per lane", ("lane", "event_type")
+))
+LANE_SLO_MISSES = REGISTRY.register(Counter(
+    "worker_lane_slo_misses_total", "Events that waited longer than their lane's SLO", ("lane", "event_type")
+))
+STREAM_LAG = REGISTRY.register(Gauge(
+    "worker_stream_lag_entries", "Entries in the stream not yet delivered to the consumer group", ("stream", "group")
+))
+STREAM_PENDING = REGISTRY.register(Gauge(
+    "worker_stream_pending_entries", "Entries delivered to the consumer group but not acked", ("stream", "group")
+))
+
+# Stage timings for the message being processed; copied into to_thread calls
+_current_record = contextvars.ContextVar("metrics_record", default=None)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name: str):
+    """Context manager timing one stage; a shared no-op when metrics are disabled."""
+    if not METRICS_ENABLED:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def record_stage(name: str, seconds: float):
+    """Record a stage duration measured elsewhere (e.g. time blocked on a pipe)."""
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.observe(seconds, stage=name)
+    record = _current_record.get()
+    if record is not None:
+        record["stages"].append((name, seconds))
+
+
+def count(name: str, unit: str, amount: float = 1):
+    """Count bytes, documents, frames... handled by a stage. unit is a single word."""
+    if not METRICS_ENABLED:
+        return
+    STAGE_ITEMS.inc(amount, stage=name, unit=unit)
+    record = _current_record.get()
+    if record is not None:
+        key = f"{name}_{unit}"
+        record["counts"][key] = record["counts"].get(key, 0) + amount
+
+
+@contextmanager
+def capture():
+    """
+    Collect the stage timings and counts recorded inside the block. Used in
+    pool processes, whose record is sent back and replayed in the worker.
+    """
+    if not METRICS_ENABLED:
+        yield None
+        return
+    record = {"stages": [], "counts": {}}
+    token = _current_record.set(record)
+    try:
+        yield record
+    finally:
+        _current_record.reset(token)
+
+
+def replay(record):
+    """Record stages and counts captured in another process as if they happened here."""
+    if not record:
+        return
+    for name, seconds in record["stages"]:
+        record_stage(name, seconds)
+    for key, amount in record["counts"].items():
+        name, unit = key.rsplit("_", 1)
+        count(name, unit, amount)
+
+
+def message_timestamp(msg_id: str) -> float:
+    """Unix time a stream entry was added, from the millisecond timestamp in its id."""
+    return int(msg_id.split("-", 1)[0]) / 1000
+
+
+def message_age_seconds(msg_id: str) -> float:
+    """Seconds since a stream entry was added."""
+    return time.time() - message_timestamp(msg_id)
+
+
+@contextmanager
+def message_timing(msg_id: str, event_type: str, enqueued_at: float = None):
+    """
+    Time the handling of one stream message. Stages recorded inside (including
+    in threads started with asyncio.to_thread) are attached to it, and a JSON
+    timing line is printed on exit when METRICS_LOG_TIMINGS is set. Queue wait
+    is measured from enqueued_at (unix seconds), by default when msg_id was added.
+    """
+    if not METRICS_ENABLED:
+        yield None
+        return
+    try:
+        wait = message_age_seconds(msg_id) if enqueued_at is None else time.time() - enqueued_at
+        EVENT_QUEUE_WAIT_SECONDS.observe(max(0.0, wait), event_type=event_type)
+    except ValueError:
+        pass
+    record = {"stages": [], "counts": {}}
+    token = _current_record.set(record)
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield record
+        outcome = record.get("outcome", "ok")
+    finally:
+        _current_record.reset(token)
+        total = time.perf_counter() - start
+        EVENT_SECONDS.observe(total, event_type=event_type, outcome=outcome)
+        if METRICS_LOG_TIMINGS:
+            stages = {}
+            for name, seconds in record["stages"]:
+                stages[name] = round(stages.get(name, 0) + seconds, 6)
+            print(json.dumps({
+                "msg_id": msg_id,
+                "event_type": event_type,
+                "outcome": outcome,
+                "total_s": round(total, 6),
+                "stages_s": stages,
+                "counts": record["counts"],
+            }))
+
+
+async def timed_message(msg_id: str, event_type: str, coro, enqueued_at: float = None):
+    """Await a message handler coroutine inside message_timing."""
+    with message_timing(msg_id, event_type, enqueued_at):
+        return await coro
+
+
+def mark_error():
+    """Flag the message being timed as failed (for handlers that catch their own errors)."""
+    record = _current_record.get()
+    if record is not None:
+        record["outcome"] = "error"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Serve REGISTRY in Prometheus text format on /metrics from a daemon thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 Metrics available on :{port}/metrics")
+    return server
@@ -0,0 +1,70 @@
+import importlib
+import threading
+import time
+
+# name -> zero-argument loader; loaded values are cached for the life of the process
+_loaders = {}
+_loaded = {}
+_load_seconds = {}
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def register(name: str, loader):
+    """Register a loader for a heavy dependency or model. Nothing is loaded until get(name)."""
+    with _registry_lock:
+        _loaders[name] = loader
+        _locks.setdefault(name, threading.Lock())
+
+
+def register_module(name: str, module_name: str = None):
+    """Register a lazily imported module."""
+    register(name, lambda: importlib.import_module(module_name or name))
+
+
+def get(name: str):
+    """Return the loaded value, loading it on first use. Concurrent callers wait for one load."""
+    if name in _loaded:
+        return _loaded[name]
+    try:
+        lock = _locks[name]
+    except KeyError:
+        raise ValueError(f"❌ No loader registered for '{name}'")
+    with lock:
+        if name not in _loaded:
+            start = time.perf_counter()
+            value = _loaders[name]()
+            _load_seconds[name] = time.perf_counter() - start
+            _loaded[name] = value
+            print(f"✅ Loaded {name} in {_load_seconds[name]:.2f}s")
+    return _loaded[name]
+
+
+def is_loaded(name: str) -> bool:
+    return name in _loaded
+
+
+def load_times() -> dict:
+    """Seconds each loaded entry took to load."""
+    return dict(_load_seconds)
+
+
+def prewarm(names) -> threading.Thread:
+    """Load names in a background thread. Failures are logged and retried on first real use."""
+    names = [n for n in names if not is_loaded(n)]
+
+    def run():
+        for name in names:
+            try:
+                get(name)
+            except Exception as e:
+                print(f"⚠️ Pre-warming {name} failed: {e}")
+
+    thread = threading.Thread(target=run, name="model-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+register_module("torch")
+register_module("cv2")
+register_module("librosa")
@@ -2,6 +2,10 @@
 import os
 from pymongo import MongoClient, errors
 
+# Audio landmarks live in their own collection, in the same database as longvideos, so the
+# index scans and syncs don't read LongVideo documents and LongVideo reads don't carry landmarks
+LANDMARK_COLLECTION = "audiolandmarks"
+
 
 
  
@@ -29,5 +33,55 @@ def connect_database():
         raise ConnectionError(f"❌ MongoDB connection failed: {e}")
 
 
- 
+def landmark_collection(long_video_collection):
+    """The collection holding each video's audio landmarks, keyed by the LongVideo _id."""
+    return long_video_collection.database[LANDMARK_COLLECTION]
+
+
+def ensure_indexes(long_video_collection, auto_copyright_collection):
+    """Create the indexes the fingerprint lookups and duplicate records rely on (no-op if they exist)."""
+    long_video_collection.create_index("fingerprint")
+    long_video_collection.create_index("audio_fingerprint")
+    # Polled by the fingerprint snapshot sync
+    long_video_collection.create_index("fingerprint_updated_at")
+    long_video_collection.create_index("audio_fingerprint_updated_at")
+    landmark_collection(long_video_collection).create_index("landmarks_updated_at")
+    auto_copyright_collection.create_index("flagged_video_id")
+    auto_copyright_collection.create_index("matched_video_id")
+    print("✅ MongoDB indexes ensured")
+
 
+def migrate_landmarks(long_video_collection, batch_size: int = 100):
+    """Move audio_landmarks stored on LongVideo documents into the landmark collection. Returns how many moved."""
+    landmarks_collection = landmark_collection(long_video_collection)
+    moved = 0
+    while True:
+        docs = list(long_video_collection.find(
+            {"audio_landmarks": {"$exists": True}}, {"_id": 1, "audio_fingerprint": 1, "audio_landmarks": 1}
+        ).limit(batch_size))
+        if not docs:
+            break
+        for doc in docs:
+            if doc["audio_landmarks"]:
+                landmarks_collection.update_one(
+                    {"_id": doc["_id"]},
+                    {"$set": {"audio_fingerprint": doc.get("audio_fingerprint"), "landmarks": doc["audio_landmarks"]},
+                     "$currentDate": {"landmarks_updated_at": True}},
+                    upsert=True,
+                )
+            long_video_collection.update_one({"_id": doc["_id"]}, {"$unset": {"audio_landmarks": ""}})
+        moved += len(docs)
+        print(f"📦 Moved landmarks of {moved} videos to '{LANDMARK_COLLECTION}'")
+    return moved
+
+
+if __name__ == "__main__":
+    # python -m mongodb: one-off move of landmarks written before they had their own collection
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    client, long_video_collection, _, _ = connect_database()
+    try:
+        migrate_landmarks(long_video_collection)
+    finally:
+        client.close()
@@ -1,20 +1,154 @@
 import os
-import cv2
+import hashlib
+import queue
 import tempfile
+import threading
+import time
 import requests
-import torch
+import numpy as np
 from PIL import Image
-from transformers import AutoModelForImageClassification, ViTImageProcessor
-from fastapi import HTTPException
-from s3 import download_video_from_s3
-from video_fingerprint import cleanup
-# Load NSFW model once
-model = AutoModelForImageClassification.from_pretrained("Falconsai/nsfw_image_detection")
-processor = ViTImageProcessor.from_pretrained("Falconsai/nsfw_image_detection")
-model.eval()
+from concurrent.futures import Future
+from contextlib import closing
+from subprocess import CalledProcessError
+from s3 import open_media, is_stream_url
+from video_fingerprint import ffmpeg_probe, iter_rawvideo
+import metrics
+import models
+
+# ViT input resolution, frames are scaled to this by ffmpeg
+NSFW_INPUT_SIZE = 224
+# "interval", "scene" or "coarse_to_fine"
+NSFW_SAMPLING_STRATEGY = os.getenv("NSFW_SAMPLING_STRATEGY", "interval")
+NSFW_SAMPLE_INTERVAL_SECONDS = float(os.getenv("NSFW_SAMPLE_INTERVAL_SECONDS", "10"))
+NSFW_COARSE_INTERVAL_SECONDS = float(os.getenv("NSFW_COARSE_INTERVAL_SECONDS", "60"))
+NSFW_SCENE_THRESHOLD = float(os.getenv("NSFW_SCENE_THRESHOLD", "0.3"))
+NSFW_MAX_BATCH_SIZE = int(os.getenv("NSFW_MAX_BATCH_SIZE", "16"))
+NSFW_MAX_WAIT_MS = float(os.getenv("NSFW_MAX_WAIT_MS", "20"))
+# Frames of a video sent to the batcher before its labels are checked. The first chunk is this small so an
+# early NSFW frame stops the decode early; each later chunk doubles, up to NSFW_MAX_BATCH_SIZE.
+NSFW_FIRST_CHUNK_FRAMES = int(os.getenv("NSFW_FIRST_CHUNK_FRAMES", "2"))
+# A chunk is also sent once its first frame has waited this long for the rest (slow seeks on streamed input)
+NSFW_CHUNK_MAX_WAIT_MS = float(os.getenv("NSFW_CHUNK_MAX_WAIT_MS", "1000"))
+
+NSFW_MODEL_NAME = "Falconsai/nsfw_image_detection"
+# "torch" (fp32), "torch_int8" (dynamically quantized Linear layers) or "onnx" (ONNX Runtime)
+NSFW_BACKEND = os.getenv("NSFW_BACKEND", "torch")
+# Exported once by the onnx backend and reused by later starts; workers with the file never import torch
+NSFW_ONNX_PATH = os.getenv("NSFW_ONNX_PATH") or os.path.join(tempfile.gettempdir(), "strmly_nsfw_vit.onnx")
+# Threads per forward pass for the torch and onnx backends, 0 keeps the library default
+NSFW_INTRA_OP_THREADS = int(os.getenv("NSFW_INTRA_OP_THREADS", "0"))
+# Part of the result cache key: bump the leading number when a change alters detect_nsfw_video's result
+NSFW_RESULT_VERSION = (
+    f"1:{NSFW_MODEL_NAME}:{NSFW_BACKEND}:{NSFW_SAMPLING_STRATEGY}:"
+    f"{NSFW_SAMPLE_INTERVAL_SECONDS}:{NSFW_COARSE_INTERVAL_SECONDS}:{NSFW_SCENE_THRESHOLD}"
+)
+
+
+class NsfwClassifier:
+    """ViT image processor plus one backend's forward pass (numpy pixel values -> numpy logits)."""
+
+    def __init__(self, backend: str, processor, forward, id2label):
+        self.backend = backend
+        self.processor = processor
+        self.forward = forward
+        self.id2label = id2label
+
+    def logits(self, frames):
+        pixel_values = self.processor(images=frames, return_tensors="np")["pixel_values"]
+        return self.forward(pixel_values.astype(np.float32, copy=False))
+
+
+def _load_processor():
+    from transformers import ViTImageProcessor
+    return ViTImageProcessor.from_pretrained(NSFW_MODEL_NAME)
+
+
+def _load_torch_model():
+    from transformers import AutoModelForImageClassification
+    model = AutoModelForImageClassification.from_pretrained(NSFW_MODEL_NAME)
+    model.eval()
+    return model
+
+
+def _torch_classifier(backend, model):
+    torch = models.get("torch")
+    if NSFW_INTRA_OP_THREADS:
+        torch.set_num_threads(NSFW_INTRA_OP_THREADS)
+
+    def forward(pixel_values):
+        with torch.no_grad():
+            return model(pixel_values=torch.from_numpy(pixel_values)).logits.numpy()
+
+    return NsfwClassifier(backend, models.get("nsfw_processor"), forward, model.config.id2label)
+
+
+def _load_torch_int8_model():
+    torch = models.get("torch")
+    # A fresh copy, so the fp32 weights aren't kept around next to the quantized ones
+    return torch.ao.quantization.quantize_dynamic(_load_torch_model(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def export_onnx(path: str = NSFW_ONNX_PATH):
+    """Export the fp32 model to ONNX with a dynamic batch dimension."""
+    torch = models.get("torch")
+    model = _load_torch_model()
+    dummy = torch.zeros(1, 3, NSFW_INPUT_SIZE, NSFW_INPUT_SIZE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        model, (dummy,), tmp_path,
+        input_names=["pixel_values"], output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+    # Atomic, so concurrent workers never load a half-written file
+    os.replace(tmp_path, path)
+    print(f"✅ Exported NSFW model to {path}")
+    return path
+
+
+def _load_onnx_classifier():
+    import onnxruntime as ort
+    from transformers import AutoConfig
+    if not os.path.exists(NSFW_ONNX_PATH):
+        export_onnx(NSFW_ONNX_PATH)
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = NSFW_INTRA_OP_THREADS
+    # Batches are one graph run, parallelism comes from intra-op threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(NSFW_ONNX_PATH, options, providers=["CPUExecutionProvider"])
+
+    def forward(pixel_values):
+        return session.run(["logits"], {"pixel_values": pixel_values})[0]
+
+    id2label = {int(k): v for k, v in AutoConfig.from_pretrained(NSFW_MODEL_NAME).id2label.items()}
+    return NsfwClassifier("onnx", models.get("nsfw_processor"), forward, id2label)
+
+
+NSFW_BACKENDS = {
+    "torch": lambda: _torch_classifier("torch", models.get("nsfw_vit")),
+    "torch_int8": lambda: _torch_classifier("torch_int8", _load_torch_int8_model()),
+    "onnx": _load_onnx_classifier,
+}
+
+
+def _load_classifier():
+    try:
+        loader = NSFW_BACKENDS[NSFW_BACKEND]
+    except KeyError:
+        raise ValueError(f"Invalid NSFW_BACKEND: {NSFW_BACKEND}")
+    return loader()
+
+
+# Loaded on first use (or by models.prewarm), so importing this module stays cheap
+models.register("nsfw_processor", _load_processor)
+models.register("nsfw_vit", _load_torch_model)
+models.register("nsfw_classifier", _load_classifier)
 
 def download_video(url: str) -> str:
     """Download a video from a URL to a temporary file."""
+    from fastapi import HTTPException
     response = requests.get(url, stream=True)
     if response.status_code != 200:
         raise HTTPException(status_code=400, detail="Failed to download video.")
@@ -27,6 +161,7 @@ def download_video(url: str) -> str:
 
 def extract_frames(video_path: str):
     """Extract frames every 10 seconds from a video."""
+    cv2 = models.get("cv2")
     frames = []
     cap = cv2.VideoCapture(video_path)
 
@@ -44,32 +179,265 @@ def extract_frames(video_path: str):
     cap.release()
     return frames
 
+def probe_duration(video_path: str) -> float:
+    """Container duration in seconds, 0 if unknown."""
+    if is_stream_url(video_path):
+        # ffmpeg only reads the container header for this, OpenCV would open a decoder on the stream
+        return ffmpeg_probe(video_path)[0]
+    cv2 = models.get("cv2")
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    cap.release()
+    return total_frames / fps if fps > 0 else 0
+
+
+def _interval_filter(seconds):
+    return f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{seconds})'"
+
+
+def _sampling_passes(strategy):
+    """ffmpeg select filters to run, in order, for a sampling strategy."""
+    if strategy == "interval":
+        return [_interval_filter(NSFW_SAMPLE_INTERVAL_SECONDS)]
+    if strategy == "scene":
+        return [f"select='eq(n,0)+gt(scene,{NSFW_SCENE_THRESHOLD})'"]
+    if strategy == "coarse_to_fine":
+        # Spread samples over the whole video first, then fill in the gaps
+        return [
+            _interval_filter(NSFW_COARSE_INTERVAL_SECONDS),
+            _interval_filter(NSFW_SAMPLE_INTERVAL_SECONDS),
+        ]
+    raise ValueError(f"Invalid NSFW_SAMPLING_STRATEGY: {strategy}")
+
+
+def sampling_filter(strategy: str = NSFW_SAMPLING_STRATEGY) -> str:
+    """The select filter for a strategy when every frame is decoded anyway (its finest pass)."""
+    return _sampling_passes(strategy)[-1]
+
+
+def _iter_rgb_frames(video_path, select_filter, size, keyframes_only):
+    cmd = ["ffmpeg", "-v", "error"]
+    if keyframes_only:
+        # Only keyframes are decoded, so "seeking" to the next sample is nearly free
+        cmd += ["-skip_frame", "nokey"]
+    cmd += [
+        "-i", video_path,
+        "-vf", f"{select_filter},scale={size}:{size},format=rgb24",
+        "-vsync", "0",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"
+    ]
+    return iter_rawvideo(cmd, (size, size, 3))
+
+
+def _sample_times(strategy, duration):
+    """Sample timestamps for the interval strategies, coarse ones first, without repeats."""
+    if strategy == "interval":
+        intervals = [NSFW_SAMPLE_INTERVAL_SECONDS]
+    elif strategy == "coarse_to_fine":
+        intervals = [NSFW_COARSE_INTERVAL_SECONDS, NSFW_SAMPLE_INTERVAL_SECONDS]
+    else:
+        raise ValueError(f"Invalid NSFW_SAMPLING_STRATEGY: {strategy}")
+    seen = set()
+    for interval in intervals:
+        t = 0.0
+        while t == 0 or t < duration:
+            if round(t, 3) not in seen:
+                seen.add(round(t, 3))
+                yield t
+            t += interval
+
+
+def _iter_seek_frames(video_path, times, size, keyframes_only):
+    """One input-seeking ffmpeg run per timestamp, so only the data around each sample is read."""
+    for t in times:
+        cmd = ["ffmpeg", "-v", "error"]
+        if keyframes_only:
+            # The keyframe the seek lands on (at or before t), decoded without reading up to t
+            cmd += ["-skip_frame", "nokey", "-noaccurate_seek"]
+        cmd += [
+            "-ss", f"{t:.3f}", "-i", video_path,
+            "-vf", f"scale={size}:{size},format=rgb24",
+            "-frames:v", "1",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"
+        ]
+        with closing(iter_rawvideo(cmd, (size, size, 3))) as frames:
+            yield from frames
+
+
+def iter_frames(video_path: str, strategy: str = NSFW_SAMPLING_STRATEGY, size: int = NSFW_INPUT_SIZE):
+    """
+    Lazily yield sampled frames as size x size PIL images.
+    Sampling decodes keyframes only; if the video has too few keyframes for
+    the sample interval, the interval pass is repeated with a full decode.
+    Frames already yielded by an earlier pass are skipped.
+    """
+    seen = set()
+    yielded = 0
+
+    def unseen(frames):
+        nonlocal yielded
+        for frame in frames:
+            digest = hashlib.blake2b(frame.tobytes(), digest_size=8).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            yielded += 1
+            yield Image.fromarray(frame)
+
+    if is_stream_url(video_path) and strategy != "scene":
+        # A select filter decodes (and so transfers) the whole stream; seek to each sample instead
+        times = list(_sample_times(strategy, probe_duration(video_path)))
+        yield from unseen(_iter_seek_frames(video_path, times, size, keyframes_only=True))
+        if yielded < len(times) / 2:
+            yield from unseen(_iter_seek_frames(video_path, times, size, keyframes_only=False))
+        return
+
+    for select_filter in _sampling_passes(strategy):
+        with closing(_iter_rgb_frames(video_path, select_filter, size, keyframes_only=True)) as frames:
+            yield from unseen(frames)
+
+    if strategy != "scene":
+        expected = probe_duration(video_path) // NSFW_SAMPLE_INTERVAL_SECONDS
+        if yielded < expected / 2:
+            select_filter = _interval_filter(NSFW_SAMPLE_INTERVAL_SECONDS)
+            with closing(_iter_rgb_frames(video_path, select_filter, size, keyframes_only=False)) as frames:
+                yield from unseen(frames)
+
+
+def sample_frames(video_path: str):
+    """iter_frames, falling back to the OpenCV extractor if ffmpeg fails before yielding anything."""
+    started = False
+    try:
+        for frame in iter_frames(video_path):
+            started = True
+            yield frame
+        return
+    except (CalledProcessError, OSError) as e:
+        if started:
+            raise
+        print(f"⚠️ ffmpeg frame sampling failed, falling back to OpenCV: {e}")
+    yield from extract_frames(video_path)
+
+
+def classify_frames(frames):
+    """Classify a list of PIL images in one forward pass. Returns one label per frame."""
+    classifier = models.get("nsfw_classifier")
+    frames = list(frames)
+    with metrics.stage("nsfw_inference"):
+        logits = classifier.logits(frames)
+    metrics.count("nsfw_inference", "frames", len(frames))
+    return [classifier.id2label[i] for i in logits.argmax(-1).tolist()]
+
+
+class NsfwBatcher:
+    """
+    Micro-batcher shared by all in-flight nsfw_detection calls.
+    Requests are queued from worker threads; one background thread merges them
+    into batches of up to max_batch_size frames, flushing early once the oldest
+    request has waited max_wait_ms, and hands each caller its own labels.
+    """
+
+    def __init__(self, max_batch_size: int = NSFW_MAX_BATCH_SIZE, max_wait_ms: float = NSFW_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, frames) -> Future:
+        """Queue up to max_batch_size frames; the future resolves to their labels."""
+        frames = list(frames)
+        if len(frames) > self.max_batch_size:
+            raise ValueError(f"Cannot submit {len(frames)} frames, max batch size is {self.max_batch_size}")
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="nsfw-batcher", daemon=True)
+                self._thread.start()
+        self._queue.put((frames, future))
+        return future
+
+    def classify(self, frames):
+        return self.submit(frames).result()
+
+    def _run(self):
+        carry = None
+        while True:
+            first = carry or self._queue.get()
+            carry = None
+            batch = [first]
+            batch_frames = len(first[0])
+            deadline = time.monotonic() + self.max_wait
+            while batch_frames < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if batch_frames + len(request[0]) > self.max_batch_size:
+                    carry = request
+                    break
+                batch.append(request)
+                batch_frames += len(request[0])
+            self._flush(batch)
+
+    def _flush(self, batch):
+        frames = [frame for request_frames, _ in batch for frame in request_frames]
+        try:
+            labels = classify_frames(frames)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        offset = 0
+        for request_frames, future in batch:
+            future.set_result(labels[offset:offset + len(request_frames)])
+            offset += len(request_frames)
+
+
+batcher = NsfwBatcher()
+
+
 def nsfw_detection(frames):
-    """Run NSFW detection on a list of PIL images."""
-    with torch.no_grad():
-        for img in frames:
-            inputs = processor(images=img, return_tensors="pt")
-            outputs = model(**inputs)
-            logits = outputs.logits
-            predicted_label = logits.argmax(-1).item()
-            label = model.config.id2label[predicted_label]
-            if label=="nsfw":
+    """
+    Run NSFW detection on PIL images, batched with other in-flight videos. Frames go to the batcher
+    in growing chunks (see NSFW_FIRST_CHUNK_FRAMES), so detection can stop soon after an NSFW frame.
+    """
+    chunk = []
+    chunk_size = max(1, min(NSFW_FIRST_CHUNK_FRAMES, batcher.max_batch_size))
+    chunk_started = None
+    for img in frames:
+        if not chunk:
+            chunk_started = time.monotonic()
+        chunk.append(img)
+        # The wait is checked as frames arrive, a frame after a long gap is sent with the ones before it
+        if len(chunk) >= chunk_size or time.monotonic() - chunk_started >= NSFW_CHUNK_MAX_WAIT_MS / 1000:
+            # Queueing plus the shared batch's inference, as seen by this video
+            with metrics.stage("nsfw_batch_wait"):
+                labels = batcher.classify(chunk)
+            if "nsfw" in labels:
                 return True
+            chunk = []
+            chunk_size = min(chunk_size * 2, batcher.max_batch_size)
+    if chunk:
+        with metrics.stage("nsfw_batch_wait"):
+            labels = batcher.classify(chunk)
+        if "nsfw" in labels:
+            return True
     return False
 
 
 
 def detect_nsfw_video(video_url,video_id,s3_client):
- temp_dir = tempfile.mkdtemp()
- output_dir = tempfile.mkdtemp()
- try:
-    input_file_path, input_file_name = download_video_from_s3(video_url,video_id,temp_dir,s3_client)
-    frames=extract_frames(input_file_path)
-    is_nsfw=nsfw_detection(frames)
-    return is_nsfw
-
- finally:
-    cleanup(temp_dir,output_dir)
+ # Cached download shared with the other analyses of the same upload, or a ranged stream
+ with open_media(video_url, s3_client, "nsfw_detection") as input_file_path:
+    # Frames are decoded as inference consumes them, decoding stops at the first NSFW frame
+    with closing(sample_frames(input_file_path)) as frames:
+        is_nsfw=nsfw_detection(frames)
+ return is_nsfw
 
 
  
\ No newline at end of file
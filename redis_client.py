@@ -1,14 +1,37 @@
 import os
+import redis as sync_redis
 import redis.asyncio as redis
 
+# Shared by the blocking XREADGROUP, result pipelines and duplicate-check pipelines
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "16"))
+# Seconds to wait for a free pooled connection before failing
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "10"))
 
 
-def init_redis():
-  redis_client = redis.Redis(
+def _connection_kwargs():
+  return dict(
         host=os.getenv("REDIS_HOST"),
         port=int(os.getenv("REDIS_PORT")),
         password=os.getenv("REDIS_PASSWORD"),
         username="default",
-        decode_responses=True
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_connect_timeout=5,
+        socket_keepalive=True,
+        # Detects connections dropped while idle before a command fails on them
+        health_check_interval=30,
     )
+
+
+def init_redis():
+  pool = redis.BlockingConnectionPool(**_connection_kwargs())
+  # from_pool hands ownership of the pool to the client, so aclose() releases it
+  redis_client = redis.Redis.from_pool(pool)
   return redis_client
+
+
+def init_sync_redis():
+  """Blocking client for code that runs in threads, e.g. the fingerprint shard queries."""
+  pool = sync_redis.BlockingConnectionPool(**_connection_kwargs())
+  return sync_redis.Redis.from_pool(pool)
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import metrics
+
+# How long a queued XADD/XACK may wait for others to share its pipeline
+REDIS_FLUSH_INTERVAL_MS = float(os.getenv("REDIS_FLUSH_INTERVAL_MS", "5"))
+# Commands per pipeline; a backlog this large is flushed without waiting
+REDIS_MAX_PIPELINE = int(os.getenv("REDIS_MAX_PIPELINE", "500"))
+
+
+class StreamWriter:
+    """
+    Coalesces the worker's result XADDs and XACKs into pipelines. Commands
+    are sent in the order they were queued, so an event's results always
+    reach Redis before its ACK. Callers await their command's flush.
+    """
+
+    def __init__(self, r, flush_interval_ms: float = REDIS_FLUSH_INTERVAL_MS, max_pipeline: int = REDIS_MAX_PIPELINE):
+        self.r = r
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pipeline = max_pipeline
+        self._queue = []
+        self._wakeup = asyncio.Event()
+        # One pipeline in flight at a time keeps commands in queue order
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.commands = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def xadd(self, stream: str, fields: dict):
+        return await self._enqueue("xadd", stream, fields)
+
+    async def ack(self, stream: str, group: str, msg_id: str):
+        return await self._enqueue("xack", stream, group, msg_id)
+
+    async def _enqueue(self, command, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((command, args, future))
+        self._wakeup.set()
+        if self._task is None:
+            # Not started (or already closed): don't leave the command waiting
+            await self.flush()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if len(self._queue) < self.max_pipeline:
+                await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            # Shielded so close() can't abandon a batch mid-pipeline
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        """Send everything queued so far in pipelines of at most max_pipeline commands."""
+        async with self._flush_lock:
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        while self._queue:
+            batch = self._queue[:self.max_pipeline]
+            del self._queue[:self.max_pipeline]
+            pipe = self.r.pipeline(transaction=False)
+            for command, args, _ in batch:
+                getattr(pipe, command)(*args)
+            try:
+                with metrics.stage("redis_publish"):
+                    results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.flushes += 1
+            self.commands += len(batch)
+            metrics.count("redis_publish", "commands", len(batch))
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def close(self):
+        """Stop the flush loop and send whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from bson import ObjectId
+import metrics
+from audio_landmarks import LANDMARK_RESULT_VERSION, landmarks_from_bytes
+from audio_fingerprint import AUDIO_FINGERPRINT_RESULT_VERSION
+from full_analysis import FULL_ANALYSIS_RESULT_VERSION
+from nsfw import NSFW_RESULT_VERSION
+from s3 import head_object, known_head
+from video_fingerprint import VIDEO_FINGERPRINT_RESULT_VERSION
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Bytes of results kept in this process (landmarks make up most of it), least recently used evicted first
+RESULT_CACHE_LRU_BYTES = int(os.getenv("RESULT_CACHE_LRU_BYTES", str(256 * 1024 ** 2)))
+# Lifetime of the shared Redis copy
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "result_cache")
+
+# The algorithm and settings each cached result depends on
+RESULT_VERSIONS = {
+    "nsfw_detection": NSFW_RESULT_VERSION,
+    "video_fingerprint": VIDEO_FINGERPRINT_RESULT_VERSION,
+    "audio_fingerprint": f"{AUDIO_FINGERPRINT_RESULT_VERSION}:{LANDMARK_RESULT_VERSION}",
+    "full_analysis": FULL_ANALYSIS_RESULT_VERSION,
+}
+
+# Rough per-entry overhead counted against RESULT_CACHE_LRU_BYTES besides the landmarks
+_ENTRY_BYTES = 512
+
+_MISS = object()
+
+
+def _hex(fingerprint):
+    return fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
+
+
+# analysis -> (result -> JSON-able without the landmarks, (JSON-able, landmarks) -> result).
+# JSON rather than pickle since Redis is shared.
+_CODECS = {
+    "nsfw_detection": (bool, lambda data, landmarks: bool(data)),
+    "video_fingerprint": (_hex, lambda data, landmarks: str(data)),
+    "audio_fingerprint": (
+        lambda result: {"fingerprint": _hex(result[0])},
+        lambda data, landmarks: (data["fingerprint"], landmarks),
+    ),
+    "full_analysis": (
+        lambda result: {
+            "fingerprint": _hex(result["fingerprint"]),
+            "is_nsfw": result["is_nsfw"],
+            "audio_fingerprint": _hex(result["audio_fingerprint"]),
+        },
+        lambda data, landmarks: {**data, "landmarks": landmarks, "errors": {}},
+    ),
+}
+
+
+def _landmarks(analysis, result):
+    if analysis == "audio_fingerprint":
+        return result[1]
+    if analysis == "full_analysis":
+        return result["landmarks"]
+    return None
+
+
+def _audio_fingerprint(analysis, data):
+    """The audio fingerprint in an encoded result, stored next to the landmarks it was computed with."""
+    return data["fingerprint"] if analysis == "audio_fingerprint" else data["audio_fingerprint"]
+
+
+def _entry_bytes(analysis, result) -> int:
+    landmarks = _landmarks(analysis, result)
+    return _ENTRY_BYTES + (0 if landmarks is None else landmarks.nbytes)
+
+
+def _cacheable(analysis, result) -> bool:
+    # A partial full analysis is retried rather than remembered
+    return not (analysis == "full_analysis" and result["errors"])
+
+
+def content_key(analysis: str, head: dict):
+    """Cache key for an S3 object's content from its HEAD response, or None if S3 gave no ETag."""
+    etag = head.get("ETag", "").strip('"')
+    if not etag:
+        return None
+    version = hashlib.sha256(RESULT_VERSIONS[analysis].encode()).hexdigest()[:16]
+    return f"{RESULT_CACHE_PREFIX}:{analysis}:{version}:{etag}:{head['ContentLength']}"
+
+
+class ResultCache:
+    """
+    Analysis results keyed by the S3 object's ETag and size plus the
+    analysis version, so re-uploads of identical bytes and retried events
+    skip the download and the decode. Lookups go to an in-process LRU, then
+    the Redis copy shared by every worker. Only a HEAD request is made for a
+    hit, and concurrent events for the same content share one computation.
+    Redis doesn't hold landmarks: it points at the video whose landmarks
+    document has them (collection is mongodb.landmark_collection) and a hit
+    reads them back.
+    Without a collection, results with landmarks stay in this process.
+    """
+
+    def __init__(self, r, collection=None, max_bytes: int = RESULT_CACHE_LRU_BYTES, ttl_seconds: int = RESULT_CACHE_TTL_SECONDS):
+        self.r = r
+        self.collection = collection
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+
+
+    def _remember(self, analysis, key, result):
+        size = _entry_bytes(analysis, result)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (result, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+
+    def _load_landmarks(self, video_id: str, audio_fingerprint: str):
+        """Landmarks stored for video_id, or None unless they were computed with this audio fingerprint."""
+        doc = self.collection.find_one({"_id": ObjectId(video_id)}, {"audio_fingerprint": 1, "landmarks": 1})
+        if not doc or doc.get("audio_fingerprint") != audio_fingerprint or not doc.get("landmarks"):
+            return None
+        return landmarks_from_bytes(doc["landmarks"])
+
+    async def get(self, analysis: str, key: str):
+        """The cached result, or _MISS."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            metrics.count("result_cache_memory", "hits")
+            return self._entries[key][0]
+        if self.r is None:
+            return _MISS
+        try:
+            with metrics.stage("result_cache_redis"):
+                value = await self.r.get(key)
+            if value is None:
+                return _MISS
+            value = json.loads(value)
+            landmarks = None
+            if value.get("landmarks_ref") is not None:
+                if self.collection is None:
+                    return _MISS
+                with metrics.stage("mongo_find"):
+                    landmarks = await asyncio.to_thread(
+                        self._load_landmarks, value["landmarks_ref"], _audio_fingerprint(analysis, value["result"])
+                    )
+                if landmarks is None:
+                    # The referenced video was deleted or re-fingerprinted
+                    return _MISS
+            result = _CODECS[analysis][1](value["result"], landmarks)
+        except Exception as e:
+            # Unreachable, malformed or from an older format: computed again and overwritten
+            print(f"⚠️ Result cache read failed: {e}")
+            return _MISS
+        self._remember(analysis, key, result)
+        metrics.count("result_cache_redis", "hits")
+        return result
+
+    async def put(self, analysis: str, key: str, result, video_id: str = None):
+        """Remember a result; video_id is the video the landmarks are stored for."""
+        self._remember(analysis, key, result)
+        if self.r is None:
+            return
+        value = {"result": _CODECS[analysis][0](result)}
+        if _landmarks(analysis, result) is not None:
+            if self.collection is None or not video_id:
+                return
+            value["landmarks_ref"] = str(video_id)
+        try:
+            await self.r.set(key, json.dumps(value), ex=self.ttl_seconds)
+        except Exception as e:
+            print(f"⚠️ Result cache write failed: {e}")
+
+    async def run(self, analysis: str, video_url: str, s3_client, compute, video_id: str = None):
+        """
+        Result of the coroutine function compute for this upload, reusing one for identical content.
+        video_id is the video the result's landmarks will be stored for.
+        """
+        if not RESULT_CACHE_ENABLED or analysis not in RESULT_VERSIONS:
+            return await compute()
+        bucket_name = os.getenv("AWS_S3_BUCKET")
+        try:
+            head = await asyncio.to_thread(head_object, s3_client, bucket_name, video_url)
+        except Exception as e:
+            # compute() reports the S3 problem with its usual error
+            print(f"⚠️ Result cache lookup skipped for {video_url}: {e}")
+            return await compute()
+        # compute() opens the object with this response instead of sending a second HEAD
+        with known_head(bucket_name, video_url, head):
+            return await self._run(analysis, content_key(analysis, head), compute, video_url, video_id)
+
+    async def _run(self, analysis, key, compute, video_url, video_id):
+        if key is None:
+            return await compute()
+
+        waiting = self._in_flight.get(key)
+        if waiting is not None:
+            try:
+                return await asyncio.shield(waiting)
+            except asyncio.CancelledError:
+                if not waiting.cancelled():
+                    raise
+                # The event computing it was cancelled, not this one
+                return await compute()
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting to retrieve a failure
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+        computed = False
+        try:
+            result = await self.get(analysis, key)
+            if result is _MISS:
+                metrics.count("result_cache", "misses")
+                result = await compute()
+                computed = True
+            else:
+                print(f"♻️ Reusing cached {analysis} result for {video_url}")
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._in_flight[key]
+        future.set_result(result)
+        if computed and _cacheable(analysis, result):
+            await self.put(analysis, key, result, video_id)
+        return result
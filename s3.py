@@ -1,7 +1,19 @@
 import boto3
 from botocore.exceptions import NoCredentialsError
 import os
+import contextvars
+import fcntl
+import socket
+import hashlib
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse
+import metrics
 
 def init_s3_client():
     """
@@ -50,4 +62,511 @@ def download_video_from_s3(video_url: str, video_id: str, temp_dir: str, s3_clie
         return input_file_path, input_file_name
         
     except Exception as e:
-        raise RuntimeError(f"Failed to download video from S3 (Bucket: {bucket_name}, Key: {video_url}): {e}")
\ No newline at end of file
+        raise RuntimeError(f"Failed to download video from S3 (Bucket: {bucket_name}, Key: {video_url}): {e}")
+
+# Empty (as in .env.example) uses the system temp dir rather than the working directory
+# HEAD response a caller already fetched for an object, so opening that object doesn't request it again
+_known_head = contextvars.ContextVar("known_head", default=None)
+
+
+@contextmanager
+def known_head(bucket_name: str, video_url: str, head: dict):
+    """Reuse head for this object inside the block, including threads started from it with asyncio.to_thread."""
+    token = _known_head.set((bucket_name, video_url, head))
+    try:
+        yield
+    finally:
+        _known_head.reset(token)
+
+
+def get_known_head():
+    """The (bucket_name, video_url, head) set by known_head, or None."""
+    return _known_head.get()
+
+
+def head_object(s3_client, bucket_name: str, video_url: str) -> dict:
+    """HEAD an S3 object, or return the response known_head provided for it."""
+    known = _known_head.get()
+    if known is not None and known[:2] == (bucket_name, video_url):
+        return known[2]
+    with metrics.stage("s3_head"):
+        return s3_client.head_object(Bucket=bucket_name, Key=video_url)
+
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "strmly_media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+
+
+def _open_locked(lock_path: str, flags: int):
+    """
+    Open and flock lock_path, retrying when it was unlinked (by an eviction) between the open and the
+    lock so every process locks the file currently at the path. Returns the fd, or None if a LOCK_NB
+    lock is held elsewhere.
+    """
+    while True:
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, flags)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock_fd).st_ino:
+                return lock_fd
+        except FileNotFoundError:
+            pass
+        os.close(lock_fd)
+
+
+class _CacheEntry:
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = 0
+        self.ready = threading.Event()
+        self.error = None
+        # Shared flock held while this process has readers, so other processes don't evict it
+        self.lock_fd = None
+
+
+class MediaCache:
+    """
+    Content-addressed local cache of S3 videos, keyed by bucket/key + ETag.
+    Concurrent readers of the same object share one in-flight download, and
+    files nobody is reading are evicted LRU once the cache exceeds max_bytes.
+    A per-file flock extends this to other worker processes sharing cache_dir,
+    and the size limit applies to the whole directory, whichever process
+    filled it (file mtimes are the shared LRU clock).
+    """
+
+    def __init__(self, cache_dir: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._drop_stale_parts()
+        with self._lock:
+            self._evict_locked()
+
+    def _drop_stale_parts(self):
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            # Other processes may share the directory, only drop abandoned downloads
+            if name.endswith(".part") and time.time() - os.path.getmtime(path) > 3600:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _scan(self):
+        """(files oldest first as [(mtime, path, size)], total bytes including downloads in progress)."""
+        files, total = [], 0
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if item.name.endswith(".lock"):
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                total += stat.st_size
+                if not item.name.endswith(".part"):
+                    files.append((stat.st_mtime, item.path, stat.st_size))
+        return sorted(files), total
+
+    def acquire(self, video_url: str, s3_client, bucket_name: str = None) -> tuple:
+        """
+        Return (cache_key, local_path) for the object, downloading it if needed.
+        Every acquire must be paired with release(cache_key).
+        """
+        bucket_name = bucket_name or os.getenv("AWS_S3_BUCKET")
+        try:
+            head = head_object(s3_client, bucket_name, video_url)
+        except Exception as e:
+            raise RuntimeError(f"Failed to download video from S3 (Bucket: {bucket_name}, Key: {video_url}): {e}")
+
+        etag = head.get("ETag", "").strip('"')
+        cache_key = hashlib.sha256(f"{bucket_name}/{video_url}:{etag}".encode()).hexdigest()
+        file_ext = os.path.splitext(video_url)[1] or '.mp4'
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                entry = _CacheEntry(os.path.join(self.cache_dir, f"{cache_key}{file_ext}"))
+                self._entries[cache_key] = entry
+            # The first reader in this process takes the file lock (and downloads if needed)
+            is_owner = entry.refs == 0
+            if is_owner:
+                entry.ready.clear()
+                entry.error = None
+            entry.refs += 1
+            self._entries.move_to_end(cache_key)
+
+        if is_owner:
+            self._fill(cache_key, entry, bucket_name, video_url, s3_client)
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                # The failed entry is already unmapped, a new acquire may have put another under cache_key
+                self._release_entry(entry)
+                raise entry.error
+            metrics.count("media_cache", "hits")
+        return cache_key, entry.path
+
+    def _fill(self, cache_key, entry, bucket_name, video_url, s3_client):
+        """Take the file lock, download the object unless another process already has, then hold a shared lock."""
+        lock_fd = None
+        lock_path = f"{entry.path}.lock"
+        try:
+            # A shared lock is enough to reuse a file another process downloaded, even while it reads it
+            lock_fd = _open_locked(lock_path, fcntl.LOCK_SH)
+            if not os.path.exists(entry.path):
+                os.close(lock_fd)
+                lock_fd = None
+                # Waits while another process downloads or evicts this object
+                lock_fd = _open_locked(lock_path, fcntl.LOCK_EX)
+            if not os.path.exists(entry.path):
+                part_path = f"{entry.path}.{uuid.uuid4().hex}.part"
+                try:
+                    with metrics.stage("s3_download"):
+                        s3_client.download_file(bucket_name, video_url, part_path)
+                    metrics.count("s3_download", "bytes", os.path.getsize(part_path))
+                    os.replace(part_path, entry.path)
+                finally:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                print(f"Successfully downloaded to {entry.path}")
+            else:
+                metrics.count("media_cache", "hits")
+                # Recently used, for every process's eviction order
+                os.utime(entry.path)
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        except Exception as e:
+            if lock_fd is not None:
+                os.close(lock_fd)
+            entry.error = RuntimeError(f"Failed to download video from S3 (Bucket: {bucket_name}, Key: {video_url}): {e}")
+            with self._lock:
+                if self._entries.get(cache_key) is entry:
+                    del self._entries[cache_key]
+            entry.ready.set()
+            raise entry.error
+
+        with self._lock:
+            entry.lock_fd = lock_fd
+            entry.ready.set()
+            self._evict_locked()
+
+    def release(self, cache_key: str):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._release_locked(entry)
+
+    def _release_entry(self, entry: _CacheEntry):
+        with self._lock:
+            self._release_locked(entry)
+
+    def _release_locked(self, entry: _CacheEntry):
+        entry.refs -= 1
+        if entry.refs == 0 and entry.lock_fd is not None:
+            os.close(entry.lock_fd)
+            entry.lock_fd = None
+        self._evict_locked()
+
+    def _evict_locked(self):
+        files, total = self._scan()
+        # Forget idle entries whose file another process evicted, the next acquire downloads it again
+        present = {path for _, path, _ in files}
+        for cache_key, entry in list(self._entries.items()):
+            if entry.refs == 0 and entry.ready.is_set() and entry.path not in present:
+                del self._entries[cache_key]
+        if total <= self.max_bytes:
+            return
+        by_path = {entry.path: (cache_key, entry) for cache_key, entry in self._entries.items()}
+        for _, path, size in files:
+            if total <= self.max_bytes:
+                break
+            cache_key, entry = by_path.get(path, (None, None))
+            if entry is not None and (entry.refs > 0 or not entry.ready.is_set()):
+                continue
+            lock_path = f"{path}.lock"
+            # Skip files another process is still reading or downloading
+            lock_fd = _open_locked(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock_fd is None:
+                continue
+            try:
+                if entry is not None:
+                    del self._entries[cache_key]
+                # Unlinked while held, so a process that opened the old lock file retries on the new one
+                for stale in (path, lock_path):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                total -= size
+            except OSError as e:
+                print(f"⚠️ Failed to evict {path}: {e}")
+            finally:
+                os.close(lock_fd)
+
+    @contextmanager
+    def open(self, video_url: str, s3_client, bucket_name: str = None):
+        """Context manager yielding the local path of a cached S3 video."""
+        cache_key, path = self.acquire(video_url, s3_client, bucket_name)
+        try:
+            yield path
+        finally:
+            self.release(cache_key)
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+
+
+def get_media_cache() -> MediaCache:
+    """Process-wide MediaCache, created on first use."""
+    global _media_cache
+    with _media_cache_lock:
+        if _media_cache is None:
+            _media_cache = MediaCache()
+        return _media_cache
+
+
+# "download" fetches the whole object into the media cache, "stream" lets ffmpeg read only the byte ranges it needs.
+# Override per analysis with S3_INGEST_MODE_<ANALYSIS>, e.g. S3_INGEST_MODE_VIDEO_FINGERPRINT=stream
+S3_INGEST_MODE = os.getenv("S3_INGEST_MODE", "download")
+# Analyses that decode the whole track (more than once) gain nothing from ranged reads, they stay on the
+# media cache unless their S3_INGEST_MODE_<ANALYSIS> says otherwise
+FULL_READ_ANALYSES = {"audio_fingerprint", "full_analysis"}
+# Ranged reads are made in aligned blocks. Each response starts with one block and doubles its readahead
+# up to S3_STREAM_MAX_READ_BYTES, so a reader that stops early (ffmpeg seeking) wastes little.
+S3_STREAM_BLOCK_BYTES = int(os.getenv("S3_STREAM_BLOCK_BYTES", str(64 * 1024)))
+S3_STREAM_MAX_READ_BYTES = int(os.getenv("S3_STREAM_MAX_READ_BYTES", str(4 * 1024 ** 2)))
+# Recently read blocks kept per open object, so the container header and index aren't re-fetched on every seek
+S3_STREAM_CACHE_BYTES = int(os.getenv("S3_STREAM_CACHE_BYTES", str(8 * 1024 ** 2)))
+
+
+def ingest_mode(analysis: str = None) -> str:
+    if analysis:
+        env_value = os.getenv(f"S3_INGEST_MODE_{analysis.upper()}")
+        if env_value:
+            return env_value
+        if analysis in FULL_READ_ANALYSES:
+            return "download"
+    return S3_INGEST_MODE
+
+
+def is_stream_url(path: str) -> bool:
+    """True for the http URLs handed out in stream mode (ffmpeg can read them, the filesystem can't)."""
+    return path.startswith(("http://", "https://"))
+
+
+def _parse_range(header: str, size: int):
+    """(start, end, partial) for a single-range "bytes=" header, None if it can't be satisfied."""
+    if not header:
+        return (0, size - 1, False) if size else None
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end, True
+
+
+class _StreamedObject:
+    def __init__(self, s3_client, bucket_name: str, key: str, size: int, etag: str, content_type: str):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+        self.bytes_fetched = 0
+        self.range_requests = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_block(self, index: int):
+        with self._lock:
+            data = self._blocks.get(index)
+            if data is not None:
+                self._blocks.move_to_end(index)
+            return data
+
+    def _fetch_blocks(self, first: int, last: int):
+        """One ranged GET for blocks first..last; returns [(index, bytes), ...] and caches them."""
+        block = S3_STREAM_BLOCK_BYTES
+        start, end = first * block, min(self.size, (last + 1) * block) - 1
+        # IfMatch keeps every range of one analysis on the same object version
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}", IfMatch=self.etag
+        )
+        data = response["Body"].read()
+        if len(data) != end - start + 1:
+            raise RuntimeError(f"Short read of {self.key} bytes {start}-{end}: got {len(data)}")
+        blocks = [(first + i, data[i * block:(i + 1) * block]) for i in range(last - first + 1)]
+        with self._lock:
+            self.bytes_fetched += len(data)
+            self.range_requests += 1
+            for index, block_data in blocks:
+                self._blocks[index] = block_data
+                self._blocks.move_to_end(index)
+            while len(self._blocks) * block > S3_STREAM_CACHE_BYTES:
+                self._blocks.popitem(last=False)
+        return blocks
+
+    def copy_range(self, start: int, end: int, out):
+        """Write bytes start..end (inclusive) to out, from cached blocks or ranged GETs."""
+        block = S3_STREAM_BLOCK_BYTES
+        max_window = max(1, S3_STREAM_MAX_READ_BYTES // block)
+        window = 1
+        position = start
+        while position <= end:
+            first = position // block
+            data = self._cached_block(first)
+            if data is not None:
+                blocks = [(first, data)]
+            else:
+                blocks = self._fetch_blocks(first, min(end // block, first + window - 1))
+                window = min(window * 2, max_window)
+            for index, data in blocks:
+                piece = data[position - index * block:end - index * block + 1]
+                out.write(piece)
+                position += len(piece)
+
+
+class _RangeRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so ffmpeg's seeks reuse one connection
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # A small send buffer makes writes block while the reader isn't consuming, so readahead only
+        # grows as fast as ffmpeg reads and little is in flight when it hangs up
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, S3_STREAM_BLOCK_BYTES)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        obj = self.server.proxy.lookup(self.path)
+        if obj is None:
+            self.send_error(404)
+            return
+        byte_range = _parse_range(self.headers.get("Range"), obj.size)
+        if byte_range is None:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{obj.size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end, partial = byte_range
+        self.send_response(206 if partial else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", obj.content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{obj.size}")
+        self.end_headers()
+        if not send_body:
+            return
+        try:
+            obj.copy_range(start, end, self.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg closes the connection when it seeks or has read enough
+            self.close_connection = True
+        except Exception as e:
+            print(f"⚠️ Ranged read of {obj.key} failed: {e}")
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class S3RangeProxy:
+    """
+    Local HTTP server that serves S3 objects with byte-range support, so
+    ffmpeg/OpenCV can read a video in place: only the ranges the decoder
+    asks for are fetched, and the bytes fetched are counted per open().
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._objects = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _RangeRequestHandler)
+        self._server.daemon_threads = True
+        self._server.proxy = self
+        self.host, self.port = self._server.server_address[:2]
+        threading.Thread(target=self._server.serve_forever, name="s3-range-proxy", daemon=True).start()
+
+    def lookup(self, path: str):
+        token = path.lstrip("/").split("/", 1)[0]
+        with self._lock:
+            return self._objects.get(token)
+
+    @contextmanager
+    def open(self, video_url: str, s3_client, bucket_name: str = None):
+        """Context manager yielding an http URL for the S3 video, valid until it exits."""
+        bucket_name = bucket_name or os.getenv("AWS_S3_BUCKET")
+        try:
+            head = head_object(s3_client, bucket_name, video_url)
+        except Exception as e:
+            raise RuntimeError(f"Failed to open video from S3 (Bucket: {bucket_name}, Key: {video_url}): {e}")
+
+        obj = _StreamedObject(
+            s3_client, bucket_name, video_url, head["ContentLength"], head.get("ETag", ""),
+            head.get("ContentType", "application/octet-stream"),
+        )
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._objects[token] = obj
+        try:
+            # Keeping the file name lets ffmpeg probe the container from the extension
+            yield f"http://{self.host}:{self.port}/{token}/{os.path.basename(video_url)}"
+        finally:
+            with self._lock:
+                del self._objects[token]
+            metrics.count("s3_stream", "bytes", obj.bytes_fetched)
+            metrics.count("s3_stream", "requests", obj.range_requests)
+            share = obj.bytes_fetched / obj.size if obj.size else 0
+            print(f"📶 Streamed {obj.bytes_fetched} of {obj.size} bytes ({share:.0%}) in {obj.range_requests} ranged GETs for {video_url}")
+
+
+_range_proxy = None
+_range_proxy_lock = threading.Lock()
+
+
+def get_range_proxy() -> S3RangeProxy:
+    """Process-wide S3RangeProxy, started on first use."""
+    global _range_proxy
+    with _range_proxy_lock:
+        if _range_proxy is None:
+            _range_proxy = S3RangeProxy()
+        return _range_proxy
+
+
+def open_media(video_url: str, s3_client, analysis: str = None):
+    """
+    Context manager yielding something ffmpeg can read for an S3 video: a
+    local media cache path ("download") or a range-served URL ("stream").
+    """
+    mode = ingest_mode(analysis)
+    if mode == "download":
+        return get_media_cache().open(video_url, s3_client)
+    if mode == "stream":
+        return get_range_proxy().open(video_url, s3_client)
+    raise ValueError(f"Invalid S3_INGEST_MODE: {mode}")
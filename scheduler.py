@@ -0,0 +1,221 @@
+import asyncio
+import os
+import time
+from collections import Counter, deque
+import metrics
+from lanes import DEFAULT_LANE, Lane
+
+# Events read from the stream but not finished yet (queued + in flight)
+MAX_PENDING_EVENTS = int(os.getenv("MAX_PENDING_EVENTS", "16"))
+# Per event type cap, override with MAX_CONCURRENCY_<EVENT_TYPE>, e.g. MAX_CONCURRENCY_NSFW_DETECTION=2
+MAX_CONCURRENCY_DEFAULT = int(os.getenv("MAX_CONCURRENCY_DEFAULT", "2"))
+DEFAULT_EVENT_CONCURRENCY = {
+    "nsfw_detection": 2,
+    "video_fingerprint": 4,
+    "audio_fingerprint": 4,
+    "full_analysis": 2,
+}
+
+
+def concurrency_limit(event_type: str) -> int:
+    env_value = os.getenv(f"MAX_CONCURRENCY_{event_type.upper()}")
+    if env_value:
+        return int(env_value)
+    return DEFAULT_EVENT_CONCURRENCY.get(event_type, MAX_CONCURRENCY_DEFAULT)
+
+
+class FairSlots:
+    """
+    Concurrency slots for one event type, handed to waiting lanes by
+    weighted fair queueing: each grant advances the lane's virtual time by
+    1 / weight and the backlogged lane with the lowest virtual time goes
+    next. A lane whose oldest waiter is past its SLO deadline goes before
+    lanes that are on time.
+    """
+
+    def __init__(self, limit: int, lanes: dict):
+        self.free = limit
+        self.lanes = lanes
+        self._waiters = {}
+        self._virtual = Counter()
+        self._clock = 0.0
+
+    def _charge(self, lane):
+        start = max(self._virtual[lane], self._clock)
+        self._clock = start
+        self._virtual[lane] = start + 1 / self.lanes[lane].weight
+
+    async def acquire(self, lane: str, deadline: float):
+        if self.free and not any(self._waiters.values()):
+            self.free -= 1
+            self._charge(lane)
+            return
+        waiters = self._waiters.setdefault(lane, deque())
+        if not waiters:
+            # Back from idle: no credit for the time it had nothing waiting
+            self._virtual[lane] = max(self._virtual[lane], self._clock)
+        future = asyncio.get_running_loop().create_future()
+        waiters.append((future, deadline))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if (future, deadline) in waiters:
+                    waiters.remove((future, deadline))
+            else:
+                # Granted just as it was cancelled, pass the slot on
+                self.release()
+            raise
+
+    def release(self):
+        self.free += 1
+        while self.free:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            future, _ = self._waiters[lane].popleft()
+            if future.done():
+                continue
+            self.free -= 1
+            self._charge(lane)
+            future.set_result(None)
+
+    def _next_lane(self):
+        backlogged = [lane for lane, waiters in self._waiters.items() if waiters]
+        if not backlogged:
+            return None
+        now = time.time()
+        overdue = [lane for lane in backlogged if self._waiters[lane][0][1] is not None and self._waiters[lane][0][1] < now]
+        return min(overdue or backlogged, key=lambda lane: self._virtual[lane])
+
+
+class EventScheduler:
+    """
+    Runs event handlers with a concurrency cap per event type and a cap on
+    the total number of pending events, so the reader can stop pulling from
+    the stream while the worker is saturated. With several lanes, each lane
+    gets a weighted share of the pending cap to read into, and an event
+    type's slots go to the lanes by weighted fair queueing.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_EVENTS, lanes=None):
+        self.max_pending = max_pending
+        self.lanes = {lane.name: lane for lane in lanes or [Lane(DEFAULT_LANE)]}
+        total_weight = sum(lane.weight for lane in self.lanes.values())
+        self._lane_capacity = {
+            name: max(1, int(max_pending * lane.weight / total_weight)) for name, lane in self.lanes.items()
+        }
+        self._slots = {}
+        self._queued = Counter()
+        self._in_flight = Counter()
+        self._lane_pending = Counter()
+        self._slo_misses = Counter()
+        self._tasks = set()
+        self._capacity_freed = asyncio.Event()
+
+    def _event_slots(self, event_type):
+        if event_type not in self._slots:
+            self._slots[event_type] = FairSlots(concurrency_limit(event_type), self.lanes)
+        return self._slots[event_type]
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def free_capacity(self, lane: str = None) -> int:
+        """Events that can be accepted, in total or into one lane's share."""
+        free = max(0, self.max_pending - len(self._tasks))
+        if lane is None:
+            return free
+        return min(free, max(0, self._lane_capacity[lane] - self._lane_pending[lane]))
+
+    async def wait_for_capacity(self, timeout: float = None) -> bool:
+        """Wait until at least one more event can be accepted. Returns False on timeout."""
+        while self.free_capacity() == 0:
+            self._capacity_freed.clear()
+            try:
+                await asyncio.wait_for(self._capacity_freed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def submit(self, event_type: str, coro, lane: str = DEFAULT_LANE, enqueued_at: float = None) -> asyncio.Task:
+        """
+        Schedule a handler coroutine; it starts once its event type grants its lane a slot. The task returns
+        its result. enqueued_at (unix seconds, defaults to now) is when the event entered the stream.
+        """
+        if lane not in self.lanes:
+            raise ValueError(f"❌ Unknown lane '{lane}'")
+        enqueued_at = time.time() if enqueued_at is None else enqueued_at
+        task = asyncio.create_task(self._run(event_type, coro, lane, enqueued_at))
+        self._tasks.add(task)
+        self._lane_pending[lane] += 1
+        task.add_done_callback(lambda task: self._on_done(task, lane))
+        return task
+
+    async def _run(self, event_type, coro, lane, enqueued_at):
+        self._queued[event_type] += 1
+        slo_seconds = self.lanes[lane].slo_seconds
+        started = False
+        try:
+            slots = self._event_slots(event_type)
+            await slots.acquire(lane, None if slo_seconds is None else enqueued_at + slo_seconds)
+            try:
+                self._queued[event_type] -= 1
+                self._in_flight[event_type] += 1
+                started = True
+                self._record_wait(lane, event_type, time.time() - enqueued_at)
+                return await coro
+            finally:
+                if started:
+                    self._in_flight[event_type] -= 1
+                slots.release()
+        finally:
+            if not started:
+                self._queued[event_type] -= 1
+                coro.close()
+
+    def _record_wait(self, lane, event_type, wait_seconds):
+        slo_seconds = self.lanes[lane].slo_seconds
+        missed = slo_seconds is not None and wait_seconds > slo_seconds
+        if missed:
+            self._slo_misses[lane] += 1
+        if metrics.METRICS_ENABLED:
+            metrics.LANE_WAIT_SECONDS.observe(max(0.0, wait_seconds), lane=lane, event_type=event_type)
+            if missed:
+                metrics.LANE_SLO_MISSES.inc(lane=lane, event_type=event_type)
+
+    def _on_done(self, task, lane):
+        self._tasks.discard(task)
+        self._lane_pending[lane] -= 1
+        self._capacity_freed.set()
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ Event task failed: {task.exception()}")
+
+    async def drain(self, timeout: float = None):
+        """Wait for pending events to finish, cancelling whatever is left after timeout."""
+        if not self._tasks:
+            return
+        print(f"⏳ Draining {len(self._tasks)} pending events...")
+        done, still_pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in still_pending:
+            task.cancel()
+        if still_pending:
+            await asyncio.gather(*still_pending, return_exceptions=True)
+            print(f"⚠️ Cancelled {len(still_pending)} events that did not finish in time")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._tasks),
+            "max_pending": self.max_pending,
+            "queued": {k: v for k, v in self._queued.items() if v},
+            "in_flight": {k: v for k, v in self._in_flight.items() if v},
+            "lanes": {
+                name: {
+                    "pending": self._lane_pending[name],
+                    "capacity": self._lane_capacity[name],
+                    "slo_misses": self._slo_misses[name],
+                }
+                for name in self.lanes
+            },
+        }
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import socket
+import uuid
+
+# Entries pending longer than this without a heartbeat are assumed lost and reclaimed
+VISIBILITY_TIMEOUT_SECONDS = float(os.getenv("REDIS_VISIBILITY_TIMEOUT_SECONDS", "300"))
+# In-flight entries are re-claimed by their own consumer this often so they never look idle
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("REDIS_HEARTBEAT_INTERVAL_SECONDS", "60"))
+RECLAIM_INTERVAL_SECONDS = float(os.getenv("REDIS_RECLAIM_INTERVAL_SECONDS", "30"))
+# Entries delivered more than this many times go to the dead-letter stream instead
+MAX_DELIVERIES = int(os.getenv("REDIS_MAX_DELIVERIES", "5"))
+# Consumers with nothing pending that have been idle this long are removed from the group
+IDLE_CONSUMER_SECONDS = float(os.getenv("REDIS_IDLE_CONSUMER_SECONDS", "3600"))
+
+
+def consumer_name() -> str:
+    """REDIS_CONSUMER_NAME if set, otherwise a name unique to this process."""
+    return os.getenv("REDIS_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class PendingReclaimer:
+    """
+    Keeps a consumer group's pending entries moving when consumers die:
+    heartbeats the entries this consumer is working on, XAUTOCLAIMs entries
+    other consumers left idle past the visibility timeout, dead-letters
+    entries that keep failing and removes consumers that are gone.
+    """
+
+    def __init__(self, r, stream: str, group: str, consumer: str, dead_letter_stream: str = None):
+        self.r = r
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer
+        self.dead_letter_stream = dead_letter_stream or f"{stream}:dead"
+        self._in_flight = set()
+        self._cursor = "0-0"
+
+    def track(self, msg_id: str, task: asyncio.Task):
+        """Heartbeat msg_id until its handler task finishes."""
+        self._in_flight.add(msg_id)
+        task.add_done_callback(lambda _: self._in_flight.discard(msg_id))
+
+    async def heartbeat(self):
+        if not self._in_flight:
+            return
+        # JUSTID resets the idle time without counting as a delivery
+        await self.r.xclaim(self.stream, self.group, self.consumer, 0, list(self._in_flight), justid=True)
+
+    async def reclaim(self, count: int):
+        """
+        Claim up to count entries idle past the visibility timeout.
+        Returns [(msg_id, fields), ...] to process; over-delivered entries are dead-lettered.
+        """
+        if count <= 0:
+            return []
+        self._cursor, claimed, *_ = await self.r.xautoclaim(
+            self.stream, self.group, self.consumer,
+            int(VISIBILITY_TIMEOUT_SECONDS * 1000), self._cursor, count=count,
+        )
+        # Entries deleted from the stream come back without fields and are dropped from the PEL by Redis
+        claimed = [(msg_id, data) for msg_id, data in claimed if data is not None]
+        if not claimed:
+            return []
+
+        pending = await self.r.xpending_range(
+            self.stream, self.group, claimed[0][0], claimed[-1][0], len(claimed), consumername=self.consumer
+        )
+        deliveries = {p["message_id"]: p["times_delivered"] for p in pending}
+        dead = [(msg_id, data) for msg_id, data in claimed if deliveries.get(msg_id, 0) > MAX_DELIVERIES]
+        if dead:
+            pipe = self.r.pipeline(transaction=False)
+            for msg_id, data in dead:
+                pipe.xadd(self.dead_letter_stream, {
+                    **data,
+                    "originalId": msg_id,
+                    "deliveries": deliveries[msg_id],
+                    "lastConsumer": self.consumer,
+                })
+                pipe.xack(self.stream, self.group, msg_id)
+            await pipe.execute()
+            print(f"☠️ Moved {len(dead)} entries to '{self.dead_letter_stream}' after {MAX_DELIVERIES} deliveries")
+
+        dead_ids = {msg_id for msg_id, _ in dead}
+        live = [(msg_id, data) for msg_id, data in claimed if msg_id not in dead_ids]
+        if live:
+            print(f"♻️ Reclaimed {len(live)} idle entries")
+        return live
+
+    async def remove_idle_consumers(self):
+        for info in await self.r.xinfo_consumers(self.stream, self.group):
+            if info["name"] == self.consumer or info["pending"]:
+                continue
+            if info["idle"] > IDLE_CONSUMER_SECONDS * 1000:
+                await self.r.xgroup_delconsumer(self.stream, self.group, info["name"])
+                print(f"🧹 Removed idle consumer '{info['name']}'")
+
+    async def run_heartbeats(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                print(f"⚠️ Pending entry heartbeat failed: {e}")
+
+    async def run(self, scheduler, submit, lane: str = None):
+        """
+        Periodically reclaim idle entries (within the scheduler's free capacity, or the lane's share of it)
+        and hand them to submit(msg_id, fields).
+        """
+        while True:
+            await asyncio.sleep(RECLAIM_INTERVAL_SECONDS)
+            try:
+                for msg_id, data in await self.reclaim(scheduler.free_capacity(lane)):
+                    submit(msg_id, data)
+                await self.remove_idle_consumers()
+            except Exception as e:
+                print(f"⚠️ Pending entry reclaim failed: {e}")
@@ -1,30 +1,159 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import os
+from dotenv import load_dotenv
+
+# Before the project imports: their settings are module constants read at import time
+load_dotenv()
+
 from nsfw import detect_nsfw_video
-from video_fingerprint import fingerprint_video,compare_hamming_distance
-from audio_fingerprint import fingerprint_audio
+from video_fingerprint import fingerprint_video
+from audio_fingerprint import analyze_audio
+from full_analysis import analyze_video
+from executor import AnalysisExecutor
+from scheduler import EventScheduler
+from result_cache import ResultCache
+from fingerprint_index import pack_fingerprint
+from fingerprint_shard import FingerprintShardsUnavailable
+from mongodb import connect_database, landmark_collection
+from redis_client import init_redis
+from s3 import init_s3_client
+import main
+
+# Videos accepted by one /api/v1/analyze-batch request
+API_MAX_BATCH_VIDEOS = int(os.getenv("API_MAX_BATCH_VIDEOS", "100"))
+# Analyses queued or running for HTTP requests; past this new requests get a 503. A batch needing more
+# than this (videos x analyses) gets a 413, so the default covers API_MAX_BATCH_VIDEOS x every analysis.
+API_MAX_PENDING = int(os.getenv("API_MAX_PENDING", "512"))
+
+
+def _hex(fingerprint):
+    return fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
+
+
+# analysis -> (function, its video arguments, JSON fields for its result)
+ANALYSES = {
+    "nsfw_detection": (
+        detect_nsfw_video, lambda v: (v.videoUrl, v.videoId),
+        lambda is_nsfw: {"is_nsfw": is_nsfw},
+    ),
+    "video_fingerprint": (
+        fingerprint_video, lambda v: (v.videoId, v.videoUrl),
+        lambda fingerprint: {"video_fingerprint": _hex(fingerprint)},
+    ),
+    "audio_fingerprint": (
+        analyze_audio, lambda v: (v.videoUrl, v.videoId),
+        lambda result: {"audio_fingerprint": _hex(result[0]), "landmarks": len(result[1])},
+    ),
+    "full_analysis": (
+        analyze_video, lambda v: (v.videoUrl, v.videoId),
+        lambda result: {
+            "video_fingerprint": _hex(result["fingerprint"]),
+            "is_nsfw": result["is_nsfw"],
+            "audio_fingerprint": _hex(result["audio_fingerprint"]),
+            "landmarks": None if result["landmarks"] is None else len(result["landmarks"]),
+            "errors": result["errors"],
+        },
+    ),
+}
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the same executor, scheduler and result cache the worker uses, plus the indexes for /compare."""
+    app.state.s3_client = init_s3_client()
+    app.state.executor = AnalysisExecutor()
+    await asyncio.to_thread(app.state.executor.start)
+    app.state.scheduler = EventScheduler(max_pending=API_MAX_PENDING)
+    r = await init_redis() if os.getenv("REDIS_HOST") else None
+    app.state.indexes = {}
+    client, long_video_collection, shard_redis, tasks = None, None, None, []
+    if os.getenv("MONGODB_URI"):
+        client, long_video_collection, _, _ = connect_database()
+        video_index, audio_index, tasks, shard_redis = await main.open_fingerprint_indexes(long_video_collection)
+        app.state.indexes = {"video": video_index, "audio": audio_index}
+    # Shares cached results with the workers when Redis is configured
+    landmarks = None if long_video_collection is None else landmark_collection(long_video_collection)
+    app.state.result_cache = ResultCache(r, landmarks)
+    try:
+        yield
+    finally:
+        await app.state.scheduler.drain(main.SHUTDOWN_DRAIN_SECONDS)
+        for task in tasks:
+            task.cancel()
+        await asyncio.to_thread(app.state.executor.shutdown)
+        if r is not None:
+            await r.aclose()
+        if shard_redis is not None:
+            shard_redis.close()
+        if client is not None:
+            client.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class VideoRequest(BaseModel):
     videoUrl: str
     videoId: str
 
- 
+
+class BatchRequest(BaseModel):
+    videos: List[VideoRequest]
+    analyses: List[str] = ["nsfw_detection", "video_fingerprint", "audio_fingerprint"]
+
+
+class CompareRequest(BaseModel):
+    fingerprint: str
+    # "video" or "audio"
+    type: str = "video"
+    threshold: Optional[int] = None
+    excludeVideoId: Optional[str] = None
+
+
+def _check_capacity(needed: int = 1):
+    if app.state.scheduler.free_capacity() < needed:
+        raise HTTPException(status_code=503, detail="Too many analyses pending, retry later")
+
+
+async def run_analysis(analysis: str, video: VideoRequest):
+    """Run one analysis on the worker's executor, under the scheduler's per-type concurrency cap."""
+    func, video_args, _ = ANALYSES[analysis]
+    s3_client = app.state.s3_client
+    compute = lambda: app.state.executor.run(analysis, func, *video_args(video), s3_client=s3_client)
+    # No video_id: the API doesn't store landmarks, so results with them aren't shared through Redis
+    return await app.state.scheduler.submit(analysis, app.state.result_cache.run(analysis, video.videoUrl, s3_client, compute))
+
+
+def query_index(index_type: str, fingerprint_hex: str, threshold: int = None, exclude_id: str = None):
+    """Matches for a fingerprint in the loaded index, closest first."""
+    index = app.state.indexes.get(index_type)
+    if index is None:
+        raise HTTPException(status_code=503, detail="Fingerprint index not loaded (MONGODB_URI unset)")
+    try:
+        matches = index.query(fingerprint_hex, main.FINGERPRINT_MATCH_THRESHOLD if threshold is None else threshold, exclude_id)
+    except FingerprintShardsUnavailable as e:
+        print(e)
+        raise HTTPException(status_code=503, detail="Fingerprint index unavailable")
+    return sorted(matches, key=lambda m: m[1])
 
 
 @app.get("/health-check")
 async def healthCheck():
-    return {"message": "ok"}
+    return {"message": "ok", "scheduler": app.state.scheduler.stats()}
 
 
 @app.post("/api/v1/detect-nsfw")
 async def detect_nsfw_endpoint(request: VideoRequest):
+    _check_capacity()
     try:
-        is_nsfw=detect_nsfw_video(request.videoUrl,request.videoId)
- 
+        is_nsfw = await run_analysis("nsfw_detection", request)
+
         return {
             "videoId": request.videoId,
             "videoUrl":request.videoUrl,
@@ -41,10 +170,10 @@ async def detect_nsfw_endpoint(request: VideoRequest):
 
 @app.post("/api/v1/fingerprint-video")
 async def generate_video_fingerprint_endpoint(request: VideoRequest):
+    _check_capacity()
     try:
-        fingerprint = fingerprint_video(request.videoId, request.videoUrl)
-        fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
-        is_duplicate=compare_hamming_distance("df88e6d0cc9a1a1c1cc9c0bf4e3e8a8b4f53b61826320eb5cb32d2e2eebc9a74",fingerprint_hex)
+        fingerprint = await run_analysis("video_fingerprint", request)
+        fingerprint_hex = _hex(fingerprint)
         return {
             "videoId": request.videoId,
             "videoUrl": request.videoUrl,
@@ -60,10 +189,15 @@ async def generate_video_fingerprint_endpoint(request: VideoRequest):
 
 @app.post("/api/v1/fingerprint-audio")
 async def fingerprint_audio_endpoint(request: VideoRequest):
+    _check_capacity()
     try:
-        fingerprint=fingerprint_audio(request.videoUrl,request.videoId)
-        fingerprint_hex = fingerprint.hex() if isinstance(fingerprint, bytes) else fingerprint
-        is_duplicate=compare_hamming_distance("df88e6d0cc9a1a1c1cc9c0bf4e3e8a8b4f53b61826320eb5cb32d2e2eebc9a74",fingerprint_hex)
+        fingerprint, _ = await run_analysis("audio_fingerprint", request)
+        fingerprint_hex = _hex(fingerprint)
+        # None when no index is loaded
+        is_duplicate = None
+        if "audio" in app.state.indexes:
+            matches = await asyncio.to_thread(query_index, "audio", fingerprint_hex, None, request.videoId)
+            is_duplicate = bool(matches)
         return {
             "videoId": request.videoId,
             "videoUrl": request.videoUrl,
@@ -71,6 +205,63 @@ async def fingerprint_audio_endpoint(request: VideoRequest):
             "is_duplicate":is_duplicate
         }
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         print(e)
-        raise HTTPException(status_code=500, detail=str("Internal Server Error"))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str("Internal Server Error"))
+
+
+@app.post("/api/v1/analyze-batch")
+async def analyze_batch_endpoint(request: BatchRequest):
+    """Run the analyses on every video, streaming one NDJSON line per (video, analysis) as each finishes."""
+    unknown = [a for a in request.analyses if a not in ANALYSES]
+    if unknown or not request.analyses:
+        raise HTTPException(status_code=422, detail=f"Unknown analyses: {unknown}, expected some of {list(ANALYSES)}")
+    if len(request.videos) > API_MAX_BATCH_VIDEOS:
+        raise HTTPException(status_code=413, detail=f"At most {API_MAX_BATCH_VIDEOS} videos per batch")
+    jobs = len(request.videos) * len(request.analyses)
+    if jobs > API_MAX_PENDING:
+        # Could never be admitted, even on an idle server
+        raise HTTPException(status_code=413, detail=f"At most {API_MAX_PENDING} videos x analyses per batch")
+    _check_capacity(jobs)
+
+    async def job(video: VideoRequest, analysis: str):
+        line = {"videoId": video.videoId, "videoUrl": video.videoUrl, "analysis": analysis}
+        try:
+            result = await run_analysis(analysis, video)
+            line.update(ANALYSES[analysis][2](result))
+        except Exception as e:
+            print(e)
+            line["error"] = "Internal Server Error"
+        return line
+
+    # Scheduled before the response starts, so nothing waits on the client reading
+    tasks = [asyncio.create_task(job(video, analysis)) for video in request.videos for analysis in request.analyses]
+
+    async def stream():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # The client went away: stop what hasn't started
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/v1/compare")
+def compare_endpoint(request: CompareRequest):
+    """Check a fingerprint against the in-memory index. Sync, so FastAPI runs it in its threadpool."""
+    if request.type not in ("video", "audio"):
+        raise HTTPException(status_code=422, detail="type must be 'video' or 'audio'")
+    if pack_fingerprint(request.fingerprint) is None:
+        raise HTTPException(status_code=422, detail="fingerprint must be a 256-bit hex string")
+    matches = query_index(request.type, request.fingerprint, request.threshold, request.excludeVideoId)
+    return {
+        "type": request.type,
+        "fingerprint": request.fingerprint,
+        "is_duplicate": bool(matches),
+        "matches": [{"videoId": video_id, "distance": distance} for video_id, distance in matches],
+    }
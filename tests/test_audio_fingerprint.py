@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip("librosa")
+
+from audio_fingerprint import HOP_LENGTH, N_FFT, N_MFCC, streaming_mfcc_mean
+
+SAMPLE_RATE = 16000
+
+
+@pytest.fixture
+def audio():
+    rng = np.random.default_rng(9)
+    t = np.arange(SAMPLE_RATE * 5) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 330 * t) + 0.2 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def whole_signal_mfcc_mean(samples):
+    mel = librosa.feature.melspectrogram(y=samples, sr=SAMPLE_RATE, n_fft=N_FFT, hop_length=HOP_LENGTH, center=False)
+    mfcc = librosa.feature.mfcc(S=librosa.power_to_db(mel, top_db=None), n_mfcc=N_MFCC)
+    return mfcc.mean(axis=1)
+
+
+@pytest.mark.parametrize("chunk", [N_FFT - 1, 5000, SAMPLE_RATE, SAMPLE_RATE * 10])
+def test_streaming_matches_whole_signal(audio, chunk):
+    chunks = (audio[i:i + chunk] for i in range(0, len(audio), chunk))
+    streamed = streaming_mfcc_mean(chunks, SAMPLE_RATE)
+    assert streamed.dtype == np.float32
+    np.testing.assert_allclose(streamed, whole_signal_mfcc_mean(audio), rtol=1e-4, atol=1e-3)
+
+
+def test_shorter_than_one_window_is_padded(audio):
+    short = audio[:N_FFT // 2]
+    expected = whole_signal_mfcc_mean(np.pad(short, (0, N_FFT - len(short))))
+    np.testing.assert_allclose(streaming_mfcc_mean([short], SAMPLE_RATE), expected, rtol=1e-4, atol=1e-3)
+
+
+def test_no_audio_raises():
+    with pytest.raises(ValueError):
+        streaming_mfcc_mean([np.zeros(0, dtype=np.float32)], SAMPLE_RATE)
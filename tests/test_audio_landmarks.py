@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+import mongomock
+import numpy as np
+import pytest
+from bson import Binary, ObjectId
+import audio_landmarks
+from audio_landmarks import (
+    LANDMARK_SAMPLE_RATE, LandmarkIndex, LandmarkSnapshotSync, extract_landmarks, landmarks_from_bytes,
+    landmarks_to_bytes,
+)
+from mongodb import landmark_collection
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def random_landmarks(rng, n=400):
+    return np.stack([
+        rng.integers(0, 1 << 20, n, dtype=np.uint32),
+        np.sort(rng.integers(0, 5000, n)).astype(np.uint32),
+    ], axis=1)
+
+
+def clip(landmarks, shift=7):
+    """Landmarks of a partial clip starting `shift` frames into a different position."""
+    part = landmarks[100:300].copy()
+    part[:, 1] += shift
+    return part
+
+
+def store(collection, video_id, landmarks, written_at):
+    collection.update_one(
+        {"_id": ObjectId(video_id)},
+        {"$set": {"landmarks": None if landmarks is None else Binary(landmarks_to_bytes(landmarks)),
+                  "landmarks_updated_at": written_at}},
+        upsert=True,
+    )
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(5)
+    collection = landmark_collection(mongomock.MongoClient().db.longvideos)
+    landmarks = {str(ObjectId()): random_landmarks(rng) for _ in range(40)}
+    for video_id, video_landmarks in landmarks.items():
+        store(collection, video_id, video_landmarks, NOW - timedelta(hours=1))
+    return collection, landmarks, rng
+
+
+def test_bytes_round_trip():
+    landmarks = np.array([[1, 2], [3, 4]], dtype=np.uint32)
+    assert np.array_equal(landmarks_from_bytes(landmarks_to_bytes(landmarks)), landmarks)
+
+
+def test_extraction_does_not_depend_on_chunking():
+    rng = np.random.default_rng(0)
+    t = np.arange(LANDMARK_SAMPLE_RATE * 20) / LANDMARK_SAMPLE_RATE
+    audio = (np.sin(2 * np.pi * 440 * t * (1 + t / 40)) + 0.3 * rng.standard_normal(len(t))).astype(np.float32)
+    whole = extract_landmarks([audio])
+    assert len(whole) > 100
+    for size in (1000, 4096, 77777):
+        chunked = extract_landmarks(audio[i:i + size] for i in range(0, len(audio), size))
+        assert np.array_equal(chunked, whole)
+
+
+def test_finds_partial_clip(catalog):
+    collection, landmarks, _ = catalog
+    index = LandmarkIndex()
+    index.load(collection)
+    video_id = next(iter(landmarks))
+    matches = index.query(clip(landmarks[video_id]))
+    assert matches[0][0] == video_id
+    assert index.query(clip(landmarks[video_id]), exclude_id=video_id) == matches[1:]
+
+
+def test_snapshot_matches_memory(catalog, tmp_path):
+    collection, landmarks, rng = catalog
+    memory = LandmarkIndex()
+    memory.load(collection)
+    mapped = LandmarkIndex()
+    LandmarkSnapshotSync(collection, mapped, str(tmp_path)).start()
+    ids = list(landmarks)
+
+    replacement = random_landmarks(rng)
+    added = str(ObjectId())
+    added_landmarks = random_landmarks(rng)
+    for index in (memory, mapped):
+        index.add(ids[0], replacement)
+        index.remove(ids[1])
+        index.add(added, added_landmarks)
+    assert len(memory) == len(mapped) == len(landmarks)
+
+    for video_id, query in [(ids[0], clip(replacement)), (added, clip(added_landmarks)), (ids[2], clip(landmarks[ids[2]]))]:
+        assert mapped.query(query) == memory.query(query)
+        assert mapped.query(query)[0][0] == video_id
+    # Replaced and removed landmarks no longer match
+    assert all(m[0] != ids[0] for m in mapped.query(clip(landmarks[ids[0]])))
+    assert mapped.query(clip(landmarks[ids[1]])) == []
+
+
+def test_snapshot_compaction_keeps_live_postings(catalog, tmp_path, monkeypatch):
+    collection, landmarks, rng = catalog
+    index = LandmarkIndex()
+    sync = LandmarkSnapshotSync(collection, index, str(tmp_path))
+    sync.start()
+    monkeypatch.setattr(LandmarkSnapshotSync, "compact_rows", 2)
+    ids = list(landmarks)
+    store(collection, ids[0], random_landmarks(rng), NOW)
+    store(collection, ids[1], None, NOW)
+    before = {video_id: index.query(clip(landmarks[video_id])) for video_id in ids[2:6]}
+    sync.sync()
+
+    assert len(sync.snapshot) == len(landmarks) - 1
+    assert sync.synced_rows == 0
+    assert len(index) == len(landmarks) - 1
+    for video_id, matches in before.items():
+        assert index.query(clip(landmarks[video_id])) == matches
+
+
+def test_sync_skips_own_writes_and_applies_others(catalog):
+    collection, landmarks, rng = catalog
+    index = LandmarkIndex()
+    index.load(collection)
+    ids = list(landmarks)
+
+    own = random_landmarks(rng)
+    index.add(ids[0], own)
+    store(collection, ids[0], own, NOW)
+    other = random_landmarks(rng)
+    store(collection, ids[1], other, NOW)
+    assert index.sync(collection) == 1
+    assert index.sync(collection) == 0
+    assert index.query(clip(other))[0][0] == ids[1]
+    assert index.dead_rows == 2
+
+
+def test_sync_reloads_once_dead_rows_pile_up(catalog, monkeypatch):
+    collection, landmarks, _ = catalog
+    monkeypatch.setattr(audio_landmarks, "LANDMARK_COMPACT_DEAD_RATIO", 0.25)
+    index = LandmarkIndex()
+    index.load(collection)
+    ids = list(landmarks)
+    for video_id in ids[:20]:
+        index.add(video_id, landmarks[video_id])
+    assert index.needs_compaction()
+    index.sync(collection)
+    assert index.dead_rows == 0
+    assert len(index._doc_ids) == len(landmarks)
+    assert index.query(clip(landmarks[ids[0]]))[0][0] == ids[0]
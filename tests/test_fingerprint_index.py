@@ -0,0 +1,78 @@
+import mongomock
+import numpy as np
+import pytest
+from bson import ObjectId
+from fingerprint_index import LinearFingerprintIndex, MultiIndexHashIndex, create_fingerprint_index
+
+
+def flip_bits(hex_str, rng, count):
+    value = int(hex_str, 16)
+    for bit in rng.choice(256, count, replace=False):
+        value ^= 1 << int(bit)
+    return f"{value:064x}"
+
+
+@pytest.fixture
+def catalog():
+    """Random fingerprints plus near copies at 0-12 bits from a few queries."""
+    rng = np.random.default_rng(3)
+    queries = [rng.bytes(32).hex() for _ in range(5)]
+    fingerprints = {f"video-{i}": rng.bytes(32).hex() for i in range(2000)}
+    for q, query in enumerate(queries):
+        for distance in range(13):
+            fingerprints[f"near-{q}-{distance}"] = flip_bits(query, rng, distance)
+    return queries, fingerprints
+
+
+def results(index, query, threshold):
+    return sorted(index.query(query, threshold))
+
+
+@pytest.mark.parametrize("chunks", [4, 8, 16])
+def test_mih_matches_linear(catalog, chunks):
+    queries, fingerprints = catalog
+    linear = LinearFingerprintIndex("fingerprint")
+    mih = MultiIndexHashIndex("fingerprint", chunks=chunks)
+    for video_id, fingerprint in fingerprints.items():
+        linear.add(video_id, fingerprint)
+        mih.add(video_id, fingerprint)
+    for query in queries:
+        for threshold in (1, 5, 9):
+            expected = results(linear, query, threshold)
+            assert results(mih, query, threshold) == expected
+            assert all(distance < threshold for _, distance in expected)
+    assert len(mih) == len(linear) == len(fingerprints)
+
+
+@pytest.mark.parametrize("backend", ["linear", "mih"])
+def test_replace_and_remove(catalog, backend):
+    queries, fingerprints = catalog
+    index = create_fingerprint_index("fingerprint", backend)
+    index.bulk_load(list(fingerprints), np.vstack([
+        np.frombuffer(bytes.fromhex(h), dtype=">u8").astype(np.uint64) for h in fingerprints.values()
+    ]))
+    assert ("near-0-0", 0) in index.query(queries[0], 5)
+    index.add("near-0-0", flip_bits(queries[0], np.random.default_rng(0), 40))
+    index.remove("near-0-1")
+    matches = dict(index.query(queries[0], 5))
+    assert "near-0-0" not in matches and "near-0-1" not in matches
+    assert set(matches) == {"near-0-2", "near-0-3", "near-0-4"}
+    assert index.query(queries[0], 5, exclude_id="near-0-2") == [m for m in index.query(queries[0], 5) if m[0] != "near-0-2"]
+    # Invalid fingerprints can't be indexed and drop the old one
+    assert index.add("near-0-2", "not hex") is False
+    assert "near-0-2" not in dict(index.query(queries[0], 5))
+
+
+@pytest.mark.parametrize("backend", ["linear", "mih"])
+def test_load_skips_unusable_fingerprints(backend):
+    collection = mongomock.MongoClient().db.longvideos
+    good = ObjectId()
+    collection.insert_many([
+        {"_id": good, "fingerprint": "ab" * 32},
+        {"_id": ObjectId(), "fingerprint": ""},
+        {"_id": ObjectId(), "fingerprint": "abc"},
+        {"_id": ObjectId()},
+    ])
+    index = create_fingerprint_index("fingerprint", backend)
+    assert index.load(collection) == 1
+    assert index.query("ab" * 32, 1) == [(str(good), 0)]
@@ -0,0 +1,95 @@
+import threading
+import fakeredis
+import mongomock
+import numpy as np
+import pytest
+from bson import ObjectId
+from fingerprint_index import create_fingerprint_index
+from fingerprint_shard import (
+    FINGERPRINT_SHARD_PARTITIONS, FingerprintShard, FingerprintShardsUnavailable, ShardedFingerprintIndex, owner_of,
+)
+
+
+def near(hex_str, bits):
+    value = int(hex_str, 16)
+    for bit in range(bits):
+        value ^= 1 << (bit * 7)
+    return f"{value:064x}"
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(11)
+    collection = mongomock.MongoClient().db.longvideos
+    query = rng.bytes(32).hex()
+    docs = [{"_id": ObjectId(), "fingerprint": rng.bytes(32).hex()} for _ in range(300)]
+    docs += [{"_id": ObjectId(), "fingerprint": near(query, bits)} for bits in range(8)]
+    collection.insert_many(docs)
+    return collection, query
+
+
+@pytest.fixture
+def shards(catalog):
+    """Two shard processes serving in threads, sharing one Redis."""
+    collection, _ = catalog
+    server = fakeredis.FakeServer()
+    shards = [
+        FingerprintShard(shard_id, fakeredis.FakeRedis(server=server, decode_responses=True), collection, ["fingerprint"])
+        for shard_id in ("shard-a", "shard-b")
+    ]
+    for shard in shards:
+        shard.heartbeat()
+    # Loaded up front, so both are serving their partitions before the first query
+    for shard in shards:
+        shard.rebalance()
+    threads = [threading.Thread(target=shard.serve, daemon=True) for shard in shards]
+    for thread in threads:
+        thread.start()
+    yield shards, fakeredis.FakeRedis(server=server, decode_responses=True)
+    for shard in shards:
+        shard.stop()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_partitions_split_between_shards():
+    members = ["shard-a", "shard-b"]
+    owners = [owner_of(p, members) for p in range(FINGERPRINT_SHARD_PARTITIONS)]
+    assert set(owners) == set(members)
+    # Adding a member only moves partitions to the new one
+    grown = [owner_of(p, members + ["shard-c"]) for p in range(FINGERPRINT_SHARD_PARTITIONS)]
+    assert all(new in (old, "shard-c") for old, new in zip(owners, grown))
+
+
+def test_scatter_gather_matches_local_index(catalog, shards):
+    collection, query = catalog
+    shard_list, r = shards
+    held = [shard.held_partitions() for shard in shard_list]
+    assert held[0] and held[1] and not held[0] & held[1]
+    assert held[0] | held[1] == set(range(FINGERPRINT_SHARD_PARTITIONS))
+
+    local = create_fingerprint_index("fingerprint")
+    local.load(collection)
+    sharded = ShardedFingerprintIndex("fingerprint", r, timeout=5)
+    for threshold in (1, 4, 8):
+        assert sorted(sharded.query(query, threshold)) == sorted(local.query(query, threshold))
+
+    # Writes go to the owning shard
+    video_id = str(ObjectId())
+    sharded.add(video_id, query)
+    for _ in range(50):
+        if (video_id, 0) in sharded.query(query, 1):
+            break
+    assert (video_id, 0) in sharded.query(query, 1)
+    assert video_id not in dict(sharded.query(query, 1, exclude_id=video_id))
+
+
+def test_missing_shards_fail_the_query(catalog):
+    _, query = catalog
+    r = fakeredis.FakeRedis(decode_responses=True)
+    with pytest.raises(FingerprintShardsUnavailable):
+        ShardedFingerprintIndex("fingerprint", r, timeout=0.2).query(query, 5)
+    # A member that never answers leaves its partitions uncovered
+    FingerprintShard("silent", r, mongomock.MongoClient().db.longvideos, ["fingerprint"]).heartbeat()
+    with pytest.raises(FingerprintShardsUnavailable):
+        ShardedFingerprintIndex("fingerprint", r, timeout=0.2).query(query, 5)
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+import mongomock
+import numpy as np
+import pytest
+from bson import ObjectId
+import fingerprint_snapshot
+from fingerprint_index import create_fingerprint_index
+from fingerprint_snapshot import FingerprintSnapshot, SnapshotSync, datetime_to_ms, ms_to_datetime, write_snapshot
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def fingerprint(rng):
+    return rng.bytes(32).hex()
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.longvideos
+
+
+def insert(collection, fingerprint_hex, written_at=NOW, video_id=None):
+    video_id = video_id or ObjectId()
+    collection.update_one(
+        {"_id": video_id},
+        {"$set": {"fingerprint": fingerprint_hex, "fingerprint_updated_at": written_at}},
+        upsert=True,
+    )
+    return str(video_id)
+
+
+def test_datetime_ms_round_trip():
+    assert ms_to_datetime(datetime_to_ms(NOW)) == NOW
+
+
+def test_write_and_map(tmp_path):
+    rng = np.random.default_rng(1)
+    ids = [str(ObjectId()) for _ in range(10)]
+    words = rng.integers(0, 2 ** 63, (10, 4), dtype=np.uint64)
+    path = str(tmp_path / "snap.fps")
+    write_snapshot(path, ids, words, 1234)
+    snapshot = FingerprintSnapshot(path)
+    assert snapshot.watermark_ms == 1234
+    assert snapshot.id_list() == sorted(ids)
+    order = np.argsort(ids)
+    assert np.array_equal(np.asarray(snapshot.words), words[order])
+    assert not snapshot.replaced()
+    write_snapshot(path, ids[:3], words[:3], 99)
+    assert snapshot.replaced()
+
+
+def test_sync_requires_directory(collection, monkeypatch):
+    monkeypatch.setattr(fingerprint_snapshot, "FINGERPRINT_SNAPSHOT_DIR", "")
+    with pytest.raises(ValueError):
+        SnapshotSync(collection, create_fingerprint_index("fingerprint"))
+
+
+@pytest.mark.parametrize("backend", ["linear", "mih"])
+def test_sync_overlap_applies_each_write_once(collection, tmp_path, backend):
+    rng = np.random.default_rng(2)
+    old = [insert(collection, fingerprint(rng), NOW - timedelta(hours=1)) for _ in range(20)]
+    index = create_fingerprint_index("fingerprint", backend)
+    sync = SnapshotSync(collection, index, str(tmp_path))
+    assert sync.start() == 20
+    assert sync.synced_rows == 0
+
+    # Written after the snapshot, within the overlap every poll reads again
+    fresh = insert(collection, fingerprint(rng), NOW)
+    assert sync.poll() == 1
+    assert sync.poll() == 0
+    assert sync.synced_rows == 1
+
+    # Rewritten with a new timestamp: applied again, and the old version is gone
+    replacement = fingerprint(rng)
+    insert(collection, replacement, NOW + timedelta(seconds=1), ObjectId(old[0]))
+    assert sync.poll() == 1
+    assert index.query(replacement, 1) == [(old[0], 0)]
+    assert sync.synced_rows == 2
+
+    # Cleared fingerprints remove the video
+    collection.update_one(
+        {"_id": ObjectId(fresh)}, {"$set": {"fingerprint": "", "fingerprint_updated_at": NOW + timedelta(seconds=2)}}
+    )
+    sync.poll()
+    assert len(index) == 20
+
+
+def test_compaction_and_replaced_snapshot(collection, tmp_path, monkeypatch):
+    rng = np.random.default_rng(4)
+    for _ in range(5):
+        insert(collection, fingerprint(rng), NOW - timedelta(hours=1))
+    first = SnapshotSync(collection, create_fingerprint_index("fingerprint"), str(tmp_path))
+    second = SnapshotSync(collection, create_fingerprint_index("fingerprint"), str(tmp_path))
+    first.start()
+    second.start()
+    monkeypatch.setattr(SnapshotSync, "compact_rows", 3)
+    added = [insert(collection, fingerprint(rng), NOW + timedelta(seconds=i)) for i in range(3)]
+    first.sync()
+    # first wrote a snapshot holding every row, second switches to it on its next sync
+    assert len(FingerprintSnapshot(first.path)) == 8
+    assert first.synced_rows == 0
+    second.sync()
+    assert second.snapshot.inode == first.snapshot.inode
+    assert len(second.index) == 8
+    assert set(added) <= set(second.snapshot.id_list())
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from hash_math import (
+    bits_to_hex, hamming_distance, hamming_distances, hex_to_bits, hex_to_words, majority_vote_hex, popcount64,
+    words_to_hex,
+)
+from video_fingerprint import binary_to_hex, hex_to_binary
+
+
+def string_majority_vote(hashes):
+    """The string loop majority_vote_hex replaced."""
+    bits = [hex_to_binary(h) for h in hashes]
+    avg = "".join("1" if sum(int(b[i]) for b in bits) > len(hashes) / 2 else "0" for i in range(len(bits[0])))
+    return binary_to_hex(avg)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 4, 11])
+def test_majority_vote_matches_string_loop(rng, count):
+    hashes = [rng.bytes(32).hex() for _ in range(count)]
+    assert majority_vote_hex(hashes) == string_majority_vote(hashes)
+
+
+def test_bits_round_trip_odd_length():
+    for hex_str in ["f", "0a1", "00ff0", "8" * 64]:
+        bits = hex_to_bits(hex_str)
+        assert len(bits) == 4 * len(hex_str)
+        assert "".join(map(str, bits)) == hex_to_binary(hex_str)
+        assert bits_to_hex(bits) == hex_str
+
+
+def test_words_round_trip(rng):
+    hex_str = rng.bytes(32).hex()
+    assert words_to_hex(hex_to_words(hex_str)) == hex_str
+    assert hex_to_words(hex_str[:-1]) is None
+    assert hex_to_words("z" * 64) is None
+    assert hex_to_words("") is None
+
+
+def test_popcount(rng):
+    words = rng.integers(0, np.iinfo(np.uint64).max, 100, dtype=np.uint64, endpoint=True)
+    assert popcount64(words).tolist() == [bin(int(w)).count("1") for w in words]
+
+
+def test_hamming_distances_match_scalar(rng):
+    query = rng.bytes(32).hex()
+    rows = [rng.bytes(32).hex() for _ in range(50)]
+    distances = hamming_distances(hex_to_words(query), np.vstack([hex_to_words(h) for h in rows]))
+    assert distances.tolist() == [hamming_distance(query, h) for h in rows]
+
+
+def test_hamming_distance_rejects_mismatched_input():
+    assert hamming_distance("", "ab") is None
+    assert hamming_distance("ab", "abc") is None
+    assert hamming_distance("zz", "ab") is None
+    assert hamming_distance("f0", "0f") == 8
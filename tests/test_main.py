@@ -0,0 +1,28 @@
+import main
+from lanes import Lane
+from scheduler import EventScheduler
+
+
+def test_plan_read_splits_lane_capacity_across_streams():
+    scheduler = EventScheduler(max_pending=8, lanes=[Lane("interactive", 3), Lane("bulk", 1)])
+    stream_lanes = {"a:interactive": "interactive", "b:interactive": "interactive", "a:bulk": "bulk", "b:bulk": "bulk"}
+    streams = ["ingress"] + list(stream_lanes)
+    selected, count = main.plan_read(streams, stream_lanes, scheduler)
+    assert selected == streams
+    # COUNT is per stream: 4 streams may each return `count` events
+    assert count * (len(selected) - 1) <= scheduler.free_capacity()
+    assert count == 1
+
+
+def test_plan_read_rotates_when_a_lane_has_fewer_slots_than_streams():
+    scheduler = EventScheduler(max_pending=2, lanes=[Lane("bulk", 1)])
+    stream_lanes = {f"s{i}:bulk": "bulk" for i in range(3)}
+    streams = list(stream_lanes)
+    reads = [main.plan_read(streams, stream_lanes, scheduler, turn) for turn in range(3)]
+    assert all(count == 1 and len(selected) == 2 for selected, count in reads)
+    assert {stream for selected, _ in reads for stream in selected} == set(streams)
+
+
+def test_enqueued_at_survives_forwarding():
+    assert main.event_enqueued_at({main.ENQUEUED_AT_FIELD: "1700000000000"}, "1800000000000-0") == 1700000000.0
+    assert main.event_enqueued_at({}, "1800000000000-0") == 1800000000.0
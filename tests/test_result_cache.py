@@ -0,0 +1,107 @@
+import asyncio
+import fakeredis
+import mongomock
+import numpy as np
+import pytest
+from bson import Binary, ObjectId
+import result_cache
+from audio_landmarks import landmarks_to_bytes
+from mongodb import landmark_collection
+from result_cache import RESULT_VERSIONS, ResultCache, content_key
+
+HEAD = {"ETag": '"abc123"', "ContentLength": 42}
+LANDMARKS = np.array([[5, 1], [9, 2]], dtype=np.uint32)
+
+
+def test_content_key():
+    key = content_key("video_fingerprint", HEAD)
+    assert key.startswith("result_cache:video_fingerprint:")
+    assert key.endswith(":abc123:42")
+    # Different sizes and analyses never share a key
+    assert content_key("video_fingerprint", {**HEAD, "ContentLength": 43}) != key
+    assert content_key("nsfw_detection", HEAD) != key
+    assert content_key("video_fingerprint", {"ContentLength": 42}) is None
+
+
+def test_key_changes_with_the_result_version(monkeypatch):
+    key = content_key("audio_fingerprint", HEAD)
+    monkeypatch.setitem(RESULT_VERSIONS, "audio_fingerprint", RESULT_VERSIONS["audio_fingerprint"] + ":next")
+    assert content_key("audio_fingerprint", HEAD) != key
+
+
+@pytest.fixture
+def stores():
+    collection = landmark_collection(mongomock.MongoClient().db.longvideos)
+    return fakeredis.aioredis.FakeRedis(decode_responses=True), collection
+
+
+def test_results_are_shared_through_redis(stores):
+    r, collection = stores
+
+    async def run():
+        await ResultCache(r, collection).put("video_fingerprint", "k", "ff" * 32)
+        await ResultCache(r, collection).put("nsfw_detection", "n", True)
+        other = ResultCache(r, collection)
+        return await other.get("video_fingerprint", "k"), await other.get("nsfw_detection", "n")
+
+    assert asyncio.run(run()) == ("ff" * 32, True)
+
+
+def test_landmarks_are_read_back_from_their_collection(stores):
+    r, collection = stores
+    video_id = ObjectId()
+    fingerprint = "ab" * 32
+    collection.insert_one({"_id": video_id, "audio_fingerprint": fingerprint, "landmarks": Binary(landmarks_to_bytes(LANDMARKS))})
+
+    async def run():
+        await ResultCache(r, collection).put("audio_fingerprint", "k", (fingerprint, LANDMARKS), str(video_id))
+        hit = await ResultCache(r, collection).get("audio_fingerprint", "k")
+        # Re-fingerprinted since: the stored landmarks no longer belong to this result
+        collection.update_one({"_id": video_id}, {"$set": {"audio_fingerprint": "cd" * 32}})
+        stale = await ResultCache(r, collection).get("audio_fingerprint", "k")
+        return hit, stale
+
+    (hit_fingerprint, hit_landmarks), stale = asyncio.run(run())
+    assert hit_fingerprint == fingerprint
+    assert np.array_equal(hit_landmarks, LANDMARKS)
+    assert stale is result_cache._MISS
+
+
+def test_landmarks_without_a_video_stay_local(stores):
+    r, collection = stores
+
+    async def run():
+        cache = ResultCache(r, collection)
+        await cache.put("audio_fingerprint", "k", ("ab" * 32, LANDMARKS))
+        return await cache.get("audio_fingerprint", "k"), await r.get("k")
+
+    (fingerprint, _), shared = asyncio.run(run())
+    assert fingerprint == "ab" * 32
+    assert shared is None
+
+
+def test_lru_evicts_oldest():
+    async def run():
+        cache = ResultCache(None, max_bytes=result_cache._ENTRY_BYTES * 2)
+        for key in ("a", "b", "c"):
+            await cache.put("video_fingerprint", key, key)
+        return [await cache.get("video_fingerprint", key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [result_cache._MISS, "b", "c"]
+
+
+def test_concurrent_runs_share_one_computation(monkeypatch):
+    monkeypatch.setattr(result_cache, "head_object", lambda s3_client, bucket, url: HEAD)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "ee" * 32
+
+    async def run():
+        cache = ResultCache(None)
+        return await asyncio.gather(*[cache.run("video_fingerprint", "x.mp4", None, compute) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["ee" * 32] * 5
+    assert len(calls) == 1
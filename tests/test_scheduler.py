@@ -0,0 +1,98 @@
+import asyncio
+import time
+import pytest
+from lanes import Lane, LanePolicy, parse_lanes, parse_mapping
+from scheduler import EventScheduler, FairSlots
+
+
+def test_parse_lanes():
+    lanes = parse_lanes("interactive:4:15, bulk:1")
+    assert [(l.name, l.weight, l.slo_seconds) for l in lanes] == [("interactive", 4.0, 15.0), ("bulk", 1.0, None)]
+    for spec in ("a:1,a:2", "a:1:2:3", ":1", "a:0"):
+        with pytest.raises(ValueError):
+            parse_lanes(spec)
+    assert parse_mapping("x=a, y=b") == {"x": "a", "y": "b"}
+    with pytest.raises(ValueError):
+        parse_mapping("x")
+
+
+def test_lane_policy_order():
+    policy = LanePolicy(
+        parse_lanes("interactive:4,bulk:1"),
+        {"video_fingerprint": "interactive", "nsfw_detection": "elsewhere"},
+        {"pro": "interactive"},
+    )
+    assert policy.lane_for({"type": "nsfw_detection", "lane": "interactive"}) == "interactive"
+    assert policy.lane_for({"type": "nsfw_detection", "creatorTier": "pro"}) == "interactive"
+    assert policy.lane_for({"type": "video_fingerprint"}) == "interactive"
+    # Mappings to lanes this worker doesn't run fall back to the last lane
+    assert policy.lane_for({"type": "nsfw_detection"}) == "bulk"
+
+
+def test_lane_capacity_shares():
+    scheduler = EventScheduler(max_pending=8, lanes=[Lane("interactive", 3), Lane("bulk", 1)])
+    assert scheduler.free_capacity("interactive") == 6
+    assert scheduler.free_capacity("bulk") == 2
+    assert scheduler.free_capacity() == 8
+
+
+def test_weighted_grants(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENCY_TEST_EVENT", "1")
+
+    async def run():
+        scheduler = EventScheduler(max_pending=40, lanes=[Lane("interactive", 3), Lane("bulk", 1)])
+        order = []
+
+        async def handler(lane):
+            order.append(lane)
+            await asyncio.sleep(0)
+
+        tasks = [
+            scheduler.submit("test_event", handler(lane), lane)
+            for _ in range(10) for lane in ("interactive", "bulk")
+        ]
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    # While both lanes are backlogged, interactive gets three grants for every bulk one
+    assert order[:12].count("interactive") == 9
+
+
+def test_overdue_lane_goes_first():
+    async def run():
+        lanes = {"fast": Lane("fast", 10), "slow": Lane("slow", 1, slo_seconds=1)}
+        slots = FairSlots(1, lanes)
+        await slots.acquire("fast", None)
+        granted = []
+
+        async def wait(lane, deadline):
+            await slots.acquire(lane, deadline)
+            granted.append(lane)
+
+        waiters = [
+            asyncio.create_task(wait("fast", None)),
+            asyncio.create_task(wait("slow", time.time() - 1)),
+        ]
+        await asyncio.sleep(0)
+        slots.release()
+        await asyncio.sleep(0)
+        return granted, waiters
+
+    granted, _ = asyncio.run(run())
+    assert granted == ["slow"]
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    async def run():
+        slots = FairSlots(1, {"default": Lane("default")})
+        await slots.acquire("default", None)
+        first = asyncio.create_task(slots.acquire("default", None))
+        second = asyncio.create_task(slots.acquire("default", None))
+        await asyncio.sleep(0)
+        first.cancel()
+        slots.release()
+        await asyncio.wait_for(second, 1)
+        return slots.free
+
+    assert asyncio.run(run()) == 0
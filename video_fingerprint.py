@@ -1,11 +1,28 @@
 import os
+import re
 import shutil
 import tempfile
 import subprocess
+import time
+from contextlib import closing
 import requests
+import numpy as np
 from PIL import Image
 import imagehash
-from s3 import download_video_from_s3
+from s3 import open_media
+from hash_math import majority_vote_hex, hamming_distance
+import metrics
+
+PHASH_SIZE = 16
+# imagehash.phash resizes to hash_size * highfreq_factor (4) before the DCT
+PHASH_IMAGE_SIZE = PHASH_SIZE * 4
+# "pipe" streams raw frames from ffmpeg, "jpeg" writes frames to disk first. Pipe fingerprints differ from
+# JPEG ones by a few bits, so keep "jpeg" until the catalog has been re-fingerprinted with the pipe.
+FINGERPRINT_FRAME_SOURCE = os.getenv("FINGERPRINT_FRAME_SOURCE", "jpeg")
+# Part of the result cache key: bump the leading number when a change alters fingerprint_video's result
+VIDEO_FINGERPRINT_RESULT_VERSION = f"1:{PHASH_SIZE}:{FINGERPRINT_FRAME_SOURCE}"
+
+
 def save_file_buffer(file_buffer, file_mime_type, video_id, temp_dir):
     """Save file buffer to a temp directory."""
     try:
@@ -23,10 +40,25 @@ def save_file_buffer(file_buffer, file_mime_type, video_id, temp_dir):
 def generate_phash(file_paths):
     """Generate perceptual hashes for a list of images."""
     hashes = []
-    for file_path in file_paths:
-        with Image.open(file_path) as img:
-            phash = imagehash.phash(img, hash_size=16)
-            hashes.append(phash.__str__())
+    with metrics.stage("phash"):
+        for file_path in file_paths:
+            with Image.open(file_path) as img:
+                phash = imagehash.phash(img, hash_size=PHASH_SIZE)
+                hashes.append(phash.__str__())
+    return hashes
+
+
+def generate_phash_from_frames(frames):
+    """Generate perceptual hashes for grayscale frames already at PHASH_IMAGE_SIZE."""
+    hashes = []
+    # Frames may be decoded lazily, only the hashing itself counts as the phash stage
+    hash_seconds = 0.0
+    for frame in frames:
+        start = time.perf_counter()
+        # PIL skips the resize when the size already matches
+        hashes.append(imagehash.phash(Image.fromarray(frame), hash_size=PHASH_SIZE).__str__())
+        hash_seconds += time.perf_counter() - start
+    metrics.record_stage("phash", hash_seconds)
     return hashes
 
 
@@ -39,17 +71,8 @@ def binary_to_hex(bin_str):
 
 
 def bitwise_avg_hashes(p_hashes):
-    binary_hashes = [hex_to_binary(h) for h in p_hashes]
-    bit_length = len(binary_hashes[0])
-    bit_sums = [0] * bit_length
-
-    for bh in binary_hashes:
-        for i in range(bit_length):
-            bit_sums[i] += 1 if bh[i] == '1' else 0
-
-    threshold = len(p_hashes) / 2
-    final_binary = ''.join('1' if s > threshold else '0' for s in bit_sums)
-    return binary_to_hex(final_binary)
+    """Majority-vote the frame hashes into one fingerprint."""
+    return majority_vote_hex(p_hashes)
 
 
 def get_frames(file_path, output_dir, file_name):
@@ -68,6 +91,95 @@ def get_frames(file_path, output_dir, file_name):
     ]
 
 
+def ffmpeg_probe(video_path: str):
+    """(duration seconds or 0, has audio) from the container header, as reported by `ffmpeg -i`."""
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-i", video_path], capture_output=True, text=True)
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    duration = int(match[1]) * 3600 + int(match[2]) * 60 + float(match[3]) if match else 0
+    return duration, re.search(r"Stream #\d+:\d+.*: Audio:", result.stderr) is not None
+
+
+def iter_ffmpeg_output(cmd, chunk_bytes: int, stage: str, keep_partial: bool = False):
+    """
+    Run an ffmpeg command that writes to stdout and yield chunk_bytes of its
+    output at a time; the shorter last chunk too when keep_partial is set.
+    Closing the generator early kills ffmpeg. Time spent waiting on ffmpeg
+    is recorded as `stage`, and a failed ffmpeg raises CalledProcessError.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finished = False
+    decode_seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            buf = proc.stdout.read(chunk_bytes)
+            decode_seconds += time.perf_counter() - start
+            if len(buf) < chunk_bytes:
+                finished = True
+                if buf and keep_partial:
+                    yield buf
+                break
+            yield buf
+    finally:
+        metrics.record_stage(stage, decode_seconds)
+        proc.stdout.close()
+        if proc.poll() is None and not finished:
+            proc.kill()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+
+def iter_rawvideo(cmd, frame_shape):
+    """
+    Run an ffmpeg command that writes rawvideo to stdout and yield one uint8
+    frame of frame_shape at a time, as the ffmpeg_decode_video stage.
+    """
+    frame_count = 0
+    try:
+        with closing(iter_ffmpeg_output(cmd, int(np.prod(frame_shape)), "ffmpeg_decode_video")) as chunks:
+            for buf in chunks:
+                frame_count += 1
+                yield np.frombuffer(buf, dtype=np.uint8).reshape(frame_shape)
+    finally:
+        metrics.count("ffmpeg_decode_video", "frames", frame_count)
+
+
+def iter_gray_frames(file_path, size=PHASH_IMAGE_SIZE, fps=1, max_frames=100):
+    """
+    Stream grayscale frames downscaled to size x size from ffmpeg's stdout.
+    Only one frame is held in memory at a time.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", file_path,
+        "-vf", f"fps={fps},scale={size}:{size}:flags=lanczos,format=gray",
+        "-frames:v", str(max_frames),
+        "-f", "rawvideo", "-pix_fmt", "gray", "pipe:1"
+    ]
+    return iter_rawvideo(cmd, (size, size))
+
+
+def hash_video_frames(file_path, output_dir, file_name):
+    """
+    pHash up to 100 frames (1 fps) of a video. Uses the ffmpeg pipe when
+    FINGERPRINT_FRAME_SOURCE is "pipe" and falls back to JPEG frames on disk.
+    """
+    if FINGERPRINT_FRAME_SOURCE == "pipe":
+        try:
+            p_hashes = generate_phash_from_frames(iter_gray_frames(file_path))
+            if p_hashes:
+                return p_hashes
+            print(f"⚠️ No frames read from ffmpeg pipe for {file_name}, falling back to JPEG frames")
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"⚠️ ffmpeg pipe failed for {file_name}, falling back to JPEG frames: {e}")
+
+    with metrics.stage("ffmpeg_decode_video"):
+        files = get_frames(file_path, output_dir, file_name)
+    return generate_phash(files)
+
+
 def cleanup(*dirs):
     """Delete temporary directories."""
     for d in dirs:
@@ -90,17 +202,15 @@ def cleanup(*paths):
 
 
 def fingerprint_video(video_id, video_url,s3_client):
-    temp_dir = tempfile.mkdtemp()
     output_dir = tempfile.mkdtemp()
 
     try:
-        input_file_path, input_file_name = download_video_from_s3(video_url,video_id,temp_dir,s3_client)
+        # Cached download shared with the other analyses of the same upload, or a ranged stream
+        with open_media(video_url, s3_client, "video_fingerprint") as input_file_path:
+            input_file_name = f"{video_id}{os.path.splitext(input_file_path)[1]}"
 
-        # Extract frames
-        files = get_frames(input_file_path, output_dir, input_file_name)
-
-        # Generate hashes
-        p_hashes = generate_phash(files)
+            # Extract frames and generate hashes
+            p_hashes = hash_video_frames(input_file_path, output_dir, input_file_name)
 
         # Average hash
         fingerprint = bitwise_avg_hashes(p_hashes)
@@ -108,16 +218,12 @@ def fingerprint_video(video_id, video_url,s3_client):
         return fingerprint
 
     finally:
-        cleanup(temp_dir, output_dir)
+        cleanup(output_dir)
 
 
 def compare_hamming_distance(str1, str2, threshold=5):
     """Compare hashes with Hamming distance."""
-    bin1 = hex_to_binary(str1)
-    bin2 = hex_to_binary(str2)
-
-    if len(bin1) != len(bin2):
+    dif = hamming_distance(str1, str2)
+    if dif is None:
         return False
-
-    dif = sum(1 for a, b in zip(bin1, bin2) if a != b)
     return dif < threshold